@@ -0,0 +1,7 @@
+@echo off
+REM Activa el entorno virtual
+call .\venv\Scripts\activate.bat
+
+REM Vigila los archivos .dbf y sincroniza las tablas que cambian
+echo "Vigilando los archivos .dbf (cierre esta ventana para detener)..."
+python watch_dbf.py
\ No newline at end of file
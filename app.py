@@ -1,21 +1,35 @@
 # app.py
 
-from flask import Flask, render_template, request, Response, redirect, url_for, jsonify
+from flask import Flask, render_template, request, Response, redirect, url_for, jsonify, stream_with_context
 import subprocess
 from dbfread import DBF
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from fpdf import FPDF
 import datetime
 import os
+import json
+import base64
+import csv
+import io
+import tempfile
 import locale
 from decimal import Decimal
 import math
+import queue
 import requests
 from bs4 import BeautifulSoup
 import sys
 import psycopg2
-from psycopg2.extras import DictCursor
+from psycopg2.extras import DictCursor, execute_values
 from dateutil.relativedelta import relativedelta
+from sync_db import refresh_facetas, refresh_combustible_stock, refresh_fletes_margen, refresh_eficiencia_combustible, refresh_resumen_diario, FUENTES_RESUMEN_DIARIO
+from sync_db import refresh_distancias_rutas, refresh_contract_summary, DISTANCIAS_MINIMO_VIAJES
+from valuacion_combustible import invalidar_valuacion_combustible, refresh_valuacion_combustible, get_retiros_valorizados, METODOS_VALUACION
+from precios_granos import refresh_precios_granos, get_serie_precios, ESCALAS_PRECIOS
+from pronostico_entregas import refresh_pronostico_entregas, PRONOSTICO_SEMANAS
+from planificador_despachos import get_datos_planificacion, planificar_despachos, PLAN_VIAJES_POR_DIA
+from busqueda import refresh_busqueda, buscar, get_etiquetas, tiene_pg_trgm, BUSQUEDA_LIMITE
+from notificaciones import notificar, EscuchaCambios, ESPERA_SEGUNDOS
 
 # --- CONFIGURACIÓN DE LOCALIZACIÓN PARA FORMATO DE NÚMEROS ---
 try:
@@ -73,6 +87,8 @@ def sync_db():
         )
         
         print(result.stdout) # Muestra la salida del script en la consola del servidor
+        invalidar_facetas()
+        invalidar_distancias_rutas()
         return jsonify({'status': 'success', 'message': 'Sincronización completada exitosamente.'})
 
     except subprocess.CalledProcessError as e:
@@ -98,6 +114,8 @@ def update_sync_db():
             check=True
         )
         print(result.stdout)
+        invalidar_facetas()
+        invalidar_distancias_rutas()
         return jsonify({'status': 'success', 'message': 'Sincronización por actualización completada exitosamente.'})
     except subprocess.CalledProcessError as e:
         print(f"Error durante la sincronización por actualización: {e.stderr}")
@@ -148,8 +166,16 @@ def format_number(value, is_currency=False, decimals=0):
     except Exception:
         return value
 
+def format_variacion(actual, anterior):
+    """Variación porcentual de 'actual' respecto de 'anterior' (p. ej. '+12,50 %'); vacío si no hay base."""
+    if not anterior:
+        return ""
+    variacion = (float(actual or 0) - float(anterior)) / abs(float(anterior)) * 100
+    return ('+' if variacion > 0 else '') + format_number(variacion, decimals=2) + ' %'
+
 app.jinja_env.globals.update(format_number=format_number)
 app.jinja_env.globals.update(format_date=format_date)
+app.jinja_env.globals.update(format_variacion=format_variacion)
 
 class PDF(FPDF):
     def header(self):
@@ -228,6 +254,119 @@ def home():
     return render_template('home.html')
 
 
+# --- RESUMEN DIARIO ---
+# Totales por rango de fechas leídos de 'resumen_diario' (ver sync_db.refresh_resumen_diario).
+# Las tablas originales sólo se recorren al pedir el detalle de los movimientos.
+DIMENSIONES_RESUMEN = ('fecha', 'grano', 'cosecha', 'cliente')
+
+def get_resumen(cursor, fuente, fecha_desde, fecha_hasta, agrupar=(), filtros=None):
+    """
+    Suma registros, kilos, kilos brutos e importe de una fuente entre dos
+    fechas (inclusive), agrupando por las dimensiones pedidas y filtrando
+    por igualdad en 'filtros' (p. ej. {'grano': '01'}).
+    """
+    agrupar = [dim for dim in agrupar if dim in DIMENSIONES_RESUMEN]
+    condiciones = ["fuente = %s", "fecha BETWEEN %s AND %s"]
+    params = [fuente, fecha_desde, fecha_hasta]
+    for dim, valor in (filtros or {}).items():
+        if dim in DIMENSIONES_RESUMEN and valor:
+            condiciones.append(f"{dim} = %s")
+            params.append(valor)
+    columnas = ", ".join(agrupar)
+    query = f"""
+        SELECT {columnas + ',' if columnas else ''}
+               COALESCE(SUM(registros), 0) AS registros, COALESCE(SUM(kilos), 0) AS kilos,
+               COALESCE(SUM(kilos_brutos), 0) AS kilos_brutos, COALESCE(SUM(importe), 0) AS importe
+        FROM resumen_diario
+        WHERE {' AND '.join(condiciones)}
+    """
+    if agrupar:
+        query += f" GROUP BY {columnas} ORDER BY {columnas}"
+    cursor.execute(query, params)
+    return cursor.fetchall()
+
+METRICAS_RESUMEN = ('registros', 'kilos', 'kilos_brutos', 'importe')
+
+def periodo_anterior(fecha_desde, fecha_hasta):
+    """El mismo período un año antes (la campaña anterior)."""
+    return fecha_desde - relativedelta(years=1), fecha_hasta - relativedelta(years=1)
+
+def get_resumen_interanual(cursor, fuentes, fecha_desde, fecha_hasta, agrupar=()):
+    """
+    Como get_resumen, pero para varias fuentes y devolviendo en la misma fila
+    el período pedido y el mismo período del año anterior (columnas con sufijo
+    '_anterior'). Ambos se calculan en una sola pasada con agregación condicional.
+    """
+    desde_anterior, hasta_anterior = periodo_anterior(fecha_desde, fecha_hasta)
+    agrupar = ['fuente'] + [dim for dim in agrupar if dim in DIMENSIONES_RESUMEN]
+    columnas = ", ".join(agrupar)
+    metricas = ",\n".join(
+        f"COALESCE(SUM({m}) FILTER (WHERE fecha BETWEEN %(desde)s AND %(hasta)s), 0) AS {m}, "
+        f"COALESCE(SUM({m}) FILTER (WHERE fecha BETWEEN %(desde_anterior)s AND %(hasta_anterior)s), 0) AS {m}_anterior"
+        for m in METRICAS_RESUMEN
+    )
+    cursor.execute(f"""
+        SELECT {columnas}, {metricas}
+        FROM resumen_diario
+        WHERE fuente = ANY(%(fuentes)s)
+          AND (fecha BETWEEN %(desde)s AND %(hasta)s OR fecha BETWEEN %(desde_anterior)s AND %(hasta_anterior)s)
+        GROUP BY {columnas}
+        ORDER BY {columnas}
+    """, {'fuentes': list(fuentes), 'desde': fecha_desde, 'hasta': fecha_hasta,
+          'desde_anterior': desde_anterior, 'hasta_anterior': hasta_anterior})
+    return cursor.fetchall()
+
+def asegurar_resumen_diario(cursor):
+    """Construye el resumen diario si todavía no existe (antes de la primera sincronización)."""
+    cursor.execute("SELECT to_regclass('resumen_diario') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        refresh_resumen_diario(cursor)
+        cursor.connection.commit()
+
+@app.route('/resumen')
+def resumen_json():
+    """
+    Totales de cualquier rango de fechas desde el resumen diario.
+    Parámetros: fuente, fecha_desde, fecha_hasta, agrupar (dimensiones separadas
+    por coma) y grano/cosecha/cliente como filtros.
+    """
+    fuente = request.args.get('fuente', 'entregas')
+    if fuente not in FUENTES_RESUMEN_DIARIO:
+        return jsonify({'success': False, 'error': f"Fuente inválida. Opciones: {', '.join(FUENTES_RESUMEN_DIARIO)}."}), 400
+    hoy = datetime.date.today()
+    fecha_desde = request.args.get('fecha_desde') or hoy.replace(day=1).strftime('%Y-%m-%d')
+    fecha_hasta = request.args.get('fecha_hasta') or hoy.strftime('%Y-%m-%d')
+    agrupar = [dim.strip() for dim in request.args.get('agrupar', '').split(',') if dim.strip()]
+    filtros = {dim: request.args.get(dim) for dim in ('grano', 'cosecha', 'cliente')}
+
+    conn = get_db()
+    if not conn:
+        return jsonify({'success': False, 'error': 'No se pudo conectar a la base de datos.'}), 500
+    try:
+        with get_dict_cursor(conn) as cursor:
+            asegurar_resumen_diario(cursor)
+            filas = get_resumen(cursor, fuente, fecha_desde, fecha_hasta, agrupar, filtros)
+        resultado = []
+        for fila in filas:
+            item = {dim: fila[dim] for dim in agrupar if dim in DIMENSIONES_RESUMEN}
+            if 'fecha' in item:
+                item['fecha'] = item['fecha'].strftime('%Y-%m-%d')
+            item.update({
+                'registros': fila['registros'],
+                'kilos': float(fila['kilos']),
+                'kilos_brutos': float(fila['kilos_brutos']),
+                'importe': float(fila['importe']),
+            })
+            resultado.append(item)
+        return jsonify({'success': True, 'fuente': fuente, 'fecha_desde': fecha_desde,
+                        'fecha_hasta': fecha_hasta, 'resumen': resultado})
+    except Exception as e:
+        print(f"Error al leer el resumen diario: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        if conn:
+            conn.close()
+
 @app.route('/dashboard', methods=['GET', 'POST'])
 def dashboard():
     try:
@@ -243,6 +382,10 @@ def dashboard():
 
         fecha_desde_dt = datetime.datetime.strptime(filtros_aplicados['fecha_desde'], '%Y-%m-%d').date()
         fecha_hasta_dt = datetime.datetime.strptime(filtros_aplicados['fecha_hasta'], '%Y-%m-%d').date()
+        # Cada panel se compara con el mismo período de la campaña anterior
+        desde_anterior_dt, hasta_anterior_dt = periodo_anterior(fecha_desde_dt, fecha_hasta_dt)
+        filtros_aplicados['fecha_desde_anterior'] = desde_anterior_dt
+        filtros_aplicados['fecha_hasta_anterior'] = hasta_anterior_dt
 
         # --- Lógica para Panel de Fletes ---
         fletes_data = None
@@ -250,15 +393,33 @@ def dashboard():
         if conn:
             try:
                 with get_dict_cursor(conn) as cursor:
-                    query = "SELECT SUM(o_neto) as total_neto, SUM(importe) as total_importe, COUNT(*) as total_viajes, SUM(g_kilomet) as total_km FROM fletes WHERE g_fecha >= %s AND g_fecha <= %s"
-                    cursor.execute(query, (filtros_aplicados['fecha_desde'], filtros_aplicados['fecha_hasta']))
+                    # Período actual y mismo período del año anterior en una sola pasada
+                    query = """
+                        SELECT
+                            SUM(o_neto) FILTER (WHERE g_fecha BETWEEN %(desde)s AND %(hasta)s) as total_neto,
+                            SUM(importe) FILTER (WHERE g_fecha BETWEEN %(desde)s AND %(hasta)s) as total_importe,
+                            COUNT(*) FILTER (WHERE g_fecha BETWEEN %(desde)s AND %(hasta)s) as total_viajes,
+                            SUM(g_kilomet) FILTER (WHERE g_fecha BETWEEN %(desde)s AND %(hasta)s) as total_km,
+                            SUM(o_neto) FILTER (WHERE g_fecha BETWEEN %(desde_anterior)s AND %(hasta_anterior)s) as total_neto_anterior,
+                            SUM(importe) FILTER (WHERE g_fecha BETWEEN %(desde_anterior)s AND %(hasta_anterior)s) as total_importe_anterior,
+                            COUNT(*) FILTER (WHERE g_fecha BETWEEN %(desde_anterior)s AND %(hasta_anterior)s) as total_viajes_anterior,
+                            SUM(g_kilomet) FILTER (WHERE g_fecha BETWEEN %(desde_anterior)s AND %(hasta_anterior)s) as total_km_anterior
+                        FROM fletes
+                        WHERE g_fecha BETWEEN %(desde)s AND %(hasta)s OR g_fecha BETWEEN %(desde_anterior)s AND %(hasta_anterior)s
+                    """
+                    cursor.execute(query, {'desde': fecha_desde_dt, 'hasta': fecha_hasta_dt,
+                                           'desde_anterior': desde_anterior_dt, 'hasta_anterior': hasta_anterior_dt})
                     fletes_result = cursor.fetchone()
                     if fletes_result:
                         fletes_data = {
                             'toneladas_transportadas': (fletes_result['total_neto'] or 0) / 1000,
                             'monto_facturado': fletes_result['total_importe'] or 0,
                             'cantidad_viajes': fletes_result['total_viajes'] or 0,
-                            'kilometros_recorridos': fletes_result['total_km'] or 0
+                            'kilometros_recorridos': fletes_result['total_km'] or 0,
+                            'toneladas_transportadas_anterior': (fletes_result['total_neto_anterior'] or 0) / 1000,
+                            'monto_facturado_anterior': fletes_result['total_importe_anterior'] or 0,
+                            'cantidad_viajes_anterior': fletes_result['total_viajes_anterior'] or 0,
+                            'kilometros_recorridos_anterior': fletes_result['total_km_anterior'] or 0
                         }
             finally:
                 conn.close()
@@ -267,38 +428,42 @@ def dashboard():
         ventas_por_grano = {}
         total_liquidado_kilos = 0
         total_liquidado_monto = 0
+        total_liquidado_kilos_anterior = 0
+        total_liquidado_monto_anterior = 0
 
         conn = get_db()
         if conn:
             try:
                 with get_dict_cursor(conn) as cursor:
-                    # Toneladas Entregadas (acocarpo table)
-                    cursor.execute("SELECT g_codi, g_saldo FROM acocarpo WHERE g_fecha >= %s AND g_fecha <= %s", (fecha_desde_dt, fecha_hasta_dt))
-                    for rec in cursor.fetchall():
-                        grano_code = rec.get('g_codi')
+                    asegurar_resumen_diario(cursor)
+                    # Entregas (acocarpo) por grano y liquidado (liqven), ambos períodos, desde el resumen diario
+                    for rec in get_resumen_interanual(cursor, ('entregas', 'liquidaciones'), fecha_desde_dt, fecha_hasta_dt, agrupar=('grano',)):
+                        if rec['fuente'] == 'liquidaciones':
+                            total_liquidado_kilos += rec['kilos']
+                            total_liquidado_monto += rec['importe']
+                            total_liquidado_kilos_anterior += rec['kilos_anterior']
+                            total_liquidado_monto_anterior += rec['importe_anterior']
+                            continue
+                        grano_code = rec['grano']
                         if not grano_code: continue
                         grano_desc = get_grano_description(grano_code, cursor)
-                        kilos = rec.get('g_saldo', 0) or 0
                         if grano_desc not in ventas_por_grano:
-                            ventas_por_grano[grano_desc] = {'toneladas_entregadas': 0}
-                        ventas_por_grano[grano_desc]['toneladas_entregadas'] += kilos
-
-                    # Toneladas y Monto Liquidado (liqven table) - Total en el período
-                    cursor.execute("SELECT peso, net_cta FROM liqven WHERE fec_c >= %s AND fec_c <= %s", (fecha_desde_dt, fecha_hasta_dt))
-                    for rec in cursor.fetchall():
-                        total_liquidado_kilos += rec.get('peso', 0) or 0
-                        total_liquidado_monto += rec.get('net_cta', 0) or 0
+                            ventas_por_grano[grano_desc] = {'toneladas_entregadas': 0, 'toneladas_entregadas_anterior': 0}
+                        ventas_por_grano[grano_desc]['toneladas_entregadas'] += rec['kilos']
+                        ventas_por_grano[grano_desc]['toneladas_entregadas_anterior'] += rec['kilos_anterior']
             finally:
                 conn.close()
         
         total_liquidado_toneladas = total_liquidado_kilos / 1000
+        total_liquidado_toneladas_anterior = total_liquidado_kilos_anterior / 1000
 
         # Combinar datos para la tabla
         ventas_data = []
         for grano, data in sorted(ventas_por_grano.items()):
             ventas_data.append({
                 'grano': grano,
-                'toneladas_entregadas': data['toneladas_entregadas'] / 1000
+                'toneladas_entregadas': data['toneladas_entregadas'] / 1000,
+                'toneladas_entregadas_anterior': data['toneladas_entregadas_anterior'] / 1000
             })
 
         # --- Lógica para Tabla de Stock y Pendiente ---
@@ -344,29 +509,30 @@ def dashboard():
         if conn:
             try:
                 with get_dict_cursor(conn) as cursor:
-                    cursor.execute("SELECT tip_f, imp_f FROM ccbcta WHERE vto_f >= %s AND vto_f <= %s", (fecha_desde_dt, fecha_hasta_dt))
-                    for rec in cursor.fetchall():
-                        tip_f = rec.get('tip_f', '').strip().upper()
-                        imp_f = rec.get('imp_f', 0) or 0
-                        
-                        if tip_f in ('LF', 'LP', 'FA'):
-                            vencimientos += imp_f
-                        elif tip_f in ('RI', 'SI', 'SG', 'SB'):
-                            cobrado += imp_f
+                    importes = {rec['fuente']: rec for rec in get_resumen_interanual(cursor, ('vencimientos', 'cobranzas'), fecha_desde_dt, fecha_hasta_dt)}
+                vencimientos = importes['vencimientos']['importe'] if 'vencimientos' in importes else 0
+                cobrado = importes['cobranzas']['importe'] if 'cobranzas' in importes else 0
+                vencimientos_anterior = importes['vencimientos']['importe_anterior'] if 'vencimientos' in importes else 0
+                cobrado_anterior = importes['cobranzas']['importe_anterior'] if 'cobranzas' in importes else 0
                 
                 cobranzas_data = {
                     'vencimientos': vencimientos,
                     'cobrado': cobrado,
-                    'saldo': vencimientos - cobrado
+                    'saldo': vencimientos - cobrado,
+                    'vencimientos_anterior': vencimientos_anterior,
+                    'cobrado_anterior': cobrado_anterior,
+                    'saldo_anterior': vencimientos_anterior - cobrado_anterior
                 }
             except Exception as e:
                 print(f"Error al leer cobranzas desde PostgreSQL: {e}")
-                cobranzas_data = {'vencimientos': 0, 'cobrado': 0, 'saldo': 0}
+                cobranzas_data = {'vencimientos': 0, 'cobrado': 0, 'saldo': 0,
+                                  'vencimientos_anterior': 0, 'cobrado_anterior': 0, 'saldo_anterior': 0}
             finally:
                 if conn:
                     conn.close()
         else:
-            cobranzas_data = {'vencimientos': 0, 'cobrado': 0, 'saldo': 0}
+            cobranzas_data = {'vencimientos': 0, 'cobrado': 0, 'saldo': 0,
+                              'vencimientos_anterior': 0, 'cobrado_anterior': 0, 'saldo_anterior': 0}
 
         # --- Lógica para Panel de Compras ---
         compras_data = []
@@ -374,26 +540,20 @@ def dashboard():
         if conn:
             try:
                 with get_dict_cursor(conn) as cursor:
-                    query = """
-                        SELECT 
-                            a.g_codi, 
-                            g.g_desc, 
-                            SUM(a.o_neto) as total_kilos, 
-                            COUNT(*) as movimientos
-                        FROM acohis a
-                        JOIN acogran g ON a.g_codi = g.g_codi
-                        WHERE a.g_ctl = 'I' AND a.g_fecha BETWEEN %s AND %s
-                        GROUP BY a.g_codi, g.g_desc
-                        ORDER BY g.g_desc
-                    """
-                    cursor.execute(query, (fecha_desde_dt, fecha_hasta_dt))
-                    compras_raw = cursor.fetchall()
+                    cursor.execute("SELECT g_codi, g_desc FROM acogran")
+                    granos_map = {rec['g_codi']: rec['g_desc'] for rec in cursor.fetchall()}
+                    compras_raw = get_resumen_interanual(cursor, ('compras',), fecha_desde_dt, fecha_hasta_dt, agrupar=('grano',))
                     for row in compras_raw:
+                        if row['grano'] not in granos_map:
+                            continue
                         compras_data.append({
-                            'grano': row['g_desc'],
-                            'kilos': row['total_kilos'],
-                            'movimientos': row['movimientos']
+                            'grano': granos_map[row['grano']],
+                            'kilos': row['kilos'],
+                            'movimientos': row['registros'],
+                            'kilos_anterior': row['kilos_anterior'],
+                            'movimientos_anterior': row['registros_anterior']
                         })
+                    compras_data.sort(key=lambda item: item['grano'])
             except Exception as e:
                 print(f"Error al leer compras desde PostgreSQL: {e}")
             finally:
@@ -427,6 +587,8 @@ def dashboard():
                                ventas_data=ventas_data,
                                total_liquidado_toneladas=total_liquidado_toneladas,
                                total_liquidado_monto=total_liquidado_monto,
+                               total_liquidado_toneladas_anterior=total_liquidado_toneladas_anterior,
+                               total_liquidado_monto_anterior=total_liquidado_monto_anterior,
                                stock_data=stock_data,
                                cobranzas_data=cobranzas_data,
                                compras_data=compras_data,
@@ -464,9 +626,6 @@ def get_contratos_pendientes(cursor, min_harvest_year=None):
         cursor.execute("SELECT contrato, peso FROM liqven")
         for rec in cursor.fetchall():
             contrato_liq = rec.get('contrato')
-            if contrato_liq and isinstance(contrato_liq, str):
-                contrato_liq = contrato_liq.strip()
-
             peso_liq = float(rec.get('peso', 0) or 0)
             if contrato_liq:
                 liquidaciones_por_contrato[contrato_liq] = liquidaciones_por_contrato.get(contrato_liq, 0) + peso_liq
@@ -495,8 +654,6 @@ def get_contratos_pendientes(cursor, min_harvest_year=None):
 
                 diferencia = kiloped - entrega
                 contrato = rec.get('nrocont_c', 'N/A')
-                if isinstance(contrato, str):
-                    contrato = contrato.strip()
 
                 grano_desc = rec.get('product_c', 'N/A')
                 comprador = rec.get('apelcom_c', 'N/A')
@@ -530,7 +687,31 @@ def get_contratos_pendientes(cursor, min_harvest_year=None):
 
     return contratos_pendientes, totales_por_grano_cosecha
 
-
+def get_pronostico_entregas(cursor):
+    """Pronóstico precalculado por la sincronización, por contrato. Si la tabla no existe la calcula."""
+    cursor.execute("SELECT to_regclass('pronostico_entregas') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        refresh_pronostico_entregas(cursor)
+        cursor.connection.commit()
+    cursor.execute("SELECT * FROM pronostico_entregas")
+    return {rec['contrato']: rec for rec in cursor.fetchall()}
+
+def get_cupos_solicitados(cursor):
+    """Cupos pendientes de asignar a un viaje y su total por grano."""
+    cursor.execute("SELECT * FROM cupos_solicitados WHERE flete_id IS NULL ORDER BY fecha_solicitud DESC")
+    cupos_solicitados = cursor.fetchall()
+    totales_cupos_por_grano = {}
+    for cupo in cupos_solicitados:
+        totales_cupos_por_grano[cupo['grano']] = totales_cupos_por_grano.get(cupo['grano'], 0) + cupo['cantidad']
+    return cupos_solicitados, totales_cupos_por_grano
+
+
+def asegurar_contract_summary(cursor):
+    """Construye el resumen por contrato si todavía no existe (antes de la primera sincronización)."""
+    cursor.execute("SELECT to_regclass('contract_summary') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        refresh_contract_summary(cursor)
+        cursor.connection.commit()
 
 @app.route('/ventas', methods=['GET', 'POST'])
 def ventas():
@@ -552,6 +733,9 @@ def ventas():
                     min_harvest_year_start = (current_year - 1) % 100
                     min_harvest_year = f"{min_harvest_year_start:02d}/{(min_harvest_year_start + 1):02d}"
                     contratos_pendientes, totales_por_grano_cosecha = get_contratos_pendientes(cursor, min_harvest_year=min_harvest_year)
+                    pronostico = get_pronostico_entregas(cursor)
+                    for contrato in contratos_pendientes:
+                        contrato['pronostico'] = pronostico.get(contrato['contrato'])
                     stock_granos_cosecha = get_stock_granos_por_cosecha(cursor)
 
                     # Prepare data for pie chart (pending shipments by grain)
@@ -583,27 +767,12 @@ def ventas():
         
         try:
             with get_dict_cursor(conn) as cursor:
-                cursor.execute("SELECT * FROM cupos_solicitados WHERE flete_id IS NULL ORDER BY fecha_solicitud DESC")
-                cupos_solicitados = cursor.fetchall()
-
-                cursor.execute("SELECT * FROM fletes ORDER BY g_fecha DESC")
-                fletes = cursor.fetchall()
-
-                totales_cupos_por_grano = {}
-                for cupo in cupos_solicitados:
-                    grano = cupo['grano']
-                    cantidad = cupo['cantidad']
-                    if grano not in totales_cupos_por_grano:
-                        totales_cupos_por_grano[grano] = 0
-                    totales_cupos_por_grano[grano] += cantidad
-
-                # --- Existing logic for contract selection ---
-                latest_dates = {}
-                cursor.execute("SELECT g_contrato, MAX(g_fecha) as max_fecha FROM acocarpo WHERE g_contrato IS NOT NULL AND g_fecha IS NOT NULL GROUP BY g_contrato")
-                for rec in cursor.fetchall():
-                    latest_dates[rec['g_contrato']] = rec['max_fecha']
-                
-                contratos_ordenados = sorted(latest_dates.keys(), key=lambda c: latest_dates[c], reverse=True)
+                cupos_solicitados, totales_cupos_por_grano = get_cupos_solicitados(cursor)
+
+                # --- Contratos ordenados por última entrega (resumen precalculado por la sincronización) ---
+                asegurar_contract_summary(cursor)
+                cursor.execute("SELECT contrato FROM contract_summary WHERE ultima_entrega IS NOT NULL ORDER BY ultima_entrega DESC")
+                contratos_ordenados = [rec['contrato'] for rec in cursor.fetchall()]
 
                 g_contrato_filtro = None
                 info_adicional = None
@@ -624,41 +793,41 @@ def ventas():
                 if request.method == 'POST':
                     g_contrato_filtro = request.form.get('g_contrato')
                     if g_contrato_filtro:
-                        cursor.execute("SELECT * FROM acocarpo WHERE g_contrato = %s", (g_contrato_filtro,))
-                        registros_acocarpo = cursor.fetchall()
-                        
-                        if registros_acocarpo:
-                            for rec in registros_acocarpo:
-                                registro_ordenado = OrderedDict()
-                                registro_ordenado['FECHA'] = format_date(rec.get('g_fecha', ''))
-                                registro_ordenado['Nro Interno'] = rec.get('g_roman', '')
-                                registro_ordenado['CTG'] = rec.get('g_ctg', '')
-                                registro_ordenado['Kilos Netos'] = format_number(rec.get('g_saldo', 0))
-                                registro_ordenado['DESTINO'] = rec.get('g_destino', '')
-                                
-                                if rec.get('g_confirm', 'N').strip().upper() == 'S':
-                                    entregas_confirmadas.append(registro_ordenado)
-                                    total_confirmadas_num += rec.get('g_saldo', 0) or 0
-                                else:
-                                    entregas_no_confirmadas.append(registro_ordenado)
-                                    total_no_confirmadas_num += rec.get('g_saldo', 0) or 0
-
+                        # Totales del encabezado desde contract_summary
+                        asegurar_contract_summary(cursor)
+                        cursor.execute("SELECT * FROM contract_summary WHERE contrato = %s", (g_contrato_filtro,))
+                        resumen = cursor.fetchone()
+                        if resumen:
+                            total_confirmadas_num = resumen['kilos_confirmados']
+                            total_no_confirmadas_num = resumen['kilos_no_confirmados']
                             total_saldo_num = total_confirmadas_num + total_no_confirmadas_num
-                            
-                            info_adicional = {
-                                'grano': registros_acocarpo[0].get('g_codi', 'N/A'),
-                                'cosecha': registros_acocarpo[0].get('g_cose', 'N/A')
-                            }
-                            grano_code = info_adicional['grano']
-                            info_adicional['grano'] = get_grano_description(grano_code, cursor)
+                            total_peso = resumen['kilos_liquidados']
+                            if resumen['registros_confirmados'] + resumen['registros_no_confirmados'] > 0:
+                                info_adicional = {
+                                    'grano': resumen['grano'] or 'N/A',
+                                    'cosecha': resumen['cosecha'] or 'N/A'
+                                }
+                                if resumen['comprador']:
+                                    info_adicional['comprador'] = resumen['comprador']
+
+                        cursor.execute("SELECT * FROM acocarpo WHERE g_contrato = %s", (g_contrato_filtro,))
+                        for rec in cursor.fetchall():
+                            registro_ordenado = OrderedDict()
+                            registro_ordenado['FECHA'] = format_date(rec.get('g_fecha', ''))
+                            registro_ordenado['Nro Interno'] = rec.get('g_roman', '')
+                            registro_ordenado['CTG'] = rec.get('g_ctg', '')
+                            registro_ordenado['Kilos Netos'] = format_number(rec.get('g_saldo', 0))
+                            registro_ordenado['DESTINO'] = rec.get('g_destino', '')
+
+                            if rec.get('g_confirm') == 'S':
+                                entregas_confirmadas.append(registro_ordenado)
+                            else:
+                                entregas_no_confirmadas.append(registro_ordenado)
 
                         cursor.execute("SELECT * FROM liqven WHERE contrato = %s", (g_contrato_filtro,))
                         registros_liqven = cursor.fetchall()
 
                         if registros_liqven:
-                            if info_adicional:
-                                info_adicional['comprador'] = registros_liqven[0].get('nom_c', 'N/A')
-                            
                             liquidaciones_filtradas = []
                             sumas = { 'Peso': 0, 'N.Grav.': 0, 'IVA': 0, 'Otros': 0, 'Total': 0 }
 
@@ -687,7 +856,6 @@ def ventas():
                             
                             total_liquidaciones = len(registros_liqven)
                             totales_liq_formatted = {key: format_number(val, is_currency=(key != 'Peso')) for key, val in sumas.items()}
-                            total_peso = sumas['Peso']
                     
                     diferencia = total_saldo_num - total_peso
                     if diferencia < 0:
@@ -698,6 +866,7 @@ def ventas():
 
         return render_template('index.html', 
                                contratos_pendientes=contratos_pendientes,
+                               pronostico_semanas=PRONOSTICO_SEMANAS,
                                totales_por_grano=totales_por_grano,
                                pie_chart_labels=pie_chart_labels,
                                pie_chart_values=pie_chart_values,
@@ -705,7 +874,6 @@ def ventas():
                                bar_chart_pendientes=bar_chart_pendientes,
                                bar_chart_stock=bar_chart_stock,
                                cupos_solicitados=cupos_solicitados,
-                               fletes=fletes,
                                totales_cupos_por_grano=totales_cupos_por_grano,
                                contratos=contratos_ordenados,
                                entregas_confirmadas=entregas_confirmadas,
@@ -732,43 +900,208 @@ def ventas():
     except Exception as e:
         return f"<h1>Ocurrió un error al leer el archivo: {e}</h1>"
 
-@app.route('/compras', methods=['GET', 'POST'])
-def compras():
+
+@app.route('/ventas/precios')
+def precios_granos():
+    """Precio promedio ponderado por volumen de las liquidaciones, por grano y semana o mes."""
+    hoy = datetime.date.today()
+    filtros = {
+        'escala': request.args.get('escala') if request.args.get('escala') in ESCALAS_PRECIOS else 'mes',
+        'grano': request.args.get('grano') or None,
+        'cosecha': request.args.get('cosecha') or None,
+        'fecha_desde': request.args.get('fecha_desde') or (hoy - relativedelta(months=12)).strftime('%Y-%m-%d'),
+        'fecha_hasta': request.args.get('fecha_hasta') or hoy.strftime('%Y-%m-%d'),
+    }
     conn = get_db()
     if not conn:
         return "<h1>Error: No se pudo conectar a la base de datos.</h1>"
+    try:
+        with get_dict_cursor(conn) as cursor:
+            cursor.execute("SELECT to_regclass('precios_granos') IS NOT NULL")
+            if not cursor.fetchone()[0]:
+                refresh_precios_granos(cursor)
+                conn.commit()
+
+            serie = get_serie_precios(cursor, filtros['escala'], filtros['fecha_desde'], filtros['fecha_hasta'],
+                                      grano=filtros['grano'], cosecha=filtros['cosecha'])
+
+            cursor.execute("""
+                SELECT DISTINCT p.grano, COALESCE(g.g_desc, p.grano) AS descripcion
+                FROM precios_granos p LEFT JOIN acogran g ON g.g_codi = p.grano
+                WHERE p.grano <> '' ORDER BY descripcion
+            """)
+            granos = cursor.fetchall()
+            cursor.execute("SELECT DISTINCT cosecha FROM precios_granos WHERE cosecha <> '' ORDER BY cosecha DESC")
+            cosechas = [rec['cosecha'] for rec in cursor.fetchall()]
+
+        # Una línea por grano sobre el eje común de períodos
+        formato = '%d/%m/%Y' if filtros['escala'] == 'semana' else '%m/%Y'
+        periodos = sorted({fila['periodo'] for fila in serie})
+        precios_por_grano = OrderedDict()
+        for fila in serie:
+            precios_por_grano.setdefault(fila['grano_desc'], {})[fila['periodo']] = float(fila['precio_promedio'])
+        grafico = {
+            'labels': [periodo.strftime(formato) for periodo in periodos],
+            'series': [{'grano': grano, 'precios': [precios.get(periodo) for periodo in periodos]}
+                       for grano, precios in precios_por_grano.items()],
+        }
+        return render_template('precios.html', serie=serie, granos=granos, cosechas=cosechas,
+                               filtros=filtros, grafico=grafico, formato=formato)
+    finally:
+        if conn:
+            conn.close()
+
+
+# --- FACETAS (VALORES DE LOS FILTROS) ---
+# La tabla 'facetas' se recalcula al final de cada sincronización (ver
+# sync_db.refresh_facetas). Aquí se lee una sola vez y se mantiene en memoria;
+# se invalida cuando la sincronización termina y, por si el script se corrió
+# desde fuera de la aplicación, vence pasado FACETAS_TTL segundos.
+FACETAS_TTL = 600
+_facetas_cache = {'datos': None, 'cargado': 0}
+
+def invalidar_facetas():
+    _facetas_cache['datos'] = None
+
+def get_facetas():
+    """
+    Devuelve {dimension: [(valor, descripcion), ...]} en el orden de la tabla 'facetas'.
+    Si la tabla todavía no existe (base sin sincronizar desde esta versión) la calcula.
+    """
+    ahora = datetime.datetime.now().timestamp()
+    if _facetas_cache['datos'] is not None and ahora - _facetas_cache['cargado'] < FACETAS_TTL:
+        return _facetas_cache['datos']
 
+    conn = get_db()
+    if not conn:
+        return _facetas_cache['datos'] or {}
+
+    facetas = {}
     try:
         with get_dict_cursor(conn) as cursor:
-            # --- Obtener valores para los filtros ---
-            cursor.execute("SELECT DISTINCT g_codi FROM acohis WHERE g_ctl = 'I' AND g_codi IS NOT NULL")
-            grano_codes = [row['g_codi'] for row in cursor.fetchall()]
-            
-            granos = {}
-            if grano_codes:
-                cursor.execute("SELECT g_codi, g_desc FROM acogran WHERE g_codi IN %s", (tuple(grano_codes),))
-                for rec in cursor.fetchall():
-                    granos[rec['g_codi']] = rec['g_desc'].strip()
+            cursor.execute("SELECT to_regclass('facetas') IS NOT NULL AS existe")
+            if not cursor.fetchone()['existe']:
+                refresh_facetas(cursor)
+                conn.commit()
+            cursor.execute("SELECT dimension, valor, descripcion FROM facetas ORDER BY dimension, orden")
+            for rec in cursor.fetchall():
+                facetas.setdefault(rec['dimension'], []).append((rec['valor'], rec['descripcion']))
+        _facetas_cache['datos'] = facetas
+        _facetas_cache['cargado'] = ahora
+    except Exception as e:
+        print(f"Ocurrió un error al leer las facetas desde PostgreSQL: {e}")
+        return _facetas_cache['datos'] or {}
+    finally:
+        conn.close()
+    return facetas
+
+
+# --- BÚSQUEDA PARA AUTOCOMPLETADO ---
+# Los selectores de choferes, clientes, localidades y contratos no traen la
+# lista completa: static/js/busqueda.js consulta /buscar a medida que se escribe.
+_busqueda_estado = {'trgm': None}
+
+def asegurar_busqueda(cursor):
+    """Crea las tablas de búsqueda si todavía no existen y recuerda si hay pg_trgm."""
+    if _busqueda_estado['trgm'] is None:
+        cursor.execute("SELECT to_regclass('busqueda') IS NOT NULL AND to_regclass('busqueda_palabras') IS NOT NULL")
+        if not cursor.fetchone()[0]:
+            refresh_busqueda(cursor)
+            cursor.connection.commit()
+        _busqueda_estado['trgm'] = tiene_pg_trgm(cursor)
+    return _busqueda_estado['trgm']
+
+def get_etiquetas_busqueda(tipo, valores):
+    """Etiquetas de los valores ya seleccionados, para renderizar sólo esas opciones."""
+    valores = [v for v in valores if v]
+    if not valores:
+        return {}
+    conn = get_db()
+    if not conn:
+        return {}
+    try:
+        with conn.cursor() as cursor:
+            asegurar_busqueda(cursor)
+            return get_etiquetas(cursor, tipo, valores)
+    except Exception as e:
+        print(f"Error al leer etiquetas de búsqueda: {e}")
+        return {}
+    finally:
+        conn.close()
 
-            cursor.execute("SELECT DISTINCT g_cose FROM acohis WHERE g_ctl = 'I' AND g_cose IS NOT NULL ORDER BY g_cose DESC")
-            cosechas = [row['g_cose'] for row in cursor.fetchall()]
+@app.route('/buscar')
+def buscar_json():
+    """
+    Sugerencias para los selectores con autocompletado: ?tipo=chofer&q=texto.
+    Con ?valor=... (repetible) devuelve la etiqueta de esos valores.
+    """
+    tipo = request.args.get('tipo', '')
+    limite = min(max(request.args.get('limite', BUSQUEDA_LIMITE, type=int), 1), 50)
+    conn = get_db()
+    if not conn:
+        return jsonify({'success': False, 'error': 'No se pudo conectar a la base de datos.'}), 500
+    try:
+        with get_dict_cursor(conn) as cursor:
+            trgm = asegurar_busqueda(cursor)
+            valores = request.args.getlist('valor')
+            if valores:
+                etiquetas = get_etiquetas(cursor, tipo, valores)
+                resultados = [{'valor': valor, 'etiqueta': etiqueta} for valor, etiqueta in etiquetas.items()]
+            else:
+                resultados = [{'valor': rec['valor'], 'etiqueta': rec['etiqueta']}
+                              for rec in buscar(cursor, request.args.get('q'), tipo, limite, trgm=trgm)]
+        return jsonify({'success': True, 'resultados': resultados})
+    except Exception as e:
+        print(f"Error en la búsqueda: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        if conn:
+            conn.close()
 
-            cursor.execute("SELECT DISTINCT cli_c FROM acohis WHERE g_ctl = 'I' AND cli_c IS NOT NULL")
-            vendedor_codes = [row['cli_c'] for row in cursor.fetchall()]
-            
-            vendedores = {}
-            if vendedor_codes:
-                cursor.execute("SELECT cli_c, s_apelli FROM sysmae WHERE cli_c IN %s", (tuple(vendedor_codes),))
-                for rec in cursor.fetchall():
-                    vendedores[rec['cli_c']] = rec['s_apelli'].strip()
+def get_filtros_sql_compras(filtros, alias=''):
+    """
+    Traduce los filtros de Compras a condiciones SQL sobre acohis.
+    Compartido por la página de Compras y su exportación.
+    """
+    condiciones = [f"{alias}g_ctl = 'I'"]
+    params = []
+    if filtros.get('fecha_desde'):
+        condiciones.append(f"{alias}g_fecha >= %s")
+        params.append(filtros['fecha_desde'])
+    if filtros.get('fecha_hasta'):
+        condiciones.append(f"{alias}g_fecha <= %s")
+        params.append(filtros['fecha_hasta'])
+    if filtros.get('vendedor'):
+        condiciones.append(f"{alias}cli_c = %s")
+        params.append(filtros['vendedor'])
+    if filtros.get('grano'):
+        condiciones.append(f"{alias}g_codi = %s")
+        params.append(filtros['grano'])
+    if filtros.get('cosecha'):
+        condiciones.append(f"{alias}g_cose = %s")
+        params.append(filtros['cosecha'])
+    if filtros.get('origen'):
+        condiciones.append(f"{alias}g_locali = %s")
+        params.append(filtros['origen'])
+    return " AND ".join(condiciones), params
+
+@app.route('/compras', methods=['GET', 'POST'])
+def compras():
+    conn = get_db()
+    if not conn:
+        return "<h1>Error: No se pudo conectar a la base de datos.</h1>"
 
-            cursor.execute("SELECT DISTINCT g_locali FROM acohis WHERE g_ctl = 'I' AND g_locali IS NOT NULL AND g_locali != '' ORDER BY g_locali")
-            origenes = [row['g_locali'] for row in cursor.fetchall()]
+    try:
+        with get_dict_cursor(conn) as cursor:
+            # --- Obtener valores para los filtros (facetas en memoria) ---
+            facetas = get_facetas()
+            granos = dict(facetas.get('compras_grano', []))
+            cosechas = [valor for valor, _ in facetas.get('compras_cosecha', [])]
+            # Vendedor y origen se eligen con autocompletado; el mapa de vendedores sigue haciendo falta para la tabla
+            vendedores = dict(facetas.get('compras_vendedor', []))
 
             # --- Procesar filtros ---
             filtros_aplicados = {}
-            query = "SELECT * FROM acohis WHERE g_ctl = 'I'"
-            params = []
 
             if request.method == 'POST':
                 filtros_aplicados['fecha_desde'] = request.form.get('fecha_desde')
@@ -783,27 +1116,8 @@ def compras():
                 filtros_aplicados['fecha_desde'] = first_day_of_month.strftime('%Y-%m-%d')
                 filtros_aplicados['fecha_hasta'] = today.strftime('%Y-%m-%d')
 
-            if filtros_aplicados.get('fecha_desde'):
-                query += " AND g_fecha >= %s"
-                params.append(filtros_aplicados['fecha_desde'])
-            if filtros_aplicados.get('fecha_hasta'):
-                query += " AND g_fecha <= %s"
-                params.append(filtros_aplicados['fecha_hasta'])
-            if filtros_aplicados.get('vendedor'):
-                query += " AND cli_c = %s"
-                params.append(filtros_aplicados['vendedor'])
-            if filtros_aplicados.get('grano'):
-                query += " AND g_codi = %s"
-                params.append(filtros_aplicados['grano'])
-            if filtros_aplicados.get('cosecha'):
-                query += " AND g_cose = %s"
-                params.append(filtros_aplicados['cosecha'])
-            if filtros_aplicados.get('origen'):
-                query += " AND g_locali = %s"
-                params.append(filtros_aplicados['origen'])
-            
-            query += " ORDER BY g_fecha DESC"
-            cursor.execute(query, params)
+            condiciones, params = get_filtros_sql_compras(filtros_aplicados)
+            cursor.execute(f"SELECT * FROM acohis WHERE {condiciones} ORDER BY g_fecha DESC", params)
             compras_data = cursor.fetchall()
 
             # --- Procesar datos para la tabla y calcular totales ---
@@ -847,7 +1161,6 @@ def compras():
                                    vendedores=vendedores,
                                    granos=granos,
                                    cosechas=cosechas,
-                                   origenes=origenes,
                                    totales=totales)
     except Exception as e:
         import traceback
@@ -856,201 +1169,517 @@ def compras():
         if conn:
             conn.close()
 
+# --- CUPOS: OPERACIONES POR LOTE ---
+# Cada tipo de operación se aplica con una única sentencia multi-fila. Los
+# endpoints individuales usan las mismas funciones con una lista de un elemento.
+
+def insertar_cupos(cursor, pedidos):
+    """Inserta los cupos pedidos (una fila por cupo, cantidad 1) en un solo INSERT. Devuelve los ids."""
+    filas = []
+    for pedido in pedidos:
+        for _ in range(int(pedido['cantidad'])):
+            filas.append((
+                pedido['contrato'],
+                pedido['grano'],
+                pedido['cosecha'],
+                1,
+                pedido['fecha_solicitud'],
+                pedido['nombre_persona']
+            ))
+    if not filas:
+        return []
+    resultado = execute_values(cursor, """
+        INSERT INTO cupos_solicitados (contrato, grano, cosecha, cantidad, fecha_solicitud, nombre_persona)
+        VALUES %s RETURNING id
+    """, filas, page_size=len(filas), fetch=True)
+    return [row[0] for row in resultado]
+
+def asignar_viajes(cursor, asignaciones):
+    """Asigna viajes a cupos ([{cupo_id, flete_id}, ...]) con un solo UPDATE ... FROM (VALUES ...)."""
+    filas = [(int(a['cupo_id']), int(a['flete_id'])) for a in asignaciones]
+    if not filas:
+        return 0
+    execute_values(cursor, """
+        UPDATE cupos_solicitados AS c SET flete_id = v.flete_id
+        FROM (VALUES %s) AS v(cupo_id, flete_id)
+        WHERE c.id = v.cupo_id
+    """, filas, page_size=len(filas))
+    return cursor.rowcount
+
+def actualizar_codigos_cupo(cursor, codigos):
+    """Actualiza códigos de cupo ([{cupo_id, codigo_cupo}, ...]) con un solo UPDATE ... FROM (VALUES ...)."""
+    filas = [(int(c['cupo_id']), c.get('codigo_cupo') or '') for c in codigos]
+    if not filas:
+        return 0
+    execute_values(cursor, """
+        UPDATE cupos_solicitados AS c SET codigo_cupo = v.codigo_cupo
+        FROM (VALUES %s) AS v(cupo_id, codigo_cupo)
+        WHERE c.id = v.cupo_id
+    """, filas, page_size=len(filas))
+    return cursor.rowcount
+
+def eliminar_cupos(cursor, cupo_ids):
+    """Elimina los cupos indicados con un solo DELETE."""
+    ids = [int(cupo_id) for cupo_id in cupo_ids]
+    if not ids:
+        return 0
+    cursor.execute("DELETE FROM cupos_solicitados WHERE id = ANY(%s)", (ids,))
+    return cursor.rowcount
+
+def ejecutar_operaciones_cupos(solicitar=(), asignar=(), codigos=(), eliminar=()):
+    """Aplica las operaciones de cupos en una única transacción y devuelve la respuesta JSON."""
+    conn = get_db()
+    if not conn:
+        return jsonify({'success': False, 'error': 'No se pudo conectar a la base de datos.'})
+
+    try:
+        with get_dict_cursor(conn) as cursor:
+            resultado = {
+                'success': True,
+                'creados': insertar_cupos(cursor, solicitar),
+                'asignados': asignar_viajes(cursor, asignar),
+                'codigos_actualizados': actualizar_codigos_cupo(cursor, codigos),
+                'eliminados': eliminar_cupos(cursor, eliminar)
+            }
+            notificar(cursor, 'cupos_solicitados')
+        conn.commit()
+        return jsonify(resultado)
+    except Exception as e:
+        conn.rollback()
+        return jsonify({'success': False, 'error': str(e)})
+    finally:
+        if conn:
+            conn.close()
+
+@app.route('/cupos/bulk', methods=['POST'])
+def cupos_bulk():
+    """
+    Operaciones de cupos por lote. Acepta un JSON con cualquiera de las listas:
+    'solicitar' (pedidos como en /cupos/solicitar), 'asignar' ([{cupo_id, flete_id}]),
+    'codigos' ([{cupo_id, codigo_cupo}]) y 'eliminar' ([cupo_id]).
+    Todo se aplica en una transacción: si algo falla no se guarda nada.
+    """
+    try:
+        data = request.get_json(force=True) or {}
+        return ejecutar_operaciones_cupos(
+            solicitar=data.get('solicitar') or [],
+            asignar=data.get('asignar') or [],
+            codigos=data.get('codigos') or [],
+            eliminar=data.get('eliminar') or []
+        )
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+# --- CUPOS: PROPUESTA AUTOMÁTICA DE ASIGNACIÓN A FLETES ---
+CUPOS_VENTANA_DIAS = 7
+
+def emparejar_por_fecha(cupos, fletes, ventana_dias):
+    """
+    Empareja dos listas ordenadas por fecha con dos punteros: a cada cupo se le
+    asigna el primer flete libre cuya fecha cae dentro de +/- ventana_dias.
+    Los fletes que quedan antes de la ventana del cupo actual tampoco sirven
+    para los siguientes (que son posteriores), así que se descartan. O(n + m).
+    """
+    pares = []
+    ventana = datetime.timedelta(days=ventana_dias)
+    i = 0
+    for cupo in cupos:
+        while i < len(fletes) and (fletes[i]['usado'] or fletes[i]['fecha'] < cupo['fecha'] - ventana):
+            i += 1
+        if i < len(fletes) and fletes[i]['fecha'] <= cupo['fecha'] + ventana:
+            fletes[i]['usado'] = True
+            pares.append((cupo, fletes[i]))
+            i += 1
+    return pares
+
+def proponer_asignaciones_cupos(cupos, fletes, ventana_dias=CUPOS_VENTANA_DIAS):
+    """
+    Propone asignaciones cupo -> flete sin comparar todos contra todos: los
+    candidatos se agrupan en tablas hash, primero por contrato (el flete conoce
+    su contrato por el CTG de la entrega en acocarpo) y luego, para los fletes
+    sin contrato conocido, por (grano, cosecha). Dentro de cada grupo se empareja
+    por cercanía de fecha (ver emparejar_por_fecha).
+    """
+    por_contrato = defaultdict(list)
+    por_grano_cosecha = defaultdict(list)
+    for flete in sorted(fletes, key=lambda f: f['fecha']):
+        flete['usado'] = False
+        if flete['contrato']:
+            por_contrato[flete['contrato']].append(flete)
+        else:
+            por_grano_cosecha[(flete['grano'], flete['cosecha'])].append(flete)
+
+    cupos_por_contrato = defaultdict(list)
+    for cupo in sorted(cupos, key=lambda c: c['fecha']):
+        cupos_por_contrato[cupo['contrato']].append(cupo)
+
+    propuestas = []
+    pendientes = defaultdict(list)
+    for contrato, cupos_contrato in cupos_por_contrato.items():
+        pares = emparejar_por_fecha(cupos_contrato, por_contrato.get(contrato, []), ventana_dias)
+        propuestas.extend((cupo, flete, 'contrato') for cupo, flete in pares)
+        asignados = {id(cupo) for cupo, _ in pares}
+        for cupo in cupos_contrato:
+            if id(cupo) not in asignados:
+                pendientes[(cupo['grano'], cupo['cosecha'])].append(cupo)
+
+    for clave, cupos_clave in pendientes.items():
+        cupos_clave.sort(key=lambda c: c['fecha'])
+        pares = emparejar_por_fecha(cupos_clave, por_grano_cosecha.get(clave, []), ventana_dias)
+        propuestas.extend((cupo, flete, 'grano_cosecha') for cupo, flete in pares)
+
+    return [{
+        'cupo_id': cupo['id'],
+        'flete_id': flete['id'],
+        'contrato': cupo['contrato'],
+        'grano': cupo['grano'],
+        'cosecha': cupo['cosecha'],
+        'fecha_cupo': cupo['fecha'].strftime('%Y-%m-%d'),
+        'fecha_flete': flete['fecha'].strftime('%Y-%m-%d'),
+        'ctg': flete['ctg'],
+        'dias': (flete['fecha'] - cupo['fecha']).days,
+        'criterio': criterio
+    } for cupo, flete, criterio in propuestas]
+
+@app.route('/cupos/propuestas')
+def propuestas_cupos():
+    """
+    Propone asignaciones para los cupos abiertos. Las propuestas se aceptan
+    enviándolas como lista 'asignar' a /cupos/bulk.
+    """
+    ventana_dias = request.args.get('ventana', CUPOS_VENTANA_DIAS, type=int)
+    conn = get_db()
+    if not conn:
+        return jsonify({'error': 'No se pudo conectar a la base de datos.'}), 500
+    try:
+        with get_dict_cursor(conn) as cursor:
+            cursor.execute("""
+                SELECT id, TRIM(contrato) AS contrato, UPPER(TRIM(grano)) AS grano, TRIM(cosecha) AS cosecha,
+                       fecha_solicitud AS fecha
+                FROM cupos_solicitados
+                WHERE flete_id IS NULL AND fecha_solicitud IS NOT NULL
+            """)
+            cupos = [dict(rec) for rec in cursor.fetchall()]
+            if not cupos:
+                return jsonify({'propuestas': [], 'cupos_abiertos': 0, 'fletes_libres': 0})
+
+            desde = min(c['fecha'] for c in cupos) - datetime.timedelta(days=ventana_dias)
+            hasta = max(c['fecha'] for c in cupos) + datetime.timedelta(days=ventana_dias)
+            cursor.execute("""
+                SELECT f.id, f.g_ctg AS ctg, f.g_fecha AS fecha, f.g_cose AS cosecha,
+                       UPPER(g.g_desc) AS grano, e.g_contrato AS contrato
+                FROM fletes f
+                LEFT JOIN acogran g ON g.g_codi = f.g_codi
+                LEFT JOIN LATERAL (
+                    SELECT a.g_contrato FROM acocarpo a WHERE a.g_ctg = f.g_ctg LIMIT 1
+                ) e ON TRUE
+                WHERE f.g_fecha BETWEEN %s AND %s
+                  AND NOT EXISTS (SELECT 1 FROM cupos_solicitados c WHERE c.flete_id = f.id)
+            """, (desde, hasta))
+            fletes_libres = [dict(rec) for rec in cursor.fetchall()]
+
+        propuestas = proponer_asignaciones_cupos(cupos, fletes_libres, ventana_dias)
+        return jsonify({'propuestas': propuestas, 'cupos_abiertos': len(cupos), 'fletes_libres': len(fletes_libres)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        if conn:
+            conn.close()
+
 @app.route('/cupos/solicitar', methods=['POST'])
 def solicitar_cupo():
     try:
-        data = request.json
-        num_cupos = int(data['cantidad'])
-        cantidad_por_cupo = 1  
-
-        conn = get_db()
-        if not conn:
-            return jsonify({'success': False, 'error': 'No se pudo conectar a la base de datos.'})
-        
-        try:
-            with get_dict_cursor(conn) as cursor:
-                for _ in range(num_cupos):
-                    cursor.execute("""
-                        INSERT INTO cupos_solicitados (contrato, grano, cosecha, cantidad, fecha_solicitud, nombre_persona)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                    """, (
-                        data['contrato'],
-                        data['grano'],
-                        data['cosecha'],
-                        cantidad_por_cupo,
-                        data['fecha_solicitud'],
-                        data['nombre_persona']
-                    ))
-            conn.commit()
-            return jsonify({'success': True})
-        except Exception as e:
-            conn.rollback()
-            return jsonify({'success': False, 'error': str(e)})
-        finally:
-            if conn:
-                conn.close()
+        return ejecutar_operaciones_cupos(solicitar=[request.json])
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/cupos/assign_trip', methods=['POST'])
 def assign_trip():
     try:
-        data = request.json
-        conn = get_db()
-        if not conn:
-            return jsonify({'success': False, 'error': 'No se pudo conectar a la base de datos.'})
-        
-        try:
-            with get_dict_cursor(conn) as cursor:
-                cursor.execute("UPDATE cupos_solicitados SET flete_id = %s WHERE id = %s", (data['flete_id'], data['cupo_id']))
-            conn.commit()
-            return jsonify({'success': True})
-        except Exception as e:
-            conn.rollback()
-            return jsonify({'success': False, 'error': str(e)})
-        finally:
-            if conn:
-                conn.close()
+        return ejecutar_operaciones_cupos(asignar=[request.json])
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/cupos/update_codigo', methods=['POST'])
 def update_codigo():
     try:
-        data = request.json
-        conn = get_db()
-        if not conn:
-            return jsonify({'success': False, 'error': 'No se pudo conectar a la base de datos.'})
-        
-        try:
-            with get_dict_cursor(conn) as cursor:
-                cursor.execute("UPDATE cupos_solicitados SET codigo_cupo = %s WHERE id = %s", (data['codigo_cupo'], data['cupo_id']))
-            conn.commit()
-            return jsonify({'success': True})
-        except Exception as e:
-            conn.rollback()
-            return jsonify({'success': False, 'error': str(e)})
-        finally:
-            if conn:
-                conn.close()
+        return ejecutar_operaciones_cupos(codigos=[request.json])
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/cupos/delete/<int:cupo_id>', methods=['POST'])
 def delete_cupo(cupo_id):
     try:
-        conn = get_db()
-        if not conn:
-            return jsonify({'success': False, 'error': 'No se pudo conectar a la base de datos.'})
-        
-        try:
-            with get_dict_cursor(conn) as cursor:
-                cursor.execute("DELETE FROM cupos_solicitados WHERE id = %s", (cupo_id,))
-            conn.commit()
-            return jsonify({'success': True})
-        except Exception as e:
-            conn.rollback()
-            return jsonify({'success': False, 'error': str(e)})
-        finally:
-            if conn:
-                conn.close()
+        return ejecutar_operaciones_cupos(eliminar=[cupo_id])
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 def get_filtro_values():
-    granos = {}
-    cosechas = set()
-    compradores = set()
+    """
+    Granos y cosechas para los filtros de Entregas, tomados de las facetas.
+    El comprador se elige con autocompletado (/buscar).
+    """
+    facetas = get_facetas()
+    granos = [(valor, descripcion) for valor, descripcion in facetas.get('grano', [])]
+    cosechas = [valor for valor, _ in facetas.get('entregas_cosecha', [])]
+    return granos, cosechas
+
+def get_filtros_sql_entregas(filtros):
+    """
+    Traduce los filtros de la consulta de Entregas a condiciones SQL sobre
+    acocarpo (alias 'a') unida a contrat (alias 'c').
+    """
+    condiciones = ["1=1"]
+    params = []
+    if filtros.get('fecha_desde'):
+        condiciones.append("a.g_fecha >= %s")
+        params.append(datetime.datetime.strptime(filtros['fecha_desde'], '%Y-%m-%d').date())
+    if filtros.get('fecha_hasta'):
+        condiciones.append("a.g_fecha <= %s")
+        params.append(datetime.datetime.strptime(filtros['fecha_hasta'], '%Y-%m-%d').date())
+    if filtros.get('grano'):
+        condiciones.append("a.g_codi = %s")
+        params.append(filtros['grano'])
+    if filtros.get('cosecha'):
+        condiciones.append("a.g_cose = %s")
+        params.append(filtros['cosecha'])
+    if filtros.get('comprador'):
+        condiciones.append("c.apelcom_c = %s")
+        params.append(filtros['comprador'])
+    return " AND ".join(condiciones), params
+
+def get_entregas(filtros):
+    """
+    Consulta de entregas (acocarpo) con comprador y grano resueltos en el servidor.
+    Todos los filtros, incluido el comprador, se aplican en el WHERE y el total de
+    kilos netos se calcula en la misma consulta.
+    """
+    entregas = []
+    total_kilos_netos = 0
     
     conn = get_db()
     if not conn:
-        return sorted(granos.items()), sorted(list(cosechas), reverse=True), sorted(list(compradores))
+        return entregas, total_kilos_netos
 
     try:
         with get_dict_cursor(conn) as cursor:
-            cursor.execute("SELECT g_codi, g_desc FROM acogran")
-            for rec in cursor.fetchall():
-                if rec.get('g_codi') and rec.get('g_desc'):
-                    granos[rec['g_codi']] = rec['g_desc'].strip()
+            query = """
+                SELECT
+                    a.g_fecha,
+                    a.g_contrato AS contrato,
+                    COALESCE(c.apelcom_c, '') AS comprador,
+                    COALESCE(g.g_desc, a.g_codi) AS grano,
+                    a.g_cose,
+                    COALESCE(a.g_saldo, 0) AS kilos_netos,
+                    a.g_ctg,
+                    a.g_destino,
+                    SUM(COALESCE(a.g_saldo, 0)) OVER () AS total_kilos_netos
+                FROM acocarpo a
+                LEFT JOIN contrat c ON c.nrocont_c = a.g_contrato
+                LEFT JOIN acogran g ON g.g_codi = a.g_codi
+            """
+            condiciones, params = get_filtros_sql_entregas(filtros)
+            query += f" WHERE {condiciones} ORDER BY a.g_fecha, a.g_ctg"
+            cursor.execute(query, params)
 
-            cursor.execute("SELECT DISTINCT g_cose FROM acocarpo WHERE g_cose IS NOT NULL")
-            for rec in cursor.fetchall():
-                cosechas.add(rec['g_cose'].strip())
-            
-            cursor.execute("SELECT DISTINCT apelcom_c FROM contrat WHERE apelcom_c IS NOT NULL")
             for rec in cursor.fetchall():
-                compradores.add(rec['apelcom_c'].strip())
+                total_kilos_netos = rec['total_kilos_netos']
+                entregas.append({
+                    'fecha': format_date(rec['g_fecha']),
+                    'contrato': rec['contrato'],
+                    'comprador': rec['comprador'],
+                    'grano': rec['grano'],
+                    'cosecha': rec['g_cose'],
+                    'kilos_netos': format_number(rec['kilos_netos']),
+                    'ctg': rec['g_ctg'] or '',
+                    'destino': rec['g_destino'] or ''
+                })
 
     except Exception as e:
-        print(f"Ocurrió un error al leer los valores de filtro desde PostgreSQL: {e}")
+        print(f"Ocurrió un error al leer las entregas desde PostgreSQL: {e}")
     finally:
         if conn:
             conn.close()
-        
-    return sorted(granos.items()), sorted(list(cosechas), reverse=True), sorted(list(compradores))
 
-def get_entregas(filtros):
-    entregas = []
-    total_kilos_netos = 0
-    
-    conn = get_db()
-    if not conn:
-        return entregas, total_kilos_netos
+    return entregas, total_kilos_netos
 
-    try:
-        with get_dict_cursor(conn) as cursor:
-            compradores_map = {}
-            cursor.execute("SELECT nrocont_c, apelcom_c FROM contrat")
-            for rec in cursor.fetchall():
-                compradores_map[rec['nrocont_c'].strip()] = rec['apelcom_c'].strip()
+def sql_comprobante(columna_punto_venta, columna_numero):
+    """
+    Expresión SQL equivalente a f"{fa1}-{str(fac).zfill(8)}", el formato de
+    comprobante (COE) que se muestra en toda la aplicación.
+    """
+    numero = f"COALESCE({columna_numero}, '')"
+    return (f"COALESCE({columna_punto_venta}, '') || '-' || "
+            f"CASE WHEN LENGTH({numero}) >= 8 THEN {numero} ELSE LPAD({numero}, 8, '0') END")
 
-            query = "SELECT * FROM acocarpo WHERE 1=1"
-            params = []
+def sql_granos_por_comprobante():
+    """
+    Subconsulta (comprobante, product_c) con el grano del contrato de cada
+    liquidación, una fila por comprobante. Se arma en una sola pasada por
+    liqven para unirla por hash con ccbcta; si un comprobante aparece en varias
+    liquidaciones se toma siempre la misma (primero las de contrato conocido).
+    """
+    return f"""
+        SELECT DISTINCT ON (l.comprobante) l.comprobante, ct.product_c
+        FROM (SELECT {sql_comprobante('fa1_c', 'fac_c')} AS comprobante, contrato FROM liqven) l
+        LEFT JOIN contrat ct ON ct.nrocont_c = l.contrato
+        ORDER BY l.comprobante, ct.product_c IS NULL, l.contrato
+    """
 
-            if filtros.get('fecha_desde'):
-                query += " AND g_fecha >= %s"
-                params.append(datetime.datetime.strptime(filtros['fecha_desde'], '%Y-%m-%d').date())
-            if filtros.get('fecha_hasta'):
-                query += " AND g_fecha <= %s"
-                params.append(datetime.datetime.strptime(filtros['fecha_hasta'], '%Y-%m-%d').date())
-            if filtros.get('grano'):
-                query += " AND g_codi = %s"
-                params.append(filtros['grano'])
-            if filtros.get('cosecha'):
-                query += " AND g_cose = %s"
-                params.append(filtros['cosecha'])
-            
-            cursor.execute(query, params)
+# Orden del libro. No hay una clave sincronizada por fila (y el ctid cambia con
+# cada sincronización completa, UPDATE o VACUUM): el desempate es el contenido
+# de la fila y, entre filas idénticas en todo, su número de repetición, que es
+# estable porque esas filas son intercambiables.
+ORDEN_CUENTA_GRANARIA = ('contrato', 'fecha', 'orden', 'comprobante', 'entregas', 'liquidaciones', 'repeticion')
 
-            for rec in cursor.fetchall():
-                contrato = rec.get('g_contrato', '').strip()
-                nombre_comprador = compradores_map.get(contrato, '')
-                if filtros.get('comprador') and nombre_comprador != filtros['comprador']:
-                    continue
-                
-                kilos_netos = rec.get('g_saldo', 0)
-                total_kilos_netos += kilos_netos
+def get_cuenta_corriente_granaria(cursor, contratos, desde=None, limite=None):
+    """
+    Devuelve el libro de la cuenta corriente granaria de uno o varios contratos
+    en una sola consulta: une entregas (acocarpo) y liquidaciones (liqven) y
+    calcula el saldo acumulado con una función de ventana por contrato.
+
+    La paginación es por clave (keyset): 'desde' es el cursor devuelto por la
+    página anterior (ver encode_cursor_granaria) con la posición del último
+    movimiento mostrado. El saldo se acumula siempre en el servidor desde el
+    primer movimiento del contrato, así que el cursor no lleva importes.
+    Devuelve (movimientos, siguiente_cursor); el cursor es None en la última página.
+    """
+    columnas_orden = ', '.join(ORDEN_CUENTA_GRANARIA)
+    params = {'contratos': list(contratos)}
+    filtro_desde = ""
+    if desde:
+        params.update({f'cursor_{columna}': desde[columna] for columna in ORDEN_CUENTA_GRANARIA})
+        filtro_desde = f"""
+            WHERE ({columnas_orden})
+                > ({', '.join(f'%(cursor_{columna})s' for columna in ORDEN_CUENTA_GRANARIA)})
+        """
+
+    query = f"""
+        WITH movimientos AS (
+            SELECT g_contrato AS contrato, g_fecha AS fecha, 0 AS orden,
+                   COALESCE(g_ctg, '') AS comprobante,
+                   COALESCE(g_saldo, 0) AS entregas, 0 AS liquidaciones
+            FROM acocarpo
+            WHERE g_contrato = ANY(%(contratos)s) AND g_fecha IS NOT NULL
+            UNION ALL
+            SELECT contrato, fec_c, 1,
+                   {sql_comprobante('fa1_c', 'fac_c')},
+                   0, COALESCE(peso, 0)
+            FROM liqven
+            WHERE contrato = ANY(%(contratos)s) AND fec_c IS NOT NULL
+        ),
+        numerados AS (
+            SELECT *, ROW_NUMBER() OVER (PARTITION BY contrato, fecha, orden, comprobante, entregas, liquidaciones) AS repeticion
+            FROM movimientos
+        ),
+        libro AS (
+            SELECT *, SUM(entregas - liquidaciones) OVER (
+                       PARTITION BY contrato ORDER BY {columnas_orden}
+                       ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+                   ) AS saldo
+            FROM numerados
+        )
+        SELECT * FROM libro
+        {filtro_desde}
+        ORDER BY {columnas_orden}
+    """
+    if limite:
+        query += " LIMIT %(limite)s"
+        params['limite'] = limite + 1
+
+    cursor.execute(query, params)
+    registros = cursor.fetchall()
+
+    siguiente = None
+    if limite and len(registros) > limite:
+        registros = registros[:limite]
+        siguiente = {columna: registros[-1][columna] for columna in ORDEN_CUENTA_GRANARIA}
+
+    movimientos = []
+    for rec in registros:
+        tipo = 'Entrega - CTG' if rec['orden'] == 0 else 'Liquidación - COE'
+        movimientos.append({
+            'contrato': rec['contrato'],
+            'fecha': rec['fecha'],
+            'comprobante': rec['comprobante'],
+            'descripcion': f"{tipo}: {rec['comprobante']}",
+            'entregas': rec['entregas'],
+            'liquidaciones': rec['liquidaciones'],
+            'saldo': rec['saldo']
+        })
+    return movimientos, siguiente
+
+def encode_cursor_granaria(cursor_granaria):
+    """Serializa el cursor de paginación de la cuenta corriente granaria para la URL/formulario."""
+    if not cursor_granaria:
+        return ''
+    data = dict(cursor_granaria)
+    data['fecha'] = data['fecha'].strftime('%Y-%m-%d')
+    data['entregas'] = str(data['entregas'])
+    data['liquidaciones'] = str(data['liquidaciones'])
+    return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).decode('ascii')
+
+def decode_cursor_granaria(valor):
+    """Inverso de encode_cursor_granaria. Devuelve None si el valor está vacío o es inválido."""
+    if not valor:
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(valor.encode('ascii')).decode('utf-8'))
+        return {
+            'contrato': str(data['contrato']),
+            'fecha': datetime.datetime.strptime(data['fecha'], '%Y-%m-%d').date(),
+            'orden': int(data['orden']),
+            'comprobante': str(data['comprobante']),
+            'entregas': Decimal(data['entregas']),
+            'liquidaciones': Decimal(data['liquidaciones']),
+            'repeticion': int(data['repeticion'])
+        }
+    except (ValueError, KeyError, TypeError, ArithmeticError):
+        return None
 
-                entrega = {
-                    'fecha': format_date(rec.get('g_fecha')),
-                    'contrato': contrato,
-                    'comprador': nombre_comprador,
-                    'grano': get_grano_description(rec.get('g_codi'), cursor),
-                    'cosecha': rec.get('g_cose'),
-                    'kilos_netos': format_number(kilos_netos),
-                    'ctg': rec.get('g_ctg', ''),
-                    'destino': rec.get('g_destino', '')
-                }
-                entregas.append(entrega)
+CUENTA_CORRIENTE_PAGINA = 500
+# Máximo de movimientos por página que se acepta en el endpoint JSON
+CUENTA_CORRIENTE_LIMITE_MAXIMO = 5000
+
+@app.route('/consultas/cuenta_corriente_granaria')
+def cuenta_corriente_granaria_json():
+    """
+    Libro de la cuenta corriente granaria en JSON. Acepta uno o varios
+    parámetros 'contrato' (modo multi-contrato), 'limite' (hasta
+    CUENTA_CORRIENTE_LIMITE_MAXIMO) y 'desde' (cursor).
+    """
+    contratos = [c for c in request.args.getlist('contrato') if c]
+    if not contratos:
+        return jsonify({'error': 'No se especificó un contrato.'}), 400
+    limite = request.args.get('limite', type=int)
+    limite = min(limite, CUENTA_CORRIENTE_LIMITE_MAXIMO) if limite and limite > 0 else CUENTA_CORRIENTE_LIMITE_MAXIMO
+    desde = decode_cursor_granaria(request.args.get('desde'))
 
+    conn = get_db()
+    if not conn:
+        return jsonify({'error': 'No se pudo conectar a la base de datos.'}), 500
+
+    try:
+        with get_dict_cursor(conn) as cursor:
+            movimientos, siguiente = get_cuenta_corriente_granaria(cursor, contratos, desde=desde, limite=limite)
+
+        libros = OrderedDict((contrato, []) for contrato in contratos)
+        for mov in movimientos:
+            libros.setdefault(mov['contrato'], []).append({
+                'fecha': mov['fecha'].strftime('%Y-%m-%d'),
+                'comprobante': mov['comprobante'],
+                'descripcion': mov['descripcion'],
+                'entregas': float(mov['entregas']),
+                'liquidaciones': float(mov['liquidaciones']),
+                'saldo': float(mov['saldo'])
+            })
+        return jsonify({'contratos': libros, 'siguiente': encode_cursor_granaria(siguiente) or None})
     except Exception as e:
-        print(f"Ocurrió un error al leer las entregas desde PostgreSQL: {e}")
+        return jsonify({'error': str(e)}), 500
     finally:
         if conn:
             conn.close()
 
-    return entregas, total_kilos_netos
-
 @app.route('/consultas', methods=['GET', 'POST'])
 def consultas():
     # --- Lógica para consulta SISA ---
@@ -1066,28 +1695,12 @@ def consultas():
     # --- Lógica para Cuenta Corriente Granaria ---
     cuenta_corriente_data = None
     g_contrato_filtro_granaria = None
+    cursor_siguiente_granaria = ''
 
 
     # --- Obtener valores para los filtros ---
-    granos, cosechas, compradores = get_filtro_values()
-    
-    # --- Obtener todos los contratos para el dropdown de Cta Cte Granaria de las últimas 3 cosechas ---
-    contratos_granaria = []
-    conn = get_db()
-    if conn:
-        try:
-            with get_dict_cursor(conn) as cursor:
-                cursor.execute("SELECT DISTINCT g_cose FROM acocarpo WHERE g_cose IS NOT NULL ORDER BY g_cose DESC")
-                cosechas_unicas = [rec['g_cose'] for rec in cursor.fetchall()]
-                ultimas_tres_cosechas = cosechas_unicas[:3]
-
-                if ultimas_tres_cosechas:
-                    cursor.execute("SELECT DISTINCT g_contrato FROM acocarpo WHERE g_contrato IS NOT NULL AND g_cose IN %s ORDER BY g_contrato DESC", (tuple(ultimas_tres_cosechas),))
-                    contratos_granaria = [rec['g_contrato'] for rec in cursor.fetchall()]
-        except Exception as e:
-            print(f"Error al leer contratos para Cta Cte Granaria desde PostgreSQL: {e}")
-        finally:
-            conn.close()
+    # El comprador y el contrato de la Cta Cte Granaria se eligen con autocompletado (/buscar)
+    granos, cosechas = get_filtro_values()
 
 
     if request.method == 'POST':
@@ -1198,57 +1811,30 @@ def consultas():
         elif 'consultar_granaria' in request.form:
             g_contrato_filtro_granaria = request.form.get('g_contrato_granaria')
             if g_contrato_filtro_granaria:
-                movimientos = []
+                desde_granaria = decode_cursor_granaria(request.form.get('desde_granaria'))
                 conn = get_db()
                 if conn:
                     try:
                         with get_dict_cursor(conn) as cursor:
-                            # Obtener Entregas
-                            cursor.execute("SELECT g_fecha, g_ctg, g_saldo FROM acocarpo WHERE g_contrato = %s", (g_contrato_filtro_granaria,))
-                            for rec in cursor.fetchall():
-                                if isinstance(rec.get('g_fecha'), datetime.date):
-                                    movimientos.append({
-                                        'fecha': rec['g_fecha'],
-                                        'comprobante': rec.get('g_ctg', ''),
-                                        'descripcion': f"Entrega - CTG: {rec.get('g_ctg', '')}",
-                                        'entregas': rec.get('g_saldo', 0) or 0,
-                                        'liquidaciones': 0
-                                    })
-                            
-                            # Obtener Liquidaciones
-                            cursor.execute("SELECT fec_c, fac_c, fa1_c, peso FROM liqven WHERE contrato = %s", (g_contrato_filtro_granaria,))
-                            for rec in cursor.fetchall():
-                                if isinstance(rec.get('fec_c'), datetime.date):
-                                    fac_c_padded = str(rec.get('fac_c', '')).zfill(8)
-                                    coe_val = f"{rec.get('fa1_c', '')}-{fac_c_padded}"
-                                    movimientos.append({
-                                        'fecha': rec['fec_c'],
-                                        'comprobante': coe_val,
-                                        'descripcion': f"Liquidación - COE: {coe_val}",
-                                        'entregas': 0,
-                                        'liquidaciones': rec.get('peso', 0) or 0
-                                    })
+                            movimientos, siguiente = get_cuenta_corriente_granaria(
+                                cursor, [g_contrato_filtro_granaria],
+                                desde=desde_granaria, limite=CUENTA_CORRIENTE_PAGINA
+                            )
+                        cursor_siguiente_granaria = encode_cursor_granaria(siguiente)
+                        cuenta_corriente_data = []
+                        for mov in movimientos:
+                            cuenta_corriente_data.append({
+                                'fecha': format_date(mov['fecha']),
+                                'comprobante': mov['comprobante'],
+                                'descripcion': mov['descripcion'],
+                                'entregas': format_number(mov['entregas']),
+                                'liquidaciones': format_number(mov['liquidaciones']),
+                                'saldo': format_number(mov['saldo'])
+                            })
                     except Exception as e:
                         print(f"Error al leer Cta Cte Granaria desde PostgreSQL: {e}")
                     finally:
                         conn.close()
-                
-                # Ordenar movimientos por fecha
-                movimientos.sort(key=lambda x: x['fecha'])
-                
-                # Calcular saldo
-                saldo = 0
-                cuenta_corriente_data = []
-                for mov in movimientos:
-                    saldo += mov['entregas'] - mov['liquidaciones']
-                    cuenta_corriente_data.append({
-                        'fecha': format_date(mov['fecha']),
-                        'comprobante': mov['comprobante'],
-                        'descripcion': mov['descripcion'],
-                        'entregas': format_number(mov['entregas']),
-                        'liquidaciones': format_number(mov['liquidaciones']),
-                        'saldo': format_number(saldo)
-                    })
 
 
     return render_template('consultas.html', 
@@ -1257,13 +1843,12 @@ def consultas():
                            error=error_sisa,
                            granos=granos,
                            cosechas=cosechas,
-                           compradores=compradores,
                            entregas=entregas,
                            total_kilos_netos=format_number(total_kilos_netos),
                            filtros_aplicados=filtros_aplicados,
-                           contratos_granaria=contratos_granaria,
                            g_contrato_filtro_granaria=g_contrato_filtro_granaria,
-                           cuenta_corriente_data=cuenta_corriente_data)
+                           cuenta_corriente_data=cuenta_corriente_data,
+                           cursor_siguiente_granaria=cursor_siguiente_granaria)
 
 @app.route('/cobranzas', methods=['GET', 'POST'])
 def cobranzas():
@@ -1291,78 +1876,43 @@ def cobranzas():
 
     try:
         with get_dict_cursor(conn) as cursor:
-            # 1. Mapear Contrato -> Grano desde contrat
-            contrato_to_grano = {}
-            cursor.execute("SELECT nrocont_c, product_c FROM contrat")
+            # Cliente y grano (del contrato de la liquidación del comprobante) se resuelven en SQL:
+            # el cliente por el índice de sysmae y el grano con una sola unión contra liqven.
+            cursor.execute(f"""
+                WITH liq AS ({sql_granos_por_comprobante()})
+                SELECT c.vto_f, c.tip_f, COALESCE(c.imp_f, 0) AS imp_f, c.cta_p,
+                       {sql_comprobante('c.fa1_f', 'c.fac_f')} AS comprobante,
+                       COALESCE(s.s_apelli, c.cli_f, '') AS cliente,
+                       COALESCE(liq.product_c, 'N/A') AS grano
+                FROM ccbcta c
+                LEFT JOIN sysmae s ON s.cli_c = c.cli_f
+                LEFT JOIN liq ON c.tip_f IN ('LF', 'LP') AND liq.comprobante = {sql_comprobante('c.fa1_f', 'c.fac_f')}
+                WHERE c.vto_f >= %s AND c.vto_f <= %s
+                ORDER BY c.fa1_f, c.fac_f, c.vto_f
+            """, (fecha_desde_dt, fecha_hasta_dt))
             for rec in cursor.fetchall():
-                contrato = rec.get('nrocont_c', '').strip()
-                grano = rec.get('product_c', 'N/A').strip()
-                if contrato:
-                    contrato_to_grano[contrato] = grano
-
-            # 2. Mapear Comprobante de Vencimiento -> Contrato
-            comprobante_to_contrato = {}
-            cursor.execute("SELECT contrato, fa1_c, fac_c FROM liqven")
-            for rec in cursor.fetchall():
-                contrato = rec.get('contrato', '').strip()
-                if contrato:
-                    comprobante = f"{rec.get('fa1_c', '')}-{str(rec.get('fac_c', '')).zfill(8)}"
-                    comprobante_to_contrato[comprobante] = contrato
-
-            clientes_map = {}
-            cursor.execute("SELECT cli_c, s_apelli FROM sysmae")
-            for rec in cursor.fetchall():
-                if rec.get('cli_c') and rec.get('s_apelli'):
-                    clientes_map[rec['cli_c'].strip()] = rec['s_apelli'].strip()
-
-            # Build a map from vencimiento comprobante to grano
-            vencimiento_comprobante_to_grano = {}
-            cursor.execute("SELECT tip_f, fa1_f, fac_f FROM ccbcta")
-            for rec in cursor.fetchall():
-                tip_f = rec.get('tip_f', '').strip().upper()
-                if tip_f in ('LF', 'LP'):
-                    comprobante = f"{rec.get('fa1_f', '')}-{str(rec.get('fac_f', '')).zfill(8)}"
-                    contrato = comprobante_to_contrato.get(comprobante)
-                    if contrato:
-                        grano = contrato_to_grano.get(contrato, 'N/A')
-                        if grano != 'N/A':
-                            vencimiento_comprobante_to_grano[comprobante] = grano
-
-            cursor.execute("SELECT * FROM ccbcta WHERE vto_f >= %s AND vto_f <= %s ORDER BY fa1_f, fac_f, vto_f", (fecha_desde_dt, fecha_hasta_dt))
-            for rec in cursor.fetchall():
-                tip_f = rec.get('tip_f', '').strip().upper()
-                imp_f = rec.get('imp_f', 0) or 0
-                cliente_code = rec.get('cli_f', '').strip()
-                comprobante = f"{rec.get('fa1_f', '')}-{str(rec.get('fac_f', '')).zfill(8)}"
+                tip_f = rec['tip_f'] or ''
+                imp_f = rec['imp_f']
 
                 if tip_f in ('LF', 'LP', 'FA'):
-                    if tip_f == 'FA':
-                        grano = 'FACTURA'
-                    else:
-                        contrato = comprobante_to_contrato.get(comprobante)
-                        grano = 'N/A'
-                        if contrato:
-                            grano = contrato_to_grano.get(contrato, 'N/A')
-                    
                     item = {
-                        'vencimiento': format_date(rec.get('vto_f')),
-                        'cliente': clientes_map.get(cliente_code, cliente_code),
+                        'vencimiento': format_date(rec['vto_f']),
+                        'cliente': rec['cliente'],
                         'tipo': tip_f,
-                        'comprobante': comprobante,
+                        'comprobante': rec['comprobante'],
                         'importe': imp_f,
-                        'grano': grano
+                        'grano': 'FACTURA' if tip_f == 'FA' else rec['grano']
                     }
                     vencimientos_list.append(item)
                     total_vencimientos += imp_f
                 elif tip_f in ('RI', 'SI', 'SG', 'SB'):
-                    cta_p_comprobante = rec.get('cta_p', '').strip()
                     item = {
-                        'vencimiento': format_date(rec.get('vto_f')),
-                        'cliente': clientes_map.get(cliente_code, cliente_code),
+                        'vencimiento': format_date(rec['vto_f']),
+                        'cliente': rec['cliente'],
                         'tipo': tip_f,
-                        'comprobante': comprobante,
+                        'comprobante': rec['comprobante'],
                         'importe': imp_f,
-                        'cta_p': cta_p_comprobante
+                        'cta_p': rec['cta_p'] or ''
                     }
                     cobranzas_list.append(item)
                     total_cobranzas += imp_f
@@ -1389,6 +1939,96 @@ def cobranzas():
                            total_cobranzas=total_cobranzas,
                            title="Cobranzas")
 
+ANTIGUEDAD_TRAMOS = ['a_vencer', 'dias_0_30', 'dias_31_60', 'dias_61_90', 'dias_90_mas']
+
+def get_antiguedad_saldos(cursor, fecha_corte):
+    """
+    Calcula la antigüedad de la deuda por cliente a una fecha de corte.
+    Lee la tabla 'ccbcta_abierta' (sólo comprobantes impagos, recalculada en cada
+    sincronización), por lo que no recorre el historial completo de ccbcta.
+    """
+    limite_30 = fecha_corte - datetime.timedelta(days=30)
+    limite_60 = fecha_corte - datetime.timedelta(days=60)
+    limite_90 = fecha_corte - datetime.timedelta(days=90)
+
+    cursor.execute("""
+        SELECT
+            a.cli_f,
+            COALESCE(MAX(s.s_apelli), a.cli_f) AS cliente,
+            SUM(CASE WHEN a.vto_f > %(corte)s THEN a.saldo_abierto ELSE 0 END) AS a_vencer,
+            SUM(CASE WHEN a.vto_f <= %(corte)s AND a.vto_f >= %(l30)s THEN a.saldo_abierto ELSE 0 END) AS dias_0_30,
+            SUM(CASE WHEN a.vto_f < %(l30)s AND a.vto_f >= %(l60)s THEN a.saldo_abierto ELSE 0 END) AS dias_31_60,
+            SUM(CASE WHEN a.vto_f < %(l60)s AND a.vto_f >= %(l90)s THEN a.saldo_abierto ELSE 0 END) AS dias_61_90,
+            SUM(CASE WHEN a.vto_f < %(l90)s THEN a.saldo_abierto ELSE 0 END) AS dias_90_mas,
+            SUM(a.saldo_abierto) AS total
+        FROM ccbcta_abierta a
+        LEFT JOIN sysmae s ON s.cli_c = a.cli_f
+        GROUP BY a.cli_f
+        ORDER BY total DESC
+    """, {'corte': fecha_corte, 'l30': limite_30, 'l60': limite_60, 'l90': limite_90})
+
+    clientes = []
+    totales = {tramo: 0 for tramo in ANTIGUEDAD_TRAMOS + ['total']}
+    for rec in cursor.fetchall():
+        item = {'codigo': rec['cli_f'], 'cliente': rec['cliente']}
+        for tramo in ANTIGUEDAD_TRAMOS + ['total']:
+            item[tramo] = float(rec[tramo] or 0)
+            totales[tramo] += item[tramo]
+        clientes.append(item)
+    return clientes, totales
+
+def get_fecha_corte(valor):
+    """Interpreta la fecha de corte recibida (YYYY-MM-DD); por defecto, hoy."""
+    if valor:
+        try:
+            return datetime.datetime.strptime(valor, '%Y-%m-%d').date()
+        except ValueError:
+            pass
+    return datetime.date.today()
+
+@app.route('/cobranzas/antiguedad', methods=['GET', 'POST'])
+def antiguedad_saldos():
+    fecha_corte = get_fecha_corte(request.values.get('fecha_corte'))
+    clientes = []
+    totales = {}
+
+    conn = get_db()
+    if not conn:
+        return "<h1>Error: No se pudo conectar a la base de datos.</h1>"
+
+    try:
+        with get_dict_cursor(conn) as cursor:
+            clientes, totales = get_antiguedad_saldos(cursor, fecha_corte)
+    except Exception as e:
+        print(f"Error al leer la antigüedad de saldos desde PostgreSQL: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+    return render_template('antiguedad.html',
+                           fecha_corte=fecha_corte.strftime('%Y-%m-%d'),
+                           clientes=clientes,
+                           totales=totales,
+                           title="Antigüedad de Saldos")
+
+@app.route('/cobranzas/antiguedad/json')
+def antiguedad_saldos_json():
+    fecha_corte = get_fecha_corte(request.args.get('fecha_corte'))
+
+    conn = get_db()
+    if not conn:
+        return jsonify({'error': 'No se pudo conectar a la base de datos.'}), 500
+
+    try:
+        with get_dict_cursor(conn) as cursor:
+            clientes, totales = get_antiguedad_saldos(cursor, fecha_corte)
+        return jsonify({'fecha_corte': fecha_corte.strftime('%Y-%m-%d'), 'clientes': clientes, 'totales': totales})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        if conn:
+            conn.close()
+
 def importar_fletes_desde_acohis():
     try:
         conn = get_db()
@@ -1473,6 +2113,10 @@ def importar_fletes_desde_acohis():
                         'dbf'
                     ))
                     added_count += 1
+
+                if added_count or updated_count:
+                    refresh_eficiencia_combustible(cursor)
+                    notificar(cursor, 'fletes')
             conn.commit()
             return f"Importación completada. {added_count} registros agregados, {updated_count} actualizados, {skipped_count} omitidos."
         except Exception as e:
@@ -1501,7 +2145,10 @@ def update_km():
         
         try:
             with get_dict_cursor(conn) as cursor:
-                cursor.execute("UPDATE fletes SET g_kilomet = %s WHERE id = %s", (km, flete_id))
+                cursor.execute("UPDATE fletes SET g_kilomet = %s WHERE id = %s RETURNING g_cuilchof, g_fecha", (km, flete_id))
+                for flete in cursor.fetchall():
+                    actualizar_eficiencia(cursor, flete['g_cuilchof'], flete['g_fecha'])
+                notificar(cursor, 'fletes')
             conn.commit()
             return jsonify({'success': True})
         except Exception as e:
@@ -1511,81 +2158,505 @@ def update_km():
             if conn:
                 conn.close()
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/fletes/nuevo', methods=['GET', 'POST'])
+def nuevo_flete():
+    conn = get_db()
+    if not conn:
+        return "<h1>Error: No se pudo conectar a la base de datos.</h1>"
+
+    try:
+        with get_dict_cursor(conn) as cursor:
+            if request.method == 'POST':
+                try:
+                    g_fecha = request.form['g_fecha']
+                    g_ctg = request.form['g_ctg']
+                    g_codi = request.form['g_codi']
+                    g_cose = request.form['g_cose']
+                    o_peso = float(request.form['o_peso'])
+                    o_neto = float(request.form['o_neto'])
+                    g_tarflet = float(request.form['g_tarflet'])
+                    g_kilomet = int(request.form['g_kilomet'])
+                    g_ctaplade = request.form['g_ctaplade']
+                    g_cuilchof = request.form['g_cuilchof']
+                    categoria = request.form['categoria']
+                    
+                    importe = round((o_neto / 1000) * g_tarflet, 2)
+
+                    cursor.execute("""
+                        INSERT INTO fletes (g_fecha, g_ctg, g_codi, g_cose, o_peso, o_neto, g_tarflet, g_kilomet, g_ctaplade, g_cuilchof, importe, fuente, categoria)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    """, (g_fecha, g_ctg, g_codi, g_cose, o_peso, o_neto, g_tarflet, g_kilomet, g_ctaplade, g_cuilchof, importe, 'manual', categoria))
+                    actualizar_eficiencia(cursor, g_cuilchof, g_fecha)
+                    notificar(cursor, 'fletes')
+                    
+                    conn.commit()
+                    return redirect(url_for('fletes'))
+                except psycopg2.IntegrityError:
+                    conn.rollback()
+                    return "Error: El CTG ya existe."
+                except Exception as e:
+                    conn.rollback()
+                    return f"Error al guardar el flete: {e}"
+
+            # Para GET, obtener datos para los dropdowns
+            cursor.execute("SELECT g_codi, g_desc FROM acogran")
+            granos_map = {rec['g_codi']: rec['g_desc'] for rec in cursor.fetchall()}
+
+            # Choferes y localidades se eligen con autocompletado (/buscar)
+            today_date = datetime.date.today().strftime('%Y-%m-%d')
+                    
+            return render_template('nuevo_flete.html', 
+                                   granos=granos_map, 
+                                   today_date=today_date,
+                                   distancias=get_distancias_rutas())
+    finally:
+        if conn:
+            conn.close()
+
+def get_filtros_sql_fletes(filtros, alias=''):
+    """
+    Traduce los filtros de Fletes (chofer, fechas, categoría) a condiciones SQL.
+    Compartido por la página de Fletes y su exportación.
+    """
+    condiciones = ["1=1"]
+    params = []
+    if filtros.get('chofer'):
+        condiciones.append(f"{alias}g_cuilchof = %s")
+        params.append(filtros['chofer'])
+    if filtros.get('fecha_desde'):
+        condiciones.append(f"{alias}g_fecha >= %s")
+        params.append(filtros['fecha_desde'])
+    if filtros.get('fecha_hasta'):
+        condiciones.append(f"{alias}g_fecha <= %s")
+        params.append(filtros['fecha_hasta'])
+
+    # Las categorías ROSARIO y ARRIMES también se deducen del prefijo del CTG.
+    categoria_filtro = filtros.get('categoria')
+    if categoria_filtro:
+        if categoria_filtro == 'ROSARIO':
+            condiciones.append(f"({alias}categoria = %s OR {alias}g_ctg LIKE %s)")
+            params.extend(['ROSARIO', '102%'])
+        elif categoria_filtro == 'ARRIMES':
+            condiciones.append(f"({alias}categoria = %s OR {alias}g_ctg LIKE %s)")
+            params.extend(['ARRIMES', '101%'])
+        else:
+            condiciones.append(f"{alias}categoria = %s")
+            params.append(categoria_filtro)
+    return " AND ".join(condiciones), params
+
+def asegurar_fletes_margen(cursor):
+    """Calcula los márgenes por viaje si la tabla todavía no existe."""
+    cursor.execute("SELECT to_regclass('fletes_margen') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        refresh_valuacion_combustible(cursor)
+        refresh_fletes_margen(cursor)
+        cursor.connection.commit()
+
+@app.route('/fletes/margenes/recalcular', methods=['POST'])
+def recalcular_margenes_fletes():
+    """Revaloriza el combustible pendiente y recalcula el margen de todos los viajes."""
+    conn = get_db()
+    if not conn:
+        return "<h1>Error: No se pudo conectar a la base de datos.</h1>"
+    try:
+        with conn.cursor() as cursor:
+            refresh_valuacion_combustible(cursor)
+            refresh_fletes_margen(cursor)
+            notificar(cursor, 'fletes')
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al recalcular márgenes de fletes: {e}")
+    finally:
+        if conn:
+            conn.close()
+    return redirect(url_for('fletes'))
+
+# --- ÍNDICE DE DISTANCIAS POR RUTA ---
+# 'distancias_rutas' se recalcula en cada sincronización (ver
+# sync_db.refresh_distancias_rutas). Se mantiene en memoria como las facetas y
+# la página de Fletes lo recibe completo para completar y validar los km sin
+# consultas adicionales.
+DISTANCIAS_TTL = 600
+_distancias_cache = {'datos': None, 'cargado': 0}
+
+def invalidar_distancias_rutas():
+    _distancias_cache['datos'] = None
+
+def asegurar_distancias_rutas(cursor):
+    """Calcula el índice de distancias si la tabla todavía no existe."""
+    cursor.execute("SELECT to_regclass('distancias_rutas') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        refresh_distancias_rutas(cursor)
+        cursor.connection.commit()
+
+def get_distancias_rutas():
+    """
+    Devuelve {'origen|destino': {'km', 'minimo', 'maximo', 'viajes'}} para las
+    rutas con al menos DISTANCIAS_MINIMO_VIAJES viajes.
+    """
+    ahora = datetime.datetime.now().timestamp()
+    if _distancias_cache['datos'] is not None and ahora - _distancias_cache['cargado'] < DISTANCIAS_TTL:
+        return _distancias_cache['datos']
+
+    conn = get_db()
+    if not conn:
+        return _distancias_cache['datos'] or {}
+
+    distancias = {}
+    try:
+        with get_dict_cursor(conn) as cursor:
+            asegurar_distancias_rutas(cursor)
+            cursor.execute("SELECT * FROM distancias_rutas WHERE viajes >= %s", (DISTANCIAS_MINIMO_VIAJES,))
+            for rec in cursor.fetchall():
+                distancias[f"{rec['origen']}|{rec['destino']}"] = {
+                    'km': round(float(rec['km_mediana'])),
+                    'minimo': float(rec['km_minimo']),
+                    'maximo': float(rec['km_maximo']),
+                    'viajes': rec['viajes'],
+                }
+        _distancias_cache['datos'] = distancias
+        _distancias_cache['cargado'] = ahora
+    except Exception as e:
+        print(f"Ocurrió un error al leer las distancias por ruta desde PostgreSQL: {e}")
+        return _distancias_cache['datos'] or {}
+    finally:
+        conn.close()
+    return distancias
+
+def get_fletes_km_atipicos(cursor, filtros):
+    """Fletes (según los filtros de la página) cuyos km faltan o están fuera del rango de su ruta."""
+    where_sql, params = get_filtros_sql_fletes(filtros, alias='f.')
+    cursor.execute(f"""
+        SELECT f.id, f.g_fecha, f.g_ctg, f.g_cuilchof, f.g_kilomet, d.origen, d.destino,
+               ROUND(d.km_mediana)::integer AS km_sugerido, d.km_minimo, d.km_maximo
+        FROM fletes f
+        JOIN sysmae s ON s.cli_c = f.g_ctaplade
+        JOIN distancias_rutas d
+          ON d.origen = s.s_locali
+         AND d.destino = CASE WHEN f.g_ctg LIKE '102%%' THEN 'ROSARIO'
+                              WHEN f.g_ctg LIKE '101%%' THEN 'ARRIMES'
+                              ELSE COALESCE(f.categoria, '') END
+        WHERE {where_sql}
+          AND d.viajes >= %s
+          AND (f.g_kilomet IS NULL OR f.g_kilomet <= 0 OR f.g_kilomet < d.km_minimo OR f.g_kilomet > d.km_maximo)
+        ORDER BY f.g_fecha, f.id
+    """, params + [DISTANCIAS_MINIMO_VIAJES])
+    return cursor.fetchall()
+
+def get_filtros_km_request():
+    return {
+        'chofer': request.values.get('chofer') or None,
+        'fecha_desde': request.values.get('fecha_desde') or None,
+        'fecha_hasta': request.values.get('fecha_hasta') or None,
+        'categoria': request.values.get('categoria') or None,
+    }
+
+@app.route('/fletes/km/atipicos')
+def fletes_km_atipicos():
+    """Lista en JSON los fletes con km faltantes o atípicos y el km sugerido por el índice de distancias."""
+    conn = get_db()
+    if not conn:
+        return jsonify({'success': False, 'error': 'No se pudo conectar a la base de datos.'}), 500
+    try:
+        with get_dict_cursor(conn) as cursor:
+            asegurar_distancias_rutas(cursor)
+            fletes_atipicos = get_fletes_km_atipicos(cursor, get_filtros_km_request())
+        return jsonify({'success': True, 'fletes': [{
+            'id': f['id'],
+            'fecha': f['g_fecha'].strftime('%Y-%m-%d') if f['g_fecha'] else None,
+            'ctg': f['g_ctg'],
+            'chofer': f['g_cuilchof'],
+            'origen': f['origen'],
+            'destino': f['destino'],
+            'km': f['g_kilomet'],
+            'km_sugerido': f['km_sugerido'],
+        } for f in fletes_atipicos]})
+    except Exception as e:
+        print(f"Error al buscar km atípicos: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        if conn:
+            conn.close()
 
-@app.route('/fletes/nuevo', methods=['GET', 'POST'])
-def nuevo_flete():
+@app.route('/fletes/km/corregir', methods=['POST'])
+def corregir_km_fletes():
+    """
+    Reemplaza por la mediana de su ruta los km faltantes o atípicos de los
+    fletes filtrados, y recalcula márgenes y eficiencia desde el viaje más antiguo corregido.
+    """
     conn = get_db()
     if not conn:
         return "<h1>Error: No se pudo conectar a la base de datos.</h1>"
-
     try:
         with get_dict_cursor(conn) as cursor:
-            if request.method == 'POST':
-                try:
-                    g_fecha = request.form['g_fecha']
-                    g_ctg = request.form['g_ctg']
-                    g_codi = request.form['g_codi']
-                    g_cose = request.form['g_cose']
-                    o_peso = float(request.form['o_peso'])
-                    o_neto = float(request.form['o_neto'])
-                    g_tarflet = float(request.form['g_tarflet'])
-                    g_kilomet = int(request.form['g_kilomet'])
-                    g_ctaplade = request.form['g_ctaplade']
-                    g_cuilchof = request.form['g_cuilchof']
-                    categoria = request.form['categoria']
-                    
-                    importe = round((o_neto / 1000) * g_tarflet, 2)
+            asegurar_distancias_rutas(cursor)
+            fletes_atipicos = get_fletes_km_atipicos(cursor, get_filtros_km_request())
+            if fletes_atipicos:
+                execute_values(cursor, """
+                    UPDATE fletes AS f SET g_kilomet = v.km
+                    FROM (VALUES %s) AS v(id, km)
+                    WHERE f.id = v.id
+                """, [(f['id'], f['km_sugerido']) for f in fletes_atipicos])
+                refresh_fletes_margen(cursor)
+                refresh_eficiencia_combustible(cursor, desde=min((f['g_fecha'] for f in fletes_atipicos if f['g_fecha']), default=None))
+                notificar(cursor, 'fletes')
+        conn.commit()
+        print(f"Km corregidos en {len(fletes_atipicos)} fletes.")
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al corregir km de fletes: {e}")
+    finally:
+        if conn:
+            conn.close()
+    return redirect(url_for('fletes'))
+
+def actualizar_eficiencia(cursor, chofer, fecha):
+    """Recalcula la eficiencia mensual de un chofer desde el mes de 'fecha'."""
+    if chofer and fecha:
+        refresh_eficiencia_combustible(cursor, desde=fecha, chofer=chofer)
+
+def armar_plan_despachos(cursor, fecha_inicio, dias, viajes_por_dia):
+    """Plan de despacho de los camiones pendientes de los contratos que lista /ventas."""
+    current_year = datetime.date.today().year
+    min_harvest_year_start = (current_year - 1) % 100
+    min_harvest_year = f"{min_harvest_year_start:02d}/{(min_harvest_year_start + 1):02d}"
+    contratos_pendientes, _ = get_contratos_pendientes(cursor, min_harvest_year=min_harvest_year)
+    pronostico = get_pronostico_entregas(cursor)
+    asegurar_fletes_margen(cursor)
+
+    contratos = [{
+        'contrato': c['contrato'],
+        'comprador': c['comprador'],
+        'grano': c['grano'],
+        'cosecha': c['cosecha'],
+        'camiones': c['camiones_pendientes'],
+        'en_riesgo': bool(pronostico.get(c['contrato']) and pronostico[c['contrato']]['en_riesgo']),
+    } for c in contratos_pendientes]
+    destinos, km_ruta, viajes_chofer, costo_km, choferes = get_datos_planificacion(cursor, [c['contrato'] for c in contratos])
+    plan, sin_asignar = planificar_despachos(contratos, choferes, destinos, km_ruta, viajes_chofer, costo_km,
+                                             fecha_inicio, dias=dias, viajes_por_dia=viajes_por_dia)
+    return plan, sin_asignar, len(choferes)
+
+def get_parametros_plan():
+    fecha = request.args.get('fecha')
+    fecha_inicio = datetime.datetime.strptime(fecha, '%Y-%m-%d').date() if fecha else datetime.date.today()
+    dias = min(max(request.args.get('dias', 1, type=int), 1), 14)
+    viajes_por_dia = min(max(request.args.get('viajes', PLAN_VIAJES_POR_DIA, type=int), 1), 5)
+    return fecha_inicio, dias, viajes_por_dia
+
+@app.route('/fletes/despachos/plan')
+def plan_despachos_json():
+    """Plan de despacho en JSON (mismos parámetros que /fletes/despachos)."""
+    fecha_inicio, dias, viajes_por_dia = get_parametros_plan()
+    conn = get_db()
+    if not conn:
+        return jsonify({'success': False, 'error': 'No se pudo conectar a la base de datos.'}), 500
+    try:
+        with get_dict_cursor(conn) as cursor:
+            plan, sin_asignar, choferes = armar_plan_despachos(cursor, fecha_inicio, dias, viajes_por_dia)
+        return jsonify({'success': True, 'plan': plan, 'camiones_sin_asignar': sin_asignar, 'choferes_disponibles': choferes})
+    except Exception as e:
+        print(f"Error al armar el plan de despacho: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        if conn:
+            conn.close()
 
-                    cursor.execute("""
-                        INSERT INTO fletes (g_fecha, g_ctg, g_codi, g_cose, o_peso, o_neto, g_tarflet, g_kilomet, g_ctaplade, g_cuilchof, importe, fuente, categoria)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """, (g_fecha, g_ctg, g_codi, g_cose, o_peso, o_neto, g_tarflet, g_kilomet, g_ctaplade, g_cuilchof, importe, 'manual', categoria))
-                    
-                    conn.commit()
-                    return redirect(url_for('fletes'))
-                except psycopg2.IntegrityError:
-                    conn.rollback()
-                    return "Error: El CTG ya existe."
-                except Exception as e:
-                    conn.rollback()
-                    return f"Error al guardar el flete: {e}"
+@app.route('/fletes/despachos')
+def despachos():
+    """Plan de despacho diario (o de varios días) de los camiones pendientes."""
+    fecha_inicio, dias, viajes_por_dia = get_parametros_plan()
+    conn = get_db()
+    if not conn:
+        return "<h1>Error: No se pudo conectar a la base de datos.</h1>"
+    try:
+        with get_dict_cursor(conn) as cursor:
+            plan, sin_asignar, choferes = armar_plan_despachos(cursor, fecha_inicio, dias, viajes_por_dia)
+        filtros = {'fecha': fecha_inicio.strftime('%Y-%m-%d'), 'dias': dias, 'viajes': viajes_por_dia}
+        return render_template('despachos.html', plan=plan, sin_asignar=sin_asignar, choferes=choferes, filtros=filtros,
+                               costo_total=sum(viaje['costo_estimado'] for viaje in plan))
+    finally:
+        if conn:
+            conn.close()
 
-            # Para GET, obtener datos para los dropdowns
-            cursor.execute("SELECT g_codi, g_desc FROM acogran")
-            granos_map = {rec['g_codi']: rec['g_desc'].strip() for rec in cursor.fetchall()}
+@app.route('/fletes/eficiencia')
+def eficiencia_combustible():
+    """Tendencia mensual de consumo cada 100 km por chofer (o de toda la flota) y meses atípicos."""
+    hoy = datetime.date.today()
+    filtros = {
+        'chofer': request.args.get('chofer') or None,
+        'desde': request.args.get('desde') or (hoy - relativedelta(months=23)).strftime('%Y-%m'),
+        'hasta': request.args.get('hasta') or hoy.strftime('%Y-%m'),
+    }
+    conn = get_db()
+    if not conn:
+        return "<h1>Error: No se pudo conectar a la base de datos.</h1>"
+    try:
+        with get_dict_cursor(conn) as cursor:
+            cursor.execute("SELECT to_regclass('eficiencia_combustible_mensual') IS NOT NULL")
+            if not cursor.fetchone()[0]:
+                refresh_eficiencia_combustible(cursor)
+                conn.commit()
 
-            cursor.execute("SELECT c_document, c_nombre FROM choferes")
-            choferes_map = {rec['c_document'].strip(): rec['c_nombre'].strip() for rec in cursor.fetchall() if rec.get('c_document') and rec.get('c_nombre')}
-            
-            sorted_choferes = OrderedDict(sorted(choferes_map.items(), key=lambda item: item[1]))
+            rango = (filtros['desde'] + '-01', filtros['hasta'] + '-01')
+            if filtros['chofer']:
+                cursor.execute("""
+                    SELECT mes, km, litros, toneladas, viajes, consumo_100km, desvio_z, atipico
+                    FROM eficiencia_combustible_mensual
+                    WHERE chofer = %s AND mes BETWEEN %s AND %s
+                    ORDER BY mes
+                """, (filtros['chofer'],) + rango)
+            else:
+                cursor.execute("""
+                    SELECT mes, SUM(km) AS km, SUM(litros) AS litros, SUM(toneladas) AS toneladas, SUM(viajes) AS viajes,
+                           CASE WHEN SUM(km) > 0 THEN SUM(litros) / SUM(km) * 100 END AS consumo_100km,
+                           NULL AS desvio_z, BOOL_OR(atipico) AS atipico
+                    FROM eficiencia_combustible_mensual
+                    WHERE mes BETWEEN %s AND %s
+                    GROUP BY mes
+                    ORDER BY mes
+                """, rango)
+            serie = cursor.fetchall()
 
-            cursor.execute("SELECT cli_c, s_locali FROM sysmae WHERE s_locali IS NOT NULL AND s_locali != '' ORDER BY s_locali")
-            localidades_temp = {rec['s_locali'].strip(): rec['cli_c'].strip() for rec in cursor.fetchall()}
-            sorted_localidades = OrderedDict(sorted({v: k for k, v in localidades_temp.items()}.items(), key=lambda item: item[1]))
+            cursor.execute("""
+                SELECT e.chofer, ch.c_nombre, e.mes, e.km, e.litros, e.consumo_100km, e.desvio_z
+                FROM eficiencia_combustible_mensual e
+                LEFT JOIN choferes ch ON ch.c_document = e.chofer
+                WHERE e.atipico AND e.mes BETWEEN %s AND %s AND (%s::varchar IS NULL OR e.chofer = %s)
+                ORDER BY e.mes DESC, ABS(e.desvio_z) DESC
+            """, rango + (filtros['chofer'], filtros['chofer']))
+            atipicos = cursor.fetchall()
 
-            today_date = datetime.date.today().strftime('%Y-%m-%d')
-                    
-            return render_template('nuevo_flete.html', 
-                                   granos=granos_map, 
-                                   choferes=sorted_choferes, 
-                                   localidades=sorted_localidades,
-                                   today_date=today_date)
+            cursor.execute("""
+                SELECT DISTINCT e.chofer, COALESCE(ch.c_nombre, e.chofer) AS nombre
+                FROM eficiencia_combustible_mensual e
+                LEFT JOIN choferes ch ON ch.c_document = e.chofer
+                ORDER BY nombre
+            """)
+            choferes = cursor.fetchall()
+        grafico = {
+            'labels': [fila['mes'].strftime('%m/%Y') for fila in serie],
+            'consumo': [float(fila['consumo_100km']) if fila['consumo_100km'] is not None else None for fila in serie],
+            'atipico': [bool(fila['atipico']) for fila in serie],
+        }
+        return render_template('eficiencia.html', serie=serie, atipicos=atipicos, choferes=choferes,
+                               filtros=filtros, grafico=grafico)
     finally:
         if conn:
             conn.close()
 
+def get_filtros_fletes(datos=None):
+    """
+    Filtros de la página de Fletes tomados de 'datos' (el formulario enviado o,
+    para la actualización en vivo, la query string). Sin datos, el mes en curso.
+    """
+    if datos is None:
+        today = datetime.date.today()
+        return {
+            'fecha_desde': today.replace(day=1).strftime('%Y-%m-%d'),
+            'fecha_hasta': today.strftime('%Y-%m-%d'),
+            'chofer': None,
+            'categoria': None,
+        }
+    return {
+        'chofer': datos.get('chofer'),
+        'fecha_desde': datos.get('fecha_desde'),
+        'fecha_hasta': datos.get('fecha_hasta'),
+        'categoria': datos.get('categoria'),
+    }
+
+def get_mapas_fletes(cursor):
+    """Descripción de granos, localidad de cada cuenta y nombre de cada chofer, para mostrar los fletes."""
+    cursor.execute("SELECT g_codi, g_desc FROM acogran")
+    granos_map = {rec['g_codi']: rec['g_desc'] for rec in cursor.fetchall()}
+
+    cursor.execute("SELECT cli_c, s_locali FROM sysmae WHERE s_locali IS NOT NULL AND s_locali != ''")
+    all_localidades = cursor.fetchall()
+    
+    localidades_map = {rec['cli_c']: rec['s_locali'] for rec in all_localidades}
+
+    cursor.execute("SELECT c_document, c_nombre FROM choferes")
+    choferes_map = {rec['c_document']: rec['c_nombre'] for rec in cursor.fetchall() if rec.get('c_document') and rec.get('c_nombre')}
+    return granos_map, localidades_map, choferes_map
+
+def get_fletes_listado(cursor, filtros, granos_map, localidades_map, choferes_map):
+    """
+    Fletes filtrados y formateados para la tabla de la página, con sus totales
+    y las filas tal como vienen de la base (para el resumen por chofer).
+    """
+    asegurar_fletes_margen(cursor)
+    condiciones, params = get_filtros_sql_fletes(filtros, alias='f.')
+    cursor.execute(f"""
+        SELECT f.*, fm.costo_combustible, fm.margen, fm.margen_por_km
+        FROM fletes f
+        LEFT JOIN fletes_margen fm ON fm.flete_id = f.id
+        WHERE {condiciones}
+        ORDER BY f.g_fecha DESC
+    """, params)
+    fletes_db = cursor.fetchall()
+
+    # --- Procesamiento de Fletes ---
+    fletes_procesados = []
+    total_neto = 0
+    total_importe = 0
+    total_km = 0
+
+    for flete in fletes_db:
+        flete_dict = dict(flete)
+        total_neto += flete_dict.get('o_neto', 0) or 0
+        total_importe += flete_dict.get('importe', 0) or 0
+        
+        # 1) Multiplicar kilometros x 2
+        kilometros = flete_dict.get('g_kilomet', 0) or 0
+        kilometros_ida_y_vuelta = kilometros # los km ya están almacenados como ida y vuelta.
+        total_km += kilometros_ida_y_vuelta
+
+        flete_dict['g_fecha'] = format_date(flete_dict.get('g_fecha'))
+        flete_dict['g_ctg'] = flete_dict.get('g_ctg') or ''
+        
+        # 2) Asignar categoría según CTG
+        if flete_dict['g_ctg'].startswith('102'):
+            flete_dict['categoria'] = 'ROSARIO'
+        elif flete_dict['g_ctg'].startswith('101'):
+            flete_dict['categoria'] = 'ARRIMES'
+        else:
+            flete_dict['categoria'] = flete_dict.get('categoria') or ''
+
+        flete_dict['g_cose'] = flete_dict.get('g_cose') or ''
+        flete_dict['o_peso'] = format_number(flete_dict.get('o_peso'), decimals=0)
+        flete_dict['o_neto'] = format_number(flete_dict.get('o_neto'), decimals=0)
+        flete_dict['g_tarflet'] = format_number(flete_dict.get('g_tarflet'), is_currency=True, decimals=2)
+        flete_dict['importe'] = format_number(flete_dict.get('importe'), is_currency=True, decimals=2)
+        flete_dict['g_kilomet'] = format_number(kilometros_ida_y_vuelta, decimals=0)
+        flete_dict['costo_combustible'] = format_number(flete_dict.get('costo_combustible'), is_currency=True, decimals=2)
+        flete_dict['margen'] = format_number(flete_dict.get('margen'), is_currency=True, decimals=2)
+        flete_dict['margen_por_km'] = format_number(flete_dict.get('margen_por_km'), is_currency=True, decimals=2)
+        
+        flete_dict['grano'] = granos_map.get(flete_dict['g_codi'], flete_dict['g_codi'])
+        flete_dict['localidad'] = localidades_map.get(flete_dict['g_ctaplade'], flete_dict['g_ctaplade'])
+        flete_dict['g_cuilchof_nombre'] = choferes_map.get(flete_dict['g_cuilchof'], flete_dict['g_cuilchof'])
+        
+        fletes_procesados.append(flete_dict)
+
+    totales = {
+        'neto': format_number(total_neto, decimals=0),
+        'importe': format_number(total_importe, is_currency=True, decimals=2),
+        'viajes': len(fletes_procesados),
+        'km': format_number(total_km, decimals=0)
+    }
+    return fletes_procesados, totales, fletes_db
+
 @app.route('/fletes', methods=['GET', 'POST'])
 def fletes():
     try:
         fletes_procesados = []
-        sorted_choferes_filtrados = OrderedDict()
         filtros_aplicados = {}
         nombre_chofer_seleccionado = None
         totales = {'neto': 0, 'importe': 0, 'viajes': 0, 'km': 0}
         granos_map = {}
-        sorted_all_choferes = OrderedDict()
-        unique_localidades = OrderedDict()
         categorias = []
         resumen_chofer = None
         
@@ -1595,21 +2666,7 @@ def fletes():
 
         try:
             with get_dict_cursor(conn) as cursor:
-                # --- Mapeo de Granos, Localidades, Choferes ---
-                cursor.execute("SELECT g_codi, g_desc FROM acogran")
-                granos_map = {rec['g_codi']: rec['g_desc'].strip() for rec in cursor.fetchall()}
-
-                cursor.execute("SELECT cli_c, s_locali FROM sysmae WHERE s_locali IS NOT NULL AND s_locali != ''")
-                all_localidades = cursor.fetchall()
-                
-                localidades_map = {rec['cli_c'].strip(): rec['s_locali'].strip() for rec in all_localidades}
-
-                localidades_temp = {rec['s_locali'].strip(): rec['cli_c'].strip() for rec in all_localidades}
-                unique_localidades = OrderedDict(sorted({v: k for k, v in localidades_temp.items()}.items(), key=lambda item: item[1]))
-
-
-                cursor.execute("SELECT c_document, c_nombre FROM choferes")
-                choferes_map = {rec['c_document'].strip(): rec['c_nombre'].strip() for rec in cursor.fetchall() if rec.get('c_document') and rec.get('c_nombre')}
+                granos_map, localidades_map, choferes_map = get_mapas_fletes(cursor)
 
                 # --- Obtener Categorías para el filtro ---
                 cursor.execute("SELECT DISTINCT categoria FROM fletes WHERE categoria IS NOT NULL AND categoria != ''")
@@ -1618,96 +2675,8 @@ def fletes():
                 categorias = sorted(list(set(categorias_db + ['ROSARIO', 'ARRIMES', 'HARINA - OTROS'])))
 
                 # --- Filtros ---
-                if request.method == 'POST':
-                    filtros_aplicados['chofer'] = request.form.get('chofer')
-                    filtros_aplicados['fecha_desde'] = request.form.get('fecha_desde')
-                    filtros_aplicados['fecha_hasta'] = request.form.get('fecha_hasta')
-                    filtros_aplicados['categoria'] = request.form.get('categoria')
-                else: # GET
-                    today = datetime.date.today()
-                    first_day_of_month = today.replace(day=1)
-                    filtros_aplicados['fecha_desde'] = first_day_of_month.strftime('%Y-%m-%d')
-                    filtros_aplicados['fecha_hasta'] = today.strftime('%Y-%m-%d')
-                    filtros_aplicados['chofer'] = None
-                    filtros_aplicados['categoria'] = None
-                
-                query = "SELECT * FROM fletes WHERE 1=1"
-                params = []
-
-                if filtros_aplicados.get('chofer'):
-                    query += " AND g_cuilchof = %s"
-                    params.append(filtros_aplicados['chofer'])
-                if filtros_aplicados.get('fecha_desde'):
-                    query += " AND g_fecha >= %s"
-                    params.append(filtros_aplicados['fecha_desde'])
-                if filtros_aplicados.get('fecha_hasta'):
-                    query += " AND g_fecha <= %s"
-                    params.append(filtros_aplicados['fecha_hasta'])
-                
-                # Añadir filtro de categoría
-                categoria_filtro = filtros_aplicados.get('categoria')
-                if categoria_filtro:
-                    if categoria_filtro == 'ROSARIO':
-                        query += " AND (categoria = %s OR g_ctg LIKE %s)"
-                        params.append('ROSARIO')
-                        params.append('102%')
-                    elif categoria_filtro == 'ARRIMES':
-                        query += " AND (categoria = %s OR g_ctg LIKE %s)"
-                        params.append('ARRIMES')
-                        params.append('101%')
-                    else:
-                        query += " AND categoria = %s"
-                        params.append(categoria_filtro)
-                
-                query += " ORDER BY g_fecha DESC"
-                cursor.execute(query, params)
-                fletes_db = cursor.fetchall()
-
-                # --- Procesamiento de Fletes ---
-                total_neto = 0
-                total_importe = 0
-                total_km = 0
-
-                for flete in fletes_db:
-                    flete_dict = dict(flete)
-                    total_neto += flete_dict.get('o_neto', 0) or 0
-                    total_importe += flete_dict.get('importe', 0) or 0
-                    
-                    # 1) Multiplicar kilometros x 2
-                    kilometros = flete_dict.get('g_kilomet', 0) or 0
-                    kilometros_ida_y_vuelta = kilometros # los km ya están almacenados como ida y vuelta.
-                    total_km += kilometros_ida_y_vuelta
-
-                    flete_dict['g_fecha'] = format_date(flete_dict.get('g_fecha'))
-                    flete_dict['g_ctg'] = flete_dict.get('g_ctg') or ''
-                    
-                    # 2) Asignar categoría según CTG
-                    if flete_dict['g_ctg'].startswith('102'):
-                        flete_dict['categoria'] = 'ROSARIO'
-                    elif flete_dict['g_ctg'].startswith('101'):
-                        flete_dict['categoria'] = 'ARRIMES'
-                    else:
-                        flete_dict['categoria'] = flete_dict.get('categoria') or ''
-
-                    flete_dict['g_cose'] = flete_dict.get('g_cose') or ''
-                    flete_dict['o_peso'] = format_number(flete_dict.get('o_peso'), decimals=0)
-                    flete_dict['o_neto'] = format_number(flete_dict.get('o_neto'), decimals=0)
-                    flete_dict['g_tarflet'] = format_number(flete_dict.get('g_tarflet'), is_currency=True, decimals=2)
-                    flete_dict['importe'] = format_number(flete_dict.get('importe'), is_currency=True, decimals=2)
-                    flete_dict['g_kilomet'] = format_number(kilometros_ida_y_vuelta, decimals=0)
-                    
-                    flete_dict['grano'] = granos_map.get(flete_dict['g_codi'], flete_dict['g_codi'])
-                    flete_dict['localidad'] = localidades_map.get(flete_dict['g_ctaplade'], flete_dict['g_ctaplade'])
-                    flete_dict['g_cuilchof_nombre'] = choferes_map.get(flete_dict['g_cuilchof'], flete_dict['g_cuilchof'])
-                    
-                    fletes_procesados.append(flete_dict)
-
-                totales = {
-                    'neto': format_number(total_neto, decimals=0),
-                    'importe': format_number(total_importe, is_currency=True, decimals=2),
-                    'viajes': len(fletes_procesados),
-                    'km': format_number(total_km, decimals=0)
-                }
+                filtros_aplicados = get_filtros_fletes(request.form if request.method == 'POST' else None)
+                fletes_procesados, totales, fletes_db = get_fletes_listado(cursor, filtros_aplicados, granos_map, localidades_map, choferes_map)
                 
                 if filtros_aplicados.get('chofer'):
                     nombre_chofer_seleccionado = choferes_map.get(filtros_aplicados['chofer'])
@@ -1717,7 +2686,8 @@ def fletes():
                     resumen_chofer = {
                         'rosario': Decimal(0), 'harina_otros': Decimal(0), 'arrimes': Decimal(0),
                         'iva': Decimal(0), 'total_facturado': Decimal(0), 'toneladas': Decimal(0),
-                        'viajes': len(fletes_db), 'km': Decimal(0), 'gasoil': Decimal(0)
+                        'viajes': len(fletes_db), 'km': Decimal(0), 'gasoil': Decimal(0),
+                        'costo_combustible': Decimal(0), 'margen': Decimal(0)
                     }
                     total_neto_resumen = Decimal(0)
 
@@ -1740,6 +2710,8 @@ def fletes():
                             resumen_chofer['arrimes'] += importe
 
                         resumen_chofer['km'] += flete.get('g_kilomet') or Decimal(0)
+                        resumen_chofer['costo_combustible'] += flete.get('costo_combustible') or Decimal(0)
+                        resumen_chofer['margen'] += flete.get('margen') or Decimal(0)
                         total_neto_resumen += flete.get('o_neto') or Decimal(0)
                     
                     subtotal = resumen_chofer['rosario'] + resumen_chofer['harina_otros'] + resumen_chofer['arrimes']
@@ -1770,39 +2742,24 @@ def fletes():
                     resumen_chofer['fact_sin_iva_km'] = (subtotal / resumen_chofer['km']) if resumen_chofer['km'] > 0 else Decimal(0)
                     resumen_chofer['fact_con_iva_km'] = (resumen_chofer['total_facturado'] / resumen_chofer['km']) if resumen_chofer['km'] > 0 else Decimal(0)
                     resumen_chofer['consumo_100km'] = (resumen_chofer['gasoil'] / resumen_chofer['km'] * 100) if resumen_chofer['km'] > 0 else Decimal(0)
+                    resumen_chofer['margen_por_km'] = (resumen_chofer['margen'] / resumen_chofer['km']) if resumen_chofer['km'] > 0 else Decimal(0)
                     
                     resumen_chofer['periodo_desde'] = format_date(datetime.datetime.strptime(filtros_aplicados['fecha_desde'], '%Y-%m-%d'))
                     resumen_chofer['periodo_hasta'] = format_date(datetime.datetime.strptime(filtros_aplicados['fecha_hasta'], '%Y-%m-%d'))
                     resumen_chofer['chofer_nombre'] = choferes_map.get(filtros_aplicados['chofer'])
-
-
-                # --- Preparar datos para el template ---
-                cuils_con_registros = set()
-                cursor.execute("SELECT DISTINCT g_cuilchof FROM fletes WHERE g_cuilchof IS NOT NULL AND g_cuilchof != ''")
-                for row in cursor.fetchall():
-                    cuils_con_registros.add(row['g_cuilchof'].strip())
-
-                choferes_filtrados = {
-                    cuil: nombre for cuil, nombre in choferes_map.items()
-                    if cuil in cuils_con_registros
-                }
-                sorted_choferes_filtrados = OrderedDict(sorted(choferes_filtrados.items(), key=lambda item: item[1]))
-                sorted_all_choferes = OrderedDict(sorted(choferes_map.items(), key=lambda item: item[1]))
         finally:
             if conn:
                 conn.close()
 
         return render_template('fletes.html', 
                                fletes=fletes_procesados, 
-                               choferes=sorted_choferes_filtrados.items(),
                                filtros_aplicados=filtros_aplicados,
                                nombre_chofer=nombre_chofer_seleccionado,
                                totales=totales,
                                granos=granos_map,
-                               all_choferes=sorted_all_choferes,
-                               localidades=unique_localidades,
                                categorias=categorias,
-                               resumen_chofer=resumen_chofer)
+                               resumen_chofer=resumen_chofer,
+                               distancias=get_distancias_rutas())
 
     except Exception as e:
         import traceback
@@ -1955,47 +2912,18 @@ def generar_pdf(tipo_reporte):
             title = f'Reporte de Cuenta Corriente Granaria - Contrato {contrato}'
             headers = ['Fecha', 'Comprobante', 'Descripción', 'Entregas', 'Liquidaciones', 'Saldo']
             
-            movimientos = []
             with get_dict_cursor(conn) as cursor:
-                # Obtener Entregas
-                cursor.execute("SELECT g_fecha, g_ctg, g_saldo FROM acocarpo WHERE g_contrato = %s", (contrato,))
-                for rec in cursor.fetchall():
-                    if isinstance(rec.get('g_fecha'), datetime.date):
-                        movimientos.append({
-                            'fecha': rec['g_fecha'],
-                            'comprobante': rec.get('g_ctg', ''),
-                            'descripcion': f"Entrega - CTG: {rec.get('g_ctg', '')}",
-                            'entregas': rec.get('g_saldo', 0) or 0,
-                            'liquidaciones': 0
-                        })
-                
-                # Obtener Liquidaciones
-                cursor.execute("SELECT fec_c, fac_c, fa1_c, peso FROM liqven WHERE contrato = %s", (contrato,))
-                for rec in cursor.fetchall():
-                    if isinstance(rec.get('fec_c'), datetime.date):
-                        fac_c_padded = str(rec.get('fac_c', '')).zfill(8)
-                        coe_val = f"{rec.get('fa1_c', '')}-{fac_c_padded}"
-                        movimientos.append({
-                            'fecha': rec['fec_c'],
-                            'comprobante': coe_val,
-                            'descripcion': f"Liquidación - COE: {coe_val}",
-                            'entregas': 0,
-                            'liquidaciones': rec.get('peso', 0) or 0
-                        })
-            
-            movimientos.sort(key=lambda x: x['fecha'])
-            
-            saldo = 0
+                movimientos, _ = get_cuenta_corriente_granaria(cursor, [contrato])
+
             table_data = []
             for mov in movimientos:
-                saldo += mov['entregas'] - mov['liquidaciones']
                 table_data.append(OrderedDict([
                     ('Fecha', format_date(mov['fecha'])),
                     ('Comprobante', mov['comprobante']),
                     ('Descripción', mov['descripcion']),
                     ('Entregas', format_number(mov['entregas'])),
                     ('Liquidaciones', format_number(mov['liquidaciones'])),
-                    ('Saldo', format_number(saldo))
+                    ('Saldo', format_number(mov['saldo']))
                 ]))
             
             if not table_data:
@@ -2059,7 +2987,7 @@ def generar_pdf(tipo_reporte):
                         value = format_number(value)
                     row_data[header] = value
 
-                if registro.get('g_confirm', 'N').strip().upper() == 'S':
+                if registro.get('g_confirm') == 'S':
                     row_data['confirmed'] = True
                     entregas_confirmadas_pdf.append(row_data)
                     total_confirmadas_pdf += registro.get('g_saldo', 0) or 0
@@ -2168,6 +3096,75 @@ def debug_acohis_last10():
         if conn:
             conn.close()
 
+FLETES_BUSQUEDA_LIMITE = 20
+FLETES_BUSQUEDA_LIMITE_MAX = 100
+
+@app.route('/fletes/buscar')
+def buscar_fletes():
+    """
+    Búsqueda de viajes para el modal "Asignar Viaje". Filtra por prefijo de CTG,
+    chofer (documento o nombre), fecha y grano, y devuelve una página de
+    'limit' resultados a partir de 'offset', del más reciente al más antiguo.
+    """
+    ctg = (request.args.get('ctg') or '').strip()
+    chofer = (request.args.get('chofer') or '').strip()
+    fecha = request.args.get('fecha')
+    grano = (request.args.get('grano') or '').strip()
+    limite = min(request.args.get('limit', FLETES_BUSQUEDA_LIMITE, type=int) or FLETES_BUSQUEDA_LIMITE, FLETES_BUSQUEDA_LIMITE_MAX)
+    offset = max(request.args.get('offset', 0, type=int) or 0, 0)
+
+    condiciones = ["1=1"]
+    params = []
+    if ctg:
+        # LIKE 'prefijo%' usa el índice idx_fletes_ctg_prefijo (varchar_pattern_ops)
+        condiciones.append("f.g_ctg LIKE %s")
+        params.append(ctg.replace('%', '').replace('_', '') + '%')
+    if chofer:
+        condiciones.append("(f.g_cuilchof LIKE %s OR ch.c_nombre ILIKE %s)")
+        params.extend([chofer + '%', '%' + chofer + '%'])
+    if fecha:
+        condiciones.append("f.g_fecha = %s")
+        params.append(fecha)
+    if grano:
+        condiciones.append("(f.g_codi = %s OR g.g_desc = UPPER(%s))")
+        params.extend([grano, grano])
+
+    conn = get_db()
+    if not conn:
+        return jsonify({'error': 'No se pudo conectar a la base de datos.'}), 500
+    try:
+        with get_dict_cursor(conn) as cursor:
+            cursor.execute(f"""
+                SELECT f.id, f.g_fecha, f.g_ctg, f.o_neto, ch.c_nombre AS chofer, g.g_desc AS grano
+                FROM fletes f
+                LEFT JOIN choferes ch ON ch.c_document = f.g_cuilchof
+                LEFT JOIN acogran g ON g.g_codi = f.g_codi
+                WHERE {" AND ".join(condiciones)}
+                ORDER BY f.g_fecha DESC NULLS LAST, f.id DESC
+                LIMIT %s OFFSET %s
+            """, params + [limite + 1, offset])
+            registros = cursor.fetchall()
+
+        fletes_encontrados = []
+        for rec in registros[:limite]:
+            fletes_encontrados.append({
+                'id': rec['id'],
+                'g_fecha': rec['g_fecha'].strftime('%Y-%m-%d') if rec['g_fecha'] else '',
+                'g_ctg': rec['g_ctg'],
+                'o_neto': float(rec['o_neto']) if rec['o_neto'] is not None else None,
+                'chofer': rec['chofer'] or '',
+                'grano': rec['grano'] or ''
+            })
+        return jsonify({
+            'fletes': fletes_encontrados,
+            'siguiente_offset': offset + limite if len(registros) > limite else None
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        if conn:
+            conn.close()
+
 @app.route('/fletes/<int:flete_id>')
 def get_flete(flete_id):
     conn = get_db()
@@ -2235,11 +3232,17 @@ def edit_flete(flete_id):
             
             importe = round((o_neto / 1000) * g_tarflet, 2)
 
+            cursor.execute("SELECT g_cuilchof, g_fecha FROM fletes WHERE id = %s", (flete_id,))
+            anterior = cursor.fetchone()
             cursor.execute("""
                 UPDATE fletes 
                 SET g_fecha = %s, g_ctg = %s, g_codi = %s, g_cose = %s, o_peso = %s, o_neto = %s, g_tarflet = %s, g_kilomet = %s, g_ctaplade = %s, g_cuilchof = %s, importe = %s, categoria = %s
                 WHERE id = %s
             """, (g_fecha, g_ctg, g_codi, g_cose, o_peso, o_neto, g_tarflet, g_kilomet, g_ctaplade, g_cuilchof, importe, categoria, flete_id))
+            if anterior:
+                actualizar_eficiencia(cursor, anterior['g_cuilchof'], anterior['g_fecha'])
+            actualizar_eficiencia(cursor, g_cuilchof, g_fecha)
+            notificar(cursor, 'fletes')
             
             conn.commit()
             return redirect(url_for('fletes'))
@@ -2261,7 +3264,10 @@ def delete_flete(flete_id):
         return "<h1>Error: No se pudo conectar a la base de datos.</h1>"
     try:
         with get_dict_cursor(conn) as cursor:
-            cursor.execute("DELETE FROM fletes WHERE id = %s", (flete_id,))
+            cursor.execute("DELETE FROM fletes WHERE id = %s RETURNING g_cuilchof, g_fecha", (flete_id,))
+            for flete in cursor.fetchall():
+                actualizar_eficiencia(cursor, flete['g_cuilchof'], flete['g_fecha'])
+            notificar(cursor, 'fletes')
         conn.commit()
         return redirect(url_for('fletes'))
     except Exception as e:
@@ -2271,6 +3277,128 @@ def delete_flete(flete_id):
         if conn:
             conn.close()
 
+# --- LIBRO DE STOCK DE COMBUSTIBLE ---
+# combustible_stock guarda el stock actual por proveedor/producto y
+# combustible_stock_mensual el movimiento neto de cada mes. Se actualizan en cada
+# alta, edición o baja de movimientos, así el stock no se recalcula sobre todo el historial.
+MOVIMIENTOS_COMBUSTIBLE_POR_PAGINA = 100
+
+def asegurar_stock_combustible(cursor):
+    """Construye el libro de stock desde el historial si todavía no existe."""
+    cursor.execute("SELECT to_regclass('combustible_stock_mensual') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        refresh_combustible_stock(cursor)
+
+def aplicar_movimiento_stock(cursor, proveedor_id, producto_id, fecha, cantidad, chofer_documento=None):
+    """
+    Suma 'cantidad' (negativa para revertir) al stock actual y al neto del mes
+    del movimiento, marca la valorización para recalcular desde esa fecha y,
+    si es un retiro de un chofer, actualiza su eficiencia mensual.
+    """
+    proveedor_id = proveedor_id or ''
+    producto_id = int(producto_id) if producto_id else 0
+    invalidar_valuacion_combustible(cursor, proveedor_id, producto_id, fecha)
+    actualizar_eficiencia(cursor, chofer_documento, fecha)
+    if not cantidad:
+        return
+    cursor.execute("""
+        INSERT INTO combustible_stock (proveedor_id, producto_id, stock) VALUES (%s, %s, %s)
+        ON CONFLICT (proveedor_id, producto_id) DO UPDATE SET stock = combustible_stock.stock + EXCLUDED.stock
+    """, (proveedor_id, producto_id, cantidad))
+    if fecha:
+        cursor.execute("""
+            INSERT INTO combustible_stock_mensual (mes, proveedor_id, producto_id, movimiento_neto)
+            VALUES (DATE_TRUNC('month', %s::timestamp)::date, %s, %s, %s)
+            ON CONFLICT (mes, proveedor_id, producto_id)
+            DO UPDATE SET movimiento_neto = combustible_stock_mensual.movimiento_neto + EXCLUDED.movimiento_neto
+        """, (fecha, proveedor_id, producto_id, cantidad))
+
+def revertir_movimientos_stock(cursor, movimientos):
+    """Descuenta del libro de stock los movimientos (filas con proveedor_id, producto_id, fecha, cantidad, chofer_documento)."""
+    for mov in movimientos:
+        aplicar_movimiento_stock(cursor, mov['proveedor_id'], mov['producto_id'], mov['fecha'],
+                                 -(mov['cantidad'] or 0), mov['chofer_documento'])
+
+def get_stock_combustible(cursor, fecha=None):
+    """
+    Stock por proveedor y producto. Sin fecha lee el stock actual; con fecha
+    suma los netos mensuales cerrados antes de ese mes y sólo recorre los
+    movimientos del mes en curso hasta la fecha pedida.
+    """
+    if fecha is None:
+        cursor.execute("""
+            SELECT p.s_apelli AS proveedor, pr.nombre AS producto, SUM(s.stock) AS stock
+            FROM combustible_stock s
+            LEFT JOIN sysmae p ON p.cli_c = NULLIF(s.proveedor_id, '')
+            LEFT JOIN combustible_productos pr ON pr.id = s.producto_id
+            GROUP BY p.s_apelli, pr.nombre
+            HAVING SUM(s.stock) != 0
+            ORDER BY p.s_apelli, pr.nombre
+        """)
+        return cursor.fetchall()
+
+    inicio_mes = fecha.replace(day=1)
+    cursor.execute("""
+        SELECT p.s_apelli AS proveedor, pr.nombre AS producto, SUM(t.neto) AS stock
+        FROM (
+            SELECT proveedor_id, producto_id, movimiento_neto AS neto
+            FROM combustible_stock_mensual
+            WHERE mes < %(inicio_mes)s
+            UNION ALL
+            SELECT COALESCE(proveedor_id, ''), COALESCE(producto_id, 0), COALESCE(cantidad, 0)
+            FROM combustible_movimientos
+            WHERE fecha >= %(inicio_mes)s AND fecha < %(hasta)s
+        ) t
+        LEFT JOIN sysmae p ON p.cli_c = NULLIF(t.proveedor_id, '')
+        LEFT JOIN combustible_productos pr ON pr.id = t.producto_id
+        GROUP BY p.s_apelli, pr.nombre
+        HAVING SUM(t.neto) != 0
+        ORDER BY p.s_apelli, pr.nombre
+    """, {'inicio_mes': inicio_mes, 'hasta': fecha + datetime.timedelta(days=1)})
+    return cursor.fetchall()
+
+def get_movimientos_combustible(cursor, args, pagina=1):
+    """
+    Movimientos de combustible con los filtros de la página (filtro_proveedor,
+    filtro_chofer, filtro_producto, filtro_fecha_inicio, filtro_fecha_fin).
+    Devuelve (movimientos de la página, hay_siguiente).
+    """
+    query = """
+        SELECT 
+            m.id, m.fecha, m.tipo_operacion, m.nro_comprobante, m.cantidad, m.precio_unitario,
+            p.s_apelli as proveedor_nombre,
+            c.c_nombre as chofer_nombre,
+            pr.nombre as producto_nombre
+        FROM combustible_movimientos m
+        LEFT JOIN sysmae p ON m.proveedor_id = p.cli_c
+        LEFT JOIN choferes c ON m.chofer_documento = c.c_document
+        LEFT JOIN combustible_productos pr ON m.producto_id = pr.id
+        WHERE 1=1
+    """
+    params = []
+    if args.get('filtro_proveedor'):
+        query += " AND m.proveedor_id = %s"
+        params.append(args.get('filtro_proveedor'))
+    if args.get('filtro_chofer'):
+        query += " AND m.chofer_documento = %s"
+        params.append(args.get('filtro_chofer'))
+    if args.get('filtro_producto'):
+        query += " AND m.producto_id = %s"
+        params.append(args.get('filtro_producto'))
+    if args.get('filtro_fecha_inicio'):
+        query += " AND m.fecha >= %s"
+        params.append(args.get('filtro_fecha_inicio'))
+    if args.get('filtro_fecha_fin'):
+        query += " AND m.fecha <= %s"
+        params.append(args.get('filtro_fecha_fin'))
+    query += " ORDER BY m.fecha DESC, m.id DESC LIMIT %s OFFSET %s"
+    params.extend([MOVIMIENTOS_COMBUSTIBLE_POR_PAGINA + 1, (pagina - 1) * MOVIMIENTOS_COMBUSTIBLE_POR_PAGINA])
+    cursor.execute(query, params)
+    movimientos = cursor.fetchall()
+    hay_siguiente = len(movimientos) > MOVIMIENTOS_COMBUSTIBLE_POR_PAGINA
+    movimientos = movimientos[:MOVIMIENTOS_COMBUSTIBLE_POR_PAGINA]
+    return movimientos, hay_siguiente
+
 @app.route('/combustible', methods=['GET', 'POST'])
 def combustible():
     conn = get_db()
@@ -2278,6 +3406,7 @@ def combustible():
         return "<h1>Error: No se pudo conectar a la base de datos.</h1>"
     try:
         with get_dict_cursor(conn) as cursor:
+            asegurar_stock_combustible(cursor)
             if request.method == 'POST':
                 tipo_operacion = request.form.get('tipo_operacion')
                 proveedor_id = request.form.get('proveedor_id') if request.form.get('proveedor_id') else None
@@ -2307,6 +3436,8 @@ def combustible():
                         INSERT INTO combustible_movimientos (fecha, proveedor_id, chofer_documento, tipo_operacion, nro_comprobante, producto_id, cantidad, precio_unitario, id_transaccion_canje)
                         VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
                     """, (fecha_movimiento, proveedor_id, chofer_documento, 'Canje - Entrada', nro_comprobante, producto_entra_id, abs(cantidad_entra), precio_unitario, id_salida))
+                    aplicar_movimiento_stock(cursor, proveedor_id, producto_sale_id, fecha_movimiento, -abs(cantidad_sale))
+                    aplicar_movimiento_stock(cursor, proveedor_id, producto_entra_id, fecha_movimiento, abs(cantidad_entra))
                 else: # Compra o Retiro
                     producto_id = request.form.get('producto_id')
                     cantidad = Decimal(request.form.get('cantidad', 0))
@@ -2319,65 +3450,42 @@ def combustible():
                         INSERT INTO combustible_movimientos (fecha, proveedor_id, chofer_documento, tipo_operacion, nro_comprobante, producto_id, cantidad, precio_unitario)
                         VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
                     """, (fecha_movimiento, proveedor_id, chofer_documento, tipo_operacion, nro_comprobante, producto_id, cantidad, precio_unitario))
+                    aplicar_movimiento_stock(cursor, proveedor_id, producto_id, fecha_movimiento, cantidad, chofer_documento)
+                notificar(cursor, 'combustible_movimientos')
                 conn.commit()
                 return redirect(url_for('combustible'))
             cursor.execute("SELECT cli_c, s_apelli FROM sysmae WHERE s_zonacu = 'PP' ORDER BY s_apelli")
             proveedores = cursor.fetchall()
             cursor.execute("SELECT id, nombre FROM combustible_productos ORDER BY nombre")
             productos = cursor.fetchall()
-            cursor.execute("SELECT c_document, c_nombre FROM choferes ORDER BY c_nombre")
-            choferes = cursor.fetchall()
-            query = """
-                SELECT 
-                    m.id, m.fecha, m.tipo_operacion, m.nro_comprobante, m.cantidad, m.precio_unitario,
-                    p.s_apelli as proveedor_nombre,
-                    c.c_nombre as chofer_nombre,
-                    pr.nombre as producto_nombre
-                FROM combustible_movimientos m
-                LEFT JOIN sysmae p ON m.proveedor_id = p.cli_c
-                LEFT JOIN choferes c ON m.chofer_documento = c.c_document
-                LEFT JOIN combustible_productos pr ON m.producto_id = pr.id
-                WHERE 1=1
-            """
-            params = []
-            if request.args.get('filtro_proveedor'):
-                query += " AND m.proveedor_id = %s"
-                params.append(request.args.get('filtro_proveedor'))
+            # Los choferes se eligen con autocompletado; sólo hace falta el nombre del filtrado
+            nombre_filtro_chofer = None
             if request.args.get('filtro_chofer'):
-                query += " AND m.chofer_documento = %s"
-                params.append(request.args.get('filtro_chofer'))
-            if request.args.get('filtro_producto'):
-                query += " AND m.producto_id = %s"
-                params.append(request.args.get('filtro_producto'))
-            if request.args.get('filtro_fecha_inicio'):
-                query += " AND m.fecha >= %s"
-                params.append(request.args.get('filtro_fecha_inicio'))
-            if request.args.get('filtro_fecha_fin'):
-                query += " AND m.fecha <= %s"
-                params.append(request.args.get('filtro_fecha_fin'))
-            query += " ORDER BY m.fecha DESC"
-            cursor.execute(query, params)
-            movimientos = cursor.fetchall()
-            cursor.execute("""
-                SELECT 
-                    p.s_apelli as proveedor, 
-                    pr.nombre as producto, 
-                    SUM(m.cantidad) as stock
-                FROM combustible_movimientos m
-                LEFT JOIN sysmae p ON m.proveedor_id = p.cli_c
-                LEFT JOIN combustible_productos pr ON m.producto_id = pr.id
-                GROUP BY p.s_apelli, pr.nombre
-                HAVING SUM(m.cantidad) != 0
-                ORDER BY p.s_apelli, pr.nombre
-            """)
-            stock = cursor.fetchall()
+                asegurar_busqueda(cursor)
+                nombre_filtro_chofer = get_etiquetas(cursor, 'chofer', [request.args.get('filtro_chofer')]).get(request.args.get('filtro_chofer').strip())
+            pagina = max(request.args.get('pagina', 1, type=int) or 1, 1)
+            movimientos, hay_siguiente = get_movimientos_combustible(cursor, request.args, pagina)
+
+            args_pagina = request.args.to_dict()
+            args_pagina.pop('pagina', None)
+            url_pagina_anterior = url_for('combustible', pagina=pagina - 1, **args_pagina) if pagina > 1 else None
+            url_pagina_siguiente = url_for('combustible', pagina=pagina + 1, **args_pagina) if hay_siguiente else None
+
+            stock_fecha = request.args.get('stock_fecha')
+            fecha_stock = datetime.datetime.strptime(stock_fecha, '%Y-%m-%d').date() if stock_fecha else None
+            stock = get_stock_combustible(cursor, fecha_stock)
+            conn.commit()
             today_date = datetime.date.today().strftime('%Y-%m-%d')
             return render_template('combustible.html',
                                    movimientos=movimientos,
                                    proveedores=proveedores,
                                    productos=productos,
-                                   choferes=choferes,
+                                   nombre_filtro_chofer=nombre_filtro_chofer,
                                    stock=stock,
+                                   stock_fecha=stock_fecha or '',
+                                   pagina=pagina,
+                                   url_pagina_anterior=url_pagina_anterior,
+                                   url_pagina_siguiente=url_pagina_siguiente,
                                    today_date=today_date)
     except Exception as e:
         conn.rollback()
@@ -2387,6 +3495,41 @@ def combustible():
         if conn:
             conn.close()
 
+@app.route('/combustible/retiros_valorizados')
+def retiros_valorizados():
+    """Retiros de combustible valorizados por chofer y mes (promedio ponderado o FIFO)."""
+    metodo = request.args.get('metodo', 'promedio')
+    if metodo not in METODOS_VALUACION:
+        return jsonify({'success': False, 'error': 'Método de valorización inválido.'}), 400
+    conn = get_db()
+    if not conn:
+        return jsonify({'success': False, 'error': 'No se pudo conectar a la base de datos.'}), 500
+    try:
+        with get_dict_cursor(conn) as cursor:
+            # Valoriza sólo los movimientos nuevos o afectados por cambios
+            refresh_valuacion_combustible(cursor)
+            conn.commit()
+            filas = get_retiros_valorizados(cursor, metodo,
+                                            request.args.get('fecha_inicio'),
+                                            request.args.get('fecha_fin'),
+                                            request.args.get('chofer'))
+        retiros = [{
+            'chofer_documento': f['chofer_documento'],
+            'chofer': f['chofer'] or f['chofer_documento'],
+            'mes': f['mes'].strftime('%Y-%m'),
+            'litros': float(f['litros'] or 0),
+            'costo': float(f['costo'] or 0),
+            'costo_por_litro': float(f['costo_por_litro']) if f['costo_por_litro'] is not None else None,
+        } for f in filas]
+        return jsonify({'success': True, 'metodo': metodo, 'retiros': retiros})
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al valorizar retiros de combustible: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        if conn:
+            conn.close()
+
 @app.route('/combustible/export_pdf')
 def export_combustible_pdf():
     conn = get_db()
@@ -2495,13 +3638,13 @@ def export_compras_pdf():
         with get_dict_cursor(conn) as cursor:
             # --- Obtener valores para mapeo ---
             cursor.execute("SELECT g_codi, g_desc FROM acogran")
-            granos = {rec['g_codi']: rec['g_desc'].strip() for rec in cursor.fetchall()}
+            granos = {rec['g_codi']: rec['g_desc'] for rec in cursor.fetchall()}
             
             cursor.execute("SELECT cli_c, s_apelli FROM sysmae")
-            vendedores = {rec['cli_c']: rec['s_apelli'].strip() for rec in cursor.fetchall()}
+            vendedores = {rec['cli_c']: rec['s_apelli'] for rec in cursor.fetchall()}
 
             cursor.execute("SELECT cli_c, s_locali FROM sysmae")
-            origenes = {rec['cli_c']: rec['s_locali'].strip() for rec in cursor.fetchall()}
+            origenes = {rec['cli_c']: rec['s_locali'] for rec in cursor.fetchall()}
 
             # --- Procesar filtros ---
             filtros = request.args
@@ -2575,8 +3718,204 @@ def export_compras_pdf():
             conn.close()
 
 
+# --- EXPORTACIONES CSV / XLSX ---
+# Las filas se leen con un cursor del lado del servidor (named cursor) y se
+# escriben de a bloques, por lo que la memoria usada no depende de la cantidad
+# de registros exportados.
+EXPORT_ITERSIZE = 5000
+EXPORT_FILAS_POR_BLOQUE = 1000
+XLSX_MAX_FILAS_HOJA = 1048575
+
+def iterar_consulta(conn, query, params, itersize=EXPORT_ITERSIZE):
+    """Recorre el resultado de una consulta con un cursor del servidor y cierra la conexión al terminar."""
+    try:
+        with conn.cursor(name='exportacion') as cursor:
+            cursor.itersize = itersize
+            cursor.execute(query, params)
+            for rec in cursor:
+                yield rec
+    finally:
+        conn.close()
+
+def valor_exportable(valor):
+    """Normaliza un valor de la base para CSV/XLSX."""
+    if valor is None:
+        return ''
+    if isinstance(valor, Decimal):
+        return float(valor)
+    if isinstance(valor, str):
+        return valor.strip()
+    return valor
+
+def generar_csv(encabezados, filas):
+    """Genera el CSV de a bloques de EXPORT_FILAS_POR_BLOQUE filas."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')  # BOM para que Excel detecte UTF-8
+    writer.writerow(encabezados)
+    for i, fila in enumerate(filas, 1):
+        writer.writerow([valor_exportable(v) for v in fila])
+        if i % EXPORT_FILAS_POR_BLOQUE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+def generar_xlsx(encabezados, filas, chunk_size=64 * 1024):
+    """
+    Genera el XLSX con xlsxwriter en modo 'constant_memory' (cada fila se vuelca
+    a disco al pasar a la siguiente) y luego transmite el archivo de a bloques.
+    Un XLSX es un ZIP, así que sólo puede enviarse una vez cerrado el libro.
+    """
+    import xlsxwriter
+
+    temp = tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False)
+    temp.close()
+    try:
+        workbook = xlsxwriter.Workbook(temp.name, {'constant_memory': True})
+        formato_fecha = workbook.add_format({'num_format': 'dd/mm/yyyy'})
+        formato_encabezado = workbook.add_format({'bold': True})
+        worksheet = None
+        fila_hoja = 0
+        for fila in filas:
+            if worksheet is None or fila_hoja > XLSX_MAX_FILAS_HOJA:
+                worksheet = workbook.add_worksheet()
+                worksheet.write_row(0, 0, encabezados, formato_encabezado)
+                fila_hoja = 1
+            for col, valor in enumerate(fila):
+                valor = valor_exportable(valor)
+                if isinstance(valor, datetime.date):
+                    worksheet.write_datetime(fila_hoja, col, valor, formato_fecha)
+                else:
+                    worksheet.write(fila_hoja, col, valor)
+            fila_hoja += 1
+        if worksheet is None:
+            worksheet = workbook.add_worksheet()
+            worksheet.write_row(0, 0, encabezados, formato_encabezado)
+        workbook.close()
+
+        with open(temp.name, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.remove(temp.name)
+
+def get_exportacion_compras(filtros):
+    condiciones, params = get_filtros_sql_compras(filtros, alias='a.')
+    encabezados = ['Fecha', 'CTG', 'Vendedor', 'Grano', 'Cosecha', 'Origen', 'Kilos Brutos', 'Mermas', 'Kilos Netos']
+    query = f"""
+        SELECT a.g_fecha, a.g_ctg, s.s_apelli, g.g_desc, a.g_cose, a.g_locali,
+               COALESCE(a.o_peso, 0), COALESCE(a.o_peso, 0) - COALESCE(a.o_neto, 0), COALESCE(a.o_neto, 0)
+        FROM acohis a
+        LEFT JOIN sysmae s ON s.cli_c = a.cli_c
+        LEFT JOIN acogran g ON g.g_codi = a.g_codi
+        WHERE {condiciones}
+        ORDER BY a.g_fecha DESC
+    """
+    return encabezados, query, params
+
+def get_exportacion_entregas(filtros):
+    condiciones, params = get_filtros_sql_entregas(filtros)
+    encabezados = ['Fecha', 'Contrato', 'Comprador', 'Grano', 'Cosecha', 'Kilos Netos', 'CTG', 'Destino']
+    query = f"""
+        SELECT a.g_fecha, a.g_contrato, c.apelcom_c, COALESCE(g.g_desc, a.g_codi), a.g_cose,
+               COALESCE(a.g_saldo, 0), a.g_ctg, a.g_destino
+        FROM acocarpo a
+        LEFT JOIN contrat c ON c.nrocont_c = a.g_contrato
+        LEFT JOIN acogran g ON g.g_codi = a.g_codi
+        WHERE {condiciones}
+        ORDER BY a.g_fecha, a.g_ctg
+    """
+    return encabezados, query, params
+
+def get_exportacion_fletes(filtros):
+    condiciones, params = get_filtros_sql_fletes(filtros, alias='f.')
+    encabezados = ['Fecha', 'CTG', 'Chofer', 'Grano', 'Cosecha', 'Localidad', 'Kilos', 'Neto', 'Tarifa', 'Km', 'Importe', 'Categoría']
+    query = f"""
+        SELECT f.g_fecha, f.g_ctg, COALESCE(ch.c_nombre, f.g_cuilchof), COALESCE(g.g_desc, f.g_codi), f.g_cose,
+               COALESCE(s.s_locali, f.g_ctaplade), f.o_peso, f.o_neto, f.g_tarflet, f.g_kilomet, f.importe,
+               CASE WHEN f.g_ctg LIKE '102%%' THEN 'ROSARIO'
+                    WHEN f.g_ctg LIKE '101%%' THEN 'ARRIMES'
+                    ELSE COALESCE(f.categoria, '') END
+        FROM fletes f
+        LEFT JOIN choferes ch ON ch.c_document = f.g_cuilchof
+        LEFT JOIN acogran g ON g.g_codi = f.g_codi
+        LEFT JOIN sysmae s ON s.cli_c = f.g_ctaplade
+        WHERE {condiciones}
+        ORDER BY f.g_fecha DESC
+    """
+    return encabezados, query, params
+
+def get_exportacion_cobranzas(filtros):
+    condiciones = ["c.tip_f IN ('LF', 'LP', 'FA', 'RI', 'SI', 'SG', 'SB')"]
+    params = []
+    if filtros.get('fecha_desde'):
+        condiciones.append("c.vto_f >= %s")
+        params.append(filtros['fecha_desde'])
+    if filtros.get('fecha_hasta'):
+        condiciones.append("c.vto_f <= %s")
+        params.append(filtros['fecha_hasta'])
+    encabezados = ['Vencimiento', 'Movimiento', 'Cliente', 'Tipo', 'Comprobante', 'Grano', 'Importe', 'Cta_p']
+    query = f"""
+        WITH liq AS ({sql_granos_por_comprobante()})
+        SELECT c.vto_f,
+               CASE WHEN c.tip_f IN ('LF', 'LP', 'FA') THEN 'Vencimiento' ELSE 'Cobranza' END,
+               COALESCE(s.s_apelli, c.cli_f),
+               c.tip_f,
+               {sql_comprobante('c.fa1_f', 'c.fac_f')},
+               CASE WHEN c.tip_f = 'FA' THEN 'FACTURA'
+                    WHEN c.tip_f IN ('LF', 'LP') THEN COALESCE(liq.product_c, 'N/A')
+                    ELSE '' END,
+               COALESCE(c.imp_f, 0),
+               c.cta_p
+        FROM ccbcta c
+        LEFT JOIN sysmae s ON s.cli_c = c.cli_f
+        LEFT JOIN liq ON c.tip_f IN ('LF', 'LP') AND liq.comprobante = {sql_comprobante('c.fa1_f', 'c.fac_f')}
+        WHERE {" AND ".join(condiciones)}
+        ORDER BY c.fa1_f, c.fac_f, c.vto_f
+    """
+    return encabezados, query, params
+
+EXPORTACIONES = {
+    'compras': get_exportacion_compras,
+    'entregas': get_exportacion_entregas,
+    'fletes': get_exportacion_fletes,
+    'cobranzas': get_exportacion_cobranzas,
+}
+
+@app.route('/exportar/<dataset>')
+def exportar(dataset):
+    """Exporta compras, entregas, fletes o cobranzas a CSV o XLSX con los mismos filtros que la página."""
+    if dataset not in EXPORTACIONES:
+        return "Error: Exportación no válida.", 400
+    formato = request.args.get('formato', 'csv')
+    if formato not in ('csv', 'xlsx'):
+        return "Error: Formato no válido.", 400
+
+    encabezados, query, params = EXPORTACIONES[dataset](request.args)
+
+    conn = get_db()
+    if not conn:
+        return "<h1>Error: No se pudo conectar a la base de datos.</h1>", 500
+
+    filas = iterar_consulta(conn, query, params)
+    filename = f"{dataset}_{datetime.date.today().strftime('%Y%m%d')}.{formato}"
+    if formato == 'xlsx':
+        return Response(generar_xlsx(encabezados, filas),
+                        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                        headers={'Content-Disposition': f'attachment;filename={filename}'})
+    return Response(generar_csv(encabezados, filas),
+                    mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment;filename={filename}'})
+
 
 
+def get_tareas_pendientes(cursor):
+    cursor.execute("SELECT * FROM agenda WHERE completada = FALSE ORDER BY fecha_vencimiento ASC")
+    return cursor.fetchall()
 
 @app.route('/agenda', methods=['GET', 'POST'])
 def agenda():
@@ -2608,6 +3947,7 @@ def agenda():
                                VALUES (%s, %s, %s, %s, %s)""",
                             (descripcion, fecha_vencimiento, link, frecuencia, False)
                         )
+                        notificar(cursor, 'agenda')
                         conn.commit()
 
                 elif action == 'complete':
@@ -2641,11 +3981,13 @@ def agenda():
                                        VALUES (%s, %s, %s, %s, %s)""",
                                     (tarea['descripcion'], nueva_fecha, tarea['link'], tarea['frecuencia'], False)
                                 )
+                        notificar(cursor, 'agenda')
                         conn.commit()
                 
                 elif action == 'delete':
                     tarea_id = request.form.get('tarea_id')
                     cursor.execute("DELETE FROM agenda WHERE id = %s", (tarea_id,))
+                    notificar(cursor, 'agenda')
                     conn.commit()
 
                 elif action == 'add_password':
@@ -2672,8 +4014,7 @@ def agenda():
                     conn.commit()
                     return redirect(url_for('agenda'))
             
-            cursor.execute("SELECT * FROM agenda WHERE completada = FALSE ORDER BY fecha_vencimiento ASC")
-            tareas = cursor.fetchall()
+            tareas = get_tareas_pendientes(cursor)
             
             cursor.execute("SELECT * FROM passwords ORDER BY titulo ASC")
             passwords = cursor.fetchall()
@@ -2748,6 +4089,7 @@ def edit_tarea(tarea_id):
                 SET descripcion = %s, fecha_vencimiento = %s, link = %s, frecuencia = %s
                 WHERE id = %s
             """, (descripcion, fecha_vencimiento, link, frecuencia, tarea_id))
+            notificar(cursor, 'agenda')
             
             conn.commit()
             return redirect(url_for('agenda'))
@@ -2814,13 +4156,23 @@ def edit_combustible_movement(movement_id):
                     return None
             precio_unitario = clean_price(precio_unitario_str)
 
+            asegurar_stock_combustible(cursor)
+            cursor.execute("SELECT proveedor_id, producto_id, fecha, cantidad, chofer_documento FROM combustible_movimientos WHERE id = %s", (movement_id,))
+            anteriores = cursor.fetchall()
             cursor.execute("""
                 UPDATE combustible_movimientos
                 SET fecha = %s, proveedor_id = %s, chofer_documento = %s, nro_comprobante = %s,
                     producto_id = %s, cantidad = %s, precio_unitario = %s
                 WHERE id = %s
+                RETURNING proveedor_id, producto_id, fecha, cantidad, chofer_documento
             """, (fecha_movimiento, proveedor_id, chofer_documento, nro_comprobante,
                   producto_id, cantidad, precio_unitario, movement_id))
+            nuevos = cursor.fetchall()
+            # Se revierte después del UPDATE para que los resúmenes se recalculen con los datos nuevos
+            revertir_movimientos_stock(cursor, anteriores)
+            for mov in nuevos:
+                aplicar_movimiento_stock(cursor, mov['proveedor_id'], mov['producto_id'], mov['fecha'], mov['cantidad'], mov['chofer_documento'])
+            notificar(cursor, 'combustible_movimientos')
             conn.commit()
             return jsonify({'success': True})
     except Exception as e:
@@ -2837,6 +4189,7 @@ def delete_combustible_movement(movement_id):
         return jsonify({'success': False, 'error': 'No se pudo conectar a la base de datos.'}), 500
     try:
         with get_dict_cursor(conn) as cursor:
+            asegurar_stock_combustible(cursor)
             # Check if this movement is part of a 'Canje' transaction
             cursor.execute("SELECT id_transaccion_canje, tipo_operacion FROM combustible_movimientos WHERE id = %s", (movement_id,))
             movement_info = cursor.fetchone()
@@ -2844,12 +4197,16 @@ def delete_combustible_movement(movement_id):
             if movement_info and movement_info['tipo_operacion'].startswith('Canje'):
                 if movement_info['tipo_operacion'] == 'Canje - Salida':
                     # If it's a 'Canje - Salida', delete the corresponding 'Canje - Entrada'
-                    cursor.execute("DELETE FROM combustible_movimientos WHERE id_transaccion_canje = %s", (movement_id,))
+                    cursor.execute("DELETE FROM combustible_movimientos WHERE id_transaccion_canje = %s RETURNING proveedor_id, producto_id, fecha, cantidad, chofer_documento", (movement_id,))
+                    revertir_movimientos_stock(cursor, cursor.fetchall())
                 elif movement_info['tipo_operacion'] == 'Canje - Entrada':
                     # If it's a 'Canje - Entrada', find the 'Canje - Salida' and delete it too
-                    cursor.execute("DELETE FROM combustible_movimientos WHERE id = %s", (movement_info['id_transaccion_canje'],))
+                    cursor.execute("DELETE FROM combustible_movimientos WHERE id = %s RETURNING proveedor_id, producto_id, fecha, cantidad, chofer_documento", (movement_info['id_transaccion_canje'],))
+                    revertir_movimientos_stock(cursor, cursor.fetchall())
             
-            cursor.execute("DELETE FROM combustible_movimientos WHERE id = %s", (movement_id,))
+            cursor.execute("DELETE FROM combustible_movimientos WHERE id = %s RETURNING proveedor_id, producto_id, fecha, cantidad, chofer_documento", (movement_id,))
+            revertir_movimientos_stock(cursor, cursor.fetchall())
+            notificar(cursor, 'combustible_movimientos')
             conn.commit()
             return jsonify({'success': True})
     except Exception as e:
@@ -2860,6 +4217,89 @@ def delete_combustible_movement(movement_id):
             conn.close()
 
 
+# --- ACTUALIZACIÓN EN VIVO ---
+# /eventos mantiene abierta una conexión server-sent events por pestaña y le
+# pasa los avisos de notificaciones.py. Con cada aviso, static/js/cambios.js
+# pide a /fragmento/<nombre> sólo la parte de la página afectada (con los
+# mismos filtros de la página) y la reemplaza, sin recargar todo.
+escucha_cambios = EscuchaCambios(get_db)
+
+@app.route('/eventos')
+def eventos():
+    cola = escucha_cambios.suscribir()
+
+    def generar():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    aviso = cola.get(timeout=ESPERA_SEGUNDOS)
+                except queue.Empty:
+                    # Comentario para que proxies y navegador no cierren la conexión
+                    yield ": sin cambios\n\n"
+                    continue
+                yield f"data: {json.dumps(aviso, default=str)}\n\n"
+        finally:
+            escucha_cambios.desuscribir(cola)
+
+    return Response(stream_with_context(generar()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def fragmento_cupos_solicitados(cursor, args):
+    cupos_solicitados, totales_cupos_por_grano = get_cupos_solicitados(cursor)
+    return render_template('parciales/cupos_solicitados.html', cupos_solicitados=cupos_solicitados,
+                           totales_cupos_por_grano=totales_cupos_por_grano)
+
+def fragmento_agenda_tareas(cursor, args):
+    return render_template('parciales/agenda_tareas.html', tareas=get_tareas_pendientes(cursor),
+                           today_date=datetime.date.today())
+
+def fragmento_combustible_stock(cursor, args):
+    asegurar_stock_combustible(cursor)
+    stock_fecha = args.get('stock_fecha')
+    fecha_stock = datetime.datetime.strptime(stock_fecha, '%Y-%m-%d').date() if stock_fecha else None
+    return render_template('parciales/combustible_stock.html', stock=get_stock_combustible(cursor, fecha_stock))
+
+def fragmento_combustible_movimientos(cursor, args):
+    pagina = max(args.get('pagina', 1, type=int) or 1, 1)
+    movimientos, _ = get_movimientos_combustible(cursor, args, pagina)
+    return render_template('parciales/combustible_movimientos.html', movimientos=movimientos)
+
+def fragmento_fletes(cursor, args):
+    fletes_procesados, totales, _ = get_fletes_listado(cursor, get_filtros_fletes(args), *get_mapas_fletes(cursor))
+    return render_template('parciales/fletes_listado.html', fletes=fletes_procesados, totales=totales)
+
+FRAGMENTOS = {
+    'cupos_solicitados': fragmento_cupos_solicitados,
+    'agenda_tareas': fragmento_agenda_tareas,
+    'combustible_stock': fragmento_combustible_stock,
+    'combustible_movimientos': fragmento_combustible_movimientos,
+    'fletes': fragmento_fletes,
+}
+
+@app.route('/fragmento/<nombre>')
+def fragmento(nombre):
+    """HTML de una parte de página (ver FRAGMENTOS) con los filtros de la query string."""
+    if nombre not in FRAGMENTOS:
+        return jsonify({'success': False, 'error': f'Fragmento desconocido: {nombre}'}), 404
+    conn = get_db()
+    if not conn:
+        return jsonify({'success': False, 'error': 'No se pudo conectar a la base de datos.'}), 500
+    try:
+        with get_dict_cursor(conn) as cursor:
+            html = FRAGMENTOS[nombre](cursor, request.args)
+        # asegurar_* puede haber creado tablas derivadas
+        conn.commit()
+        return html
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al generar el fragmento {nombre}: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        if conn:
+            conn.close()
+
+
 if __name__ == '__main__':
 
 
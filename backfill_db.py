@@ -0,0 +1,199 @@
+# backfill_db.py
+# Carga de la historia anterior a ANIO_CORTE. sync_db.py y update_sync.py sólo
+# cargan desde ese año en las tablas con fecha (acohis, liqven, ccbcta,
+# acocarpo y contrat); este script agrega los años anteriores.
+#
+# La carga se hace por tramos (tabla, año). Cada tramo va en su propia
+# transacción: borra lo que hubiera de ese año, inserta los registros del DBF
+# en lotes con execute_values y lo marca como completo en 'backfill_progreso'.
+# Si se interrumpe, al volver a ejecutarlo sigue con los tramos que faltan; un
+# tramo a medio cargar se revierte entero. La sincronización completa recrea
+# las tablas sin historia y borra su progreso, así que después hay que volver
+# a ejecutarlo.
+#
+# Para poder correr en horario de trabajo se frena solo: usa una sola conexión,
+# hace una pausa entre tramos y, si la base tiene muchas consultas activas de
+# otras conexiones (la aplicación), espera antes de empezar el próximo. Las
+# esperas son siempre fuera de la transacción del tramo, así no retiene
+# bloqueos mientras duerme. Toma además el bloqueo de sincronización
+# (SYNC_BLOQUEO): no corre junto con sync_db.py ni update_sync.py, que
+# reemplazan las mismas tablas.
+#
+# Uso: python backfill_db.py [--desde 2018] [--hasta 2022] [--tablas acohis liqven] [--reiniciar]
+
+import argparse
+import datetime
+import os
+import sys
+import time
+
+from dbfread import DBF, DBFNotFound
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+import sync_db
+from sync_db import get_db_connection, limpiar_registro, refresh_tablas_derivadas, bloquear_sync
+from sync_db import COLUMNAS_DBF, CLAVES_DBF, CAMPOS_FECHA, ANIO_CORTE
+from notificaciones import notificar
+
+# Años que se cargan si no se indica --desde
+BACKFILL_ANIOS_DEFECTO = 5
+BACKFILL_LOTE = 1000
+# Segundos de pausa antes de cada tramo
+BACKFILL_PAUSA_TRAMO = 2
+# Con más consultas activas que esto en otras conexiones, se espera antes del próximo tramo
+BACKFILL_MAX_ACTIVAS = 5
+BACKFILL_ESPERA_OCUPADA = 5
+
+def asegurar_progreso(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS backfill_progreso (
+        tabla VARCHAR(50), anio INTEGER, registros INTEGER, completado TIMESTAMP,
+        PRIMARY KEY (tabla, anio)
+    );""")
+
+def get_anios_completos(cursor, tabla):
+    cursor.execute("SELECT anio FROM backfill_progreso WHERE tabla = %s", (tabla,))
+    return {rec[0] for rec in cursor.fetchall()}
+
+def esperar_base_libre(cursor):
+    """Espera mientras la aplicación tenga más de BACKFILL_MAX_ACTIVAS consultas en curso."""
+    while True:
+        cursor.execute("""
+            SELECT COUNT(*) FROM pg_stat_activity
+            WHERE datname = current_database() AND state = 'active' AND pid <> pg_backend_pid()
+        """)
+        activas = cursor.fetchone()[0]
+        if activas <= BACKFILL_MAX_ACTIVAS:
+            return
+        print(f"  Base ocupada ({activas} consultas activas), se espera {BACKFILL_ESPERA_OCUPADA} s.")
+        time.sleep(BACKFILL_ESPERA_OCUPADA)
+
+def leer_por_anio(tabla, anios):
+    """
+    Lee el DBF de 'tabla' una sola vez y devuelve los registros limpios de los
+    'anios' pedidos, agrupados por año. Sólo se guardan en memoria los años pendientes.
+    """
+    columnas = COLUMNAS_DBF[tabla]
+    campo_fecha = CAMPOS_FECHA[tabla]
+    por_anio = {anio: [] for anio in anios}
+    dbf = DBF(os.path.join(sync_db.DBF_PATH_PREFIX, f'{tabla}.dbf'), encoding='iso-8859-1')
+    for rec in dbf:
+        fecha = rec.get(campo_fecha)
+        if isinstance(fecha, datetime.date) and fecha.year in por_anio:
+            por_anio[fecha.year].append(limpiar_registro(rec, columnas))
+    return por_anio
+
+def cargar_tramo(conn, cursor, tabla, anio, filas):
+    """Reemplaza el año 'anio' de 'tabla' por 'filas' y lo marca como completo, en una transacción."""
+    # Las esperas van antes de abrir la transacción del tramo
+    esperar_base_libre(cursor)
+    conn.commit()
+    time.sleep(BACKFILL_PAUSA_TRAMO)
+
+    campo_fecha = sql.Identifier(CAMPOS_FECHA[tabla].lower())
+    cursor.execute(sql.SQL("DELETE FROM {tabla} WHERE {campo} >= %s AND {campo} < %s").format(
+        tabla=sql.Identifier(tabla), campo=campo_fecha
+    ), (datetime.date(anio, 1, 1), datetime.date(anio + 1, 1, 1)))
+
+    insert_sql = sql.SQL("INSERT INTO {tabla} ({cols}) VALUES %s").format(
+        tabla=sql.Identifier(tabla),
+        cols=sql.SQL(', ').join(sql.Identifier(col.lower()) for col in COLUMNAS_DBF[tabla])
+    )
+    if tabla in CLAVES_DBF:
+        # Un registro viejo puede repetir una clave ya cargada
+        insert_sql += sql.SQL(" ON CONFLICT ({pks}) DO NOTHING").format(
+            pks=sql.SQL(', ').join(sql.Identifier(col.lower()) for col in CLAVES_DBF[tabla])
+        )
+    insert_sql = insert_sql.as_string(conn)
+
+    for inicio in range(0, len(filas), BACKFILL_LOTE):
+        execute_values(cursor, insert_sql, filas[inicio:inicio + BACKFILL_LOTE], page_size=BACKFILL_LOTE)
+
+    cursor.execute("""
+        INSERT INTO backfill_progreso (tabla, anio, registros, completado)
+        VALUES (%s, %s, %s, NOW())
+        ON CONFLICT (tabla, anio) DO UPDATE SET registros = EXCLUDED.registros, completado = EXCLUDED.completado
+    """, (tabla, anio, len(filas)))
+    conn.commit()
+
+def backfill(desde, hasta, tablas, reiniciar=False):
+    """
+    Carga los años desde..hasta (ambos incluidos) de las tablas pedidas que
+    todavía no estén completos. Devuelve False si no pudo correr o quedaron
+    años pendientes por error.
+    """
+    conn = get_db_connection()
+    if not conn:
+        return False
+
+    completo = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SET application_name = 'backfill_db'")
+            if not bloquear_sync(cursor):
+                print("Hay una sincronización en curso. Se cancela el backfill.", file=sys.stderr)
+                return False
+            asegurar_progreso(cursor)
+            if reiniciar:
+                cursor.execute("DELETE FROM backfill_progreso WHERE tabla = ANY(%s) AND anio BETWEEN %s AND %s",
+                               (list(tablas), desde, hasta))
+            conn.commit()
+
+            anios_cargados = []
+            for tabla in tablas:
+                print(f"\n--- Backfill de la tabla: {tabla} ---")
+                completos = get_anios_completos(cursor, tabla)
+                pendientes = [anio for anio in range(desde, hasta + 1) if anio not in completos]
+                if not pendientes:
+                    print(f"  Años {desde}-{hasta} ya cargados.")
+                    continue
+                dbf_path = os.path.join(sync_db.DBF_PATH_PREFIX, f'{tabla}.dbf')
+                try:
+                    por_anio = leer_por_anio(tabla, pendientes)
+                except (FileNotFoundError, DBFNotFound):
+                    print(f"  [Error Fatal] Archivo no encontrado: {dbf_path}. Saltando tabla '{tabla}'.")
+                    continue
+
+                for anio in pendientes:
+                    try:
+                        cargar_tramo(conn, cursor, tabla, anio, por_anio[anio])
+                        anios_cargados.append(anio)
+                        print(f"  Año {anio}: {len(por_anio[anio])} registros cargados.")
+                    except Exception as e:
+                        conn.rollback()
+                        completo = False
+                        print(f"  [Error] No se pudo cargar el año {anio} de '{tabla}', queda pendiente. Causa: {e}")
+                    por_anio[anio] = None
+
+            if anios_cargados:
+                # Los resúmenes se recalculan una vez al final, desde el año más viejo cargado
+                print("\n--- Recalculando tablas derivadas ---")
+                refresh_tablas_derivadas(cursor, resumen_desde=datetime.date(min(anios_cargados), 1, 1))
+                notificar(cursor, 'sync')
+                conn.commit()
+        print("\n¡Backfill finalizado!")
+        return completo
+
+    except Exception as e:
+        print(f"\nOcurrió un error crítico durante el backfill: {e}")
+        if conn:
+            conn.rollback()
+            print("Se revirtió la transacción en curso; los años ya completos quedan guardados.")
+        return False
+    finally:
+        if conn:
+            conn.close()
+            print("Conexión a la base de datos cerrada.")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=f"Carga la historia anterior a {ANIO_CORTE} por tablas y años.")
+    parser.add_argument('--desde', type=int, default=ANIO_CORTE - BACKFILL_ANIOS_DEFECTO)
+    parser.add_argument('--hasta', type=int, default=ANIO_CORTE - 1)
+    parser.add_argument('--tablas', nargs='+', choices=sorted(CAMPOS_FECHA), default=sorted(CAMPOS_FECHA))
+    parser.add_argument('--reiniciar', action='store_true', help="Vuelve a cargar también los años ya completos.")
+    args = parser.parse_args()
+    if args.hasta >= ANIO_CORTE:
+        parser.error(f"--hasta debe ser anterior a {ANIO_CORTE}: desde ese año cargan las sincronizaciones.")
+    if not backfill(args.desde, args.hasta, args.tablas, args.reiniciar):
+        sys.exit(1)
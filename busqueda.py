@@ -0,0 +1,152 @@
+# busqueda.py
+# Búsqueda unificada para los selectores con autocompletado.
+#
+# 'busqueda' reúne en una sola tabla, recalculada en cada sincronización,
+# todo lo que los formularios permiten elegir: choferes (nombre y CUIL),
+# clientes de sysmae (razón social y cuenta), localidades, contratos
+# (número, comprador, producto y cosecha) y los valores de los filtros de
+# Compras y Consultas tomados de 'facetas'. Cada fila tiene el valor que se
+# envía en el formulario, la etiqueta que se muestra y un texto normalizado
+# sobre el que se busca.
+#
+# Si la base tiene pg_trgm, el texto lleva un índice GIN de trigramas y los
+# resultados se ordenan por similitud (tolera errores de tipeo). Si no, se
+# buscan prefijos de palabra: 'busqueda_palabras' guarda, por cada palabra del
+# texto, el resto del texto desde esa palabra, con un índice text_pattern_ops
+# que resuelve "LIKE 'x%'". Se ordena por coincidencia exacta, prefijo del
+# texto completo y prefijo de otra palabra.
+
+BUSQUEDA_LIMITE = 10
+# Dimensiones de 'facetas' que también se buscan (el tipo es el nombre de la dimensión)
+BUSQUEDA_FACETAS = ('compras_vendedor', 'compras_origen', 'comprador', 'contrato_granaria')
+
+def tiene_pg_trgm(cursor):
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+    return cursor.fetchone()[0]
+
+def refresh_busqueda(cursor):
+    """Reconstruye 'busqueda' y sus índices (trigramas si pg_trgm está disponible)."""
+    cursor.execute("SAVEPOINT extension_trgm")
+    try:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cursor.execute("RELEASE SAVEPOINT extension_trgm")
+    except Exception as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT extension_trgm")
+        print(f"  [Aviso] pg_trgm no disponible, la búsqueda usa prefijos de palabra. Causa: {e}")
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS busqueda (
+        tipo VARCHAR(50) NOT NULL, valor VARCHAR(255) NOT NULL,
+        etiqueta VARCHAR(500) NOT NULL, texto TEXT NOT NULL,
+        PRIMARY KEY (tipo, valor)
+    );""")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS busqueda_palabras (
+        tipo VARCHAR(50) NOT NULL, valor VARCHAR(255) NOT NULL,
+        posicion INTEGER NOT NULL, sufijo TEXT NOT NULL
+    );""")
+    cursor.execute("DROP INDEX IF EXISTS idx_busqueda_prefijo")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_busqueda_palabras ON busqueda_palabras (tipo, sufijo text_pattern_ops)")
+    if tiene_pg_trgm(cursor):
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_busqueda_trgm ON busqueda USING gin (texto gin_trgm_ops)")
+
+    cursor.execute("DELETE FROM busqueda")
+    cursor.execute("DELETE FROM busqueda_palabras")
+    cursor.execute("""
+        INSERT INTO busqueda (tipo, valor, etiqueta, texto)
+        SELECT DISTINCT ON (tipo, valor) tipo, valor, etiqueta,
+               LOWER(etiqueta || ' ' || valor || ' ' || REGEXP_REPLACE(valor, '[^0-9]', '', 'g'))
+        FROM (
+            SELECT 'chofer' AS tipo, c_document AS valor, c_nombre AS etiqueta
+            FROM choferes
+            WHERE COALESCE(c_document, '') <> '' AND COALESCE(c_nombre, '') <> ''
+            UNION ALL
+            SELECT 'cliente', cli_c, s_apelli || COALESCE(' (' || NULLIF(s_locali, '') || ')', '')
+            FROM sysmae
+            WHERE COALESCE(cli_c, '') <> '' AND COALESCE(s_apelli, '') <> ''
+            UNION ALL
+            -- Una cuenta por localidad, como en los selectores de Fletes
+            SELECT 'localidad', MAX(cli_c), s_locali
+            FROM sysmae
+            WHERE COALESCE(s_locali, '') <> ''
+            GROUP BY s_locali
+            UNION ALL
+            SELECT 'contrato', nrocont_c,
+                   nrocont_c || ' - ' || COALESCE(apelcom_c, '') || ' ' || COALESCE(product_c, '') || ' ' || COALESCE(cosecha_c, '')
+            FROM contrat
+            WHERE COALESCE(nrocont_c, '') <> ''
+            UNION ALL
+            SELECT dimension, valor, COALESCE(NULLIF(descripcion, ''), valor)
+            FROM facetas
+            WHERE dimension = ANY(%s) AND COALESCE(valor, '') <> ''
+        ) x
+        ORDER BY tipo, valor, etiqueta
+    """, (list(BUSQUEDA_FACETAS),))
+    valores = cursor.rowcount
+    # El texto desde cada palabra hasta el final, con los espacios normalizados como en buscar()
+    cursor.execute(r"""
+        INSERT INTO busqueda_palabras (tipo, valor, posicion, sufijo)
+        SELECT tipo, valor, i, ARRAY_TO_STRING(palabras[i:], ' ')
+        FROM (
+            SELECT tipo, valor, REGEXP_SPLIT_TO_ARRAY(BTRIM(texto), '\s+') AS palabras
+            FROM busqueda
+        ) b, GENERATE_SERIES(1, ARRAY_LENGTH(palabras, 1)) AS i
+        WHERE palabras[i] <> ''
+    """)
+    print(f"Tabla 'busqueda' recalculada. Valores: {valores}.")
+
+def buscar(cursor, texto, tipo, limite=BUSQUEDA_LIMITE, trgm=None):
+    """
+    Devuelve hasta 'limite' filas (valor, etiqueta) del 'tipo' pedido que
+    coinciden con 'texto', las mejores primero.
+    """
+    texto = ' '.join((texto or '').lower().split())
+    if not texto:
+        return []
+    patron = texto.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    params = {'tipo': tipo, 'texto': texto, 'prefijo': patron + '%',
+              'subcadena': '%' + patron + '%', 'limite': limite}
+    if trgm is None:
+        trgm = tiene_pg_trgm(cursor)
+    if trgm:
+        cursor.execute("""
+            SELECT valor, etiqueta
+            FROM busqueda
+            WHERE tipo = %(tipo)s AND (texto LIKE %(subcadena)s OR texto %% %(texto)s)
+            ORDER BY (texto LIKE %(prefijo)s) DESC, similarity(texto, %(texto)s) DESC, etiqueta
+            LIMIT %(limite)s
+        """, params)
+    else:
+        # Sólo prefijos de palabra, para que el filtro use idx_busqueda_palabras
+        cursor.execute("""
+            SELECT b.valor, b.etiqueta
+            FROM busqueda b
+            JOIN (
+                SELECT valor, MIN(posicion) AS posicion
+                FROM busqueda_palabras
+                WHERE tipo = %(tipo)s AND sufijo LIKE %(prefijo)s
+                GROUP BY valor
+            ) p ON p.valor = b.valor
+            WHERE b.tipo = %(tipo)s
+            ORDER BY CASE WHEN LOWER(b.etiqueta) = %(texto)s OR LOWER(b.valor) = %(texto)s THEN 0
+                          WHEN p.posicion = 1 THEN 1
+                          ELSE 2 END,
+                     b.etiqueta
+            LIMIT %(limite)s
+        """, params)
+    return cursor.fetchall()
+
+def get_etiquetas(cursor, tipo, valores):
+    """Etiquetas de valores ya elegidos (para mostrar la selección actual sin cargar toda la lista)."""
+    valores = [v.strip() for v in valores if v and v.strip()]
+    if not valores:
+        return {}
+    cursor.execute("SELECT valor, etiqueta FROM busqueda WHERE tipo = %s AND valor = ANY(%s)", (tipo, valores))
+    etiquetas = {rec[0]: rec[1] for rec in cursor.fetchall()}
+    faltantes = [v for v in valores if v not in etiquetas]
+    if tipo == 'localidad' and faltantes:
+        # Un flete puede tener cualquier cuenta de la localidad, no sólo la que se ofrece al buscar
+        cursor.execute("SELECT cli_c, s_locali FROM sysmae WHERE cli_c = ANY(%s) AND COALESCE(s_locali, '') <> ''",
+                       (faltantes,))
+        etiquetas.update({rec[0]: rec[1] for rec in cursor.fetchall()})
+    return etiquetas
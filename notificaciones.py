@@ -0,0 +1,100 @@
+# notificaciones.py
+# Avisos de cambios entre usuarios con LISTEN/NOTIFY de PostgreSQL.
+#
+# Cada escritura en fletes, cupos_solicitados, combustible_movimientos y agenda,
+# y cada sincronización, publica con pg_notify en el canal CANAL_CAMBIOS un JSON
+# {"tabla": ...}. NOTIFY es transaccional: el aviso sale recién cuando se
+# confirma la transacción y no sale si se revierte.
+#
+# En el servidor web un único hilo escucha el canal con su propia conexión y
+# reparte cada aviso a las colas de los navegadores conectados a /eventos
+# (server-sent events), así hay una sola conexión LISTEN por proceso y no una
+# por pestaña abierta.
+
+import json
+import queue
+import select
+import threading
+import time
+
+CANAL_CAMBIOS = 'acopio_cambios'
+# Cada cuánto se revisa la conexión y /eventos manda un comentario para mantenerla viva
+ESPERA_SEGUNDOS = 15
+# Un navegador que no lee no debe acumular avisos sin límite
+MAXIMO_PENDIENTES = 100
+# Aviso que se reparte al reconectar: pudo haberse perdido cualquier cambio
+AVISO_TODO = {'tabla': '*'}
+
+def notificar(cursor, tabla, **datos):
+    """Publica un cambio en 'tabla'; llega a los navegadores cuando se confirma la transacción."""
+    aviso = dict(datos, tabla=tabla)
+    cursor.execute("SELECT pg_notify(%s, %s)", (CANAL_CAMBIOS, json.dumps(aviso, default=str)))
+
+class EscuchaCambios:
+    """
+    Hilo que hace LISTEN en CANAL_CAMBIOS y reparte los avisos a las colas
+    suscriptas. 'conectar' es una función que devuelve una conexión nueva
+    (get_db en la aplicación); el hilo arranca con la primera suscripción y se
+    reconecta solo si la conexión se cae.
+    """
+
+    def __init__(self, conectar):
+        self.conectar = conectar
+        self._colas = set()
+        self._lock = threading.Lock()
+        self._hilo = None
+
+    def suscribir(self):
+        cola = queue.Queue(MAXIMO_PENDIENTES)
+        with self._lock:
+            self._colas.add(cola)
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._escuchar, name='escucha-cambios', daemon=True)
+                self._hilo.start()
+        return cola
+
+    def desuscribir(self, cola):
+        with self._lock:
+            self._colas.discard(cola)
+
+    def _repartir(self, aviso):
+        with self._lock:
+            colas = list(self._colas)
+        for cola in colas:
+            try:
+                cola.put_nowait(aviso)
+            except queue.Full:
+                # El navegador está atrasado: con el próximo aviso igual refresca
+                pass
+
+    def _escuchar(self):
+        reconexion = False
+        while True:
+            conn = None
+            try:
+                conn = self.conectar()
+                if not conn:
+                    raise RuntimeError("No se pudo conectar a la base de datos.")
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CANAL_CAMBIOS}")
+                if reconexion:
+                    self._repartir(AVISO_TODO)
+                reconexion = True
+                while True:
+                    if select.select([conn], [], [], ESPERA_SEGUNDOS) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notificacion = conn.notifies.pop(0)
+                        try:
+                            aviso = json.loads(notificacion.payload)
+                        except ValueError:
+                            aviso = {'tabla': notificacion.payload}
+                        self._repartir(aviso)
+            except Exception as e:
+                print(f"Error en la escucha de cambios, se reintenta en {ESPERA_SEGUNDOS} s: {e}")
+                time.sleep(ESPERA_SEGUNDOS)
+            finally:
+                if conn:
+                    conn.close()
@@ -0,0 +1,175 @@
+# planificador_despachos.py
+# Plan de despacho de camiones para los contratos con saldo pendiente.
+#
+# Cada camión pendiente (contrato -> destino) se asigna a un turno de chofer
+# (chofer, día, viaje) resolviendo un problema de asignación de costo mínimo
+# con scipy.optimize.linear_sum_assignment. El costo de que un chofer haga un
+# destino es:
+#
+#     km de la ruta * costo de combustible por km del chofer
+#     * (1 + PLAN_RECARGO_RUTA_NUEVA si el chofer nunca hizo ese destino)
+#     + recargo por día * día
+#
+# El recargo por día es algo mayor que la mayor diferencia de costo de ruta
+# entre dos turnos: así un camión nunca queda en un día posterior habiendo un
+# turno libre antes, y los turnos se llenan en orden de fecha (sin él, todos
+# los días cuestan lo mismo y los camiones quedan repartidos al azar en el
+# horizonte). Dentro de un mismo día decide el costo de la ruta. Los contratos
+# en riesgo de no terminar pagan PLAN_FACTOR_DIA_RIESGO veces ese recargo, así
+# se despachan antes que los demás.
+#
+# Los km de cada destino son la mediana histórica de los viajes que llegaron a
+# él (CTG del flete cruzado con acocarpo). Cuando hay más camiones que turnos,
+# primero se eligen por prioridad (contratos en riesgo y, dentro de cada
+# prioridad, repartiendo los turnos entre contratos) y después se asignan.
+
+import datetime
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+# Choferes con viajes en este período se consideran disponibles
+PLAN_DIAS_CHOFER_ACTIVO = 60
+PLAN_VIAJES_POR_DIA = 1
+PLAN_RECARGO_RUTA_NUEVA = 0.25
+# Mayor que 2 para que un camión en riesgo nunca quede después de uno que no lo está
+PLAN_FACTOR_DIA_RIESGO = 3
+# Costo por km de referencia si no hay combustible valorizado para el chofer
+PLAN_COSTO_KM_DEFECTO = 1.0
+
+def get_datos_planificacion(cursor, contratos):
+    """
+    Lee de la base lo que necesita el planificador para los contratos dados:
+    destino habitual de cada contrato, km por destino, viajes de cada chofer a
+    cada destino, costo por km de cada chofer y choferes activos.
+    """
+    cursor.execute("""
+        SELECT DISTINCT ON (contrato) contrato, destino
+        FROM (
+            SELECT g_contrato AS contrato, g_destino AS destino, COUNT(*) AS entregas
+            FROM acocarpo
+            WHERE g_contrato = ANY(%s) AND COALESCE(g_destino, '') <> ''
+            GROUP BY 1, 2
+        ) t
+        ORDER BY contrato, entregas DESC, destino
+    """, (list(contratos),))
+    destinos = {rec['contrato']: rec['destino'] for rec in cursor.fetchall()}
+
+    cursor.execute("""
+        WITH viajes AS (
+            SELECT f.g_cuilchof AS chofer, e.g_destino AS destino, f.g_kilomet AS km
+            FROM fletes f
+            JOIN LATERAL (
+                SELECT a.g_destino FROM acocarpo a WHERE a.g_ctg = f.g_ctg LIMIT 1
+            ) e ON TRUE
+            WHERE COALESCE(e.g_destino, '') <> ''
+        )
+        SELECT destino, chofer, GROUPING(chofer) = 1 AS total_destino, COUNT(*) AS viajes,
+               percentile_cont(0.5) WITHIN GROUP (ORDER BY km) FILTER (WHERE km > 0) AS km
+        FROM viajes
+        GROUP BY GROUPING SETS ((destino), (destino, chofer))
+    """)
+    km_ruta = {}
+    viajes_chofer = {}
+    for rec in cursor.fetchall():
+        if rec['total_destino']:
+            if rec['km'] is not None:
+                km_ruta[rec['destino']] = float(rec['km'])
+        else:
+            viajes_chofer[(rec['chofer'], rec['destino'])] = rec['viajes']
+
+    cursor.execute("""
+        SELECT chofer, SUM(costo_combustible) / NULLIF(SUM(km), 0) AS costo_km
+        FROM fletes_margen
+        WHERE km > 0
+        GROUP BY chofer
+    """)
+    costo_km = {rec['chofer']: float(rec['costo_km']) for rec in cursor.fetchall() if rec['costo_km']}
+
+    cursor.execute("""
+        SELECT f.g_cuilchof AS documento, COALESCE(MAX(ch.c_nombre), f.g_cuilchof) AS nombre
+        FROM fletes f
+        LEFT JOIN choferes ch ON ch.c_document = f.g_cuilchof
+        WHERE f.g_fecha >= CURRENT_DATE - %s AND COALESCE(f.g_cuilchof, '') <> ''
+        GROUP BY f.g_cuilchof
+        ORDER BY nombre
+    """, (PLAN_DIAS_CHOFER_ACTIVO,))
+    choferes = [dict(rec) for rec in cursor.fetchall()]
+
+    return destinos, km_ruta, viajes_chofer, costo_km, choferes
+
+def seleccionar_camiones(contratos, cantidad):
+    """
+    Elige hasta 'cantidad' camiones de los contratos pendientes: primero los
+    contratos en riesgo y, dentro de cada grupo, de a un camión por contrato
+    por vuelta para no dejar todos los turnos a un solo contrato.
+    """
+    camiones = []
+    for en_riesgo in (True, False):
+        restantes = {c['contrato']: c['camiones'] for c in contratos if bool(c.get('en_riesgo')) == en_riesgo}
+        grupo = [c for c in contratos if c['contrato'] in restantes]
+        while len(camiones) < cantidad and any(restantes.values()):
+            for contrato in grupo:
+                if len(camiones) >= cantidad:
+                    break
+                if restantes[contrato['contrato']] > 0:
+                    restantes[contrato['contrato']] -= 1
+                    camiones.append(contrato)
+    return camiones
+
+def planificar_despachos(contratos, choferes, destinos, km_ruta, viajes_chofer, costo_km,
+                         fecha_inicio, dias=1, viajes_por_dia=PLAN_VIAJES_POR_DIA):
+    """
+    Arma el plan de despacho. 'contratos' es una lista de dicts con contrato,
+    comprador, grano, cosecha, camiones y en_riesgo. Devuelve (plan, sin_asignar):
+    el plan es una lista de viajes ordenada por día y chofer.
+    """
+    turnos = [(chofer, dia) for dia in range(dias) for chofer in choferes for _ in range(viajes_por_dia)]
+    camiones = seleccionar_camiones(contratos, len(turnos))
+    sin_asignar = sum(c['camiones'] for c in contratos) - len(camiones)
+    if not camiones or not turnos:
+        return [], sin_asignar
+
+    km_defecto = float(np.median(list(km_ruta.values()))) if km_ruta else 0.0
+    costo_defecto = float(np.median(list(costo_km.values()))) if costo_km else PLAN_COSTO_KM_DEFECTO
+
+    destino_camion = [destinos.get(c['contrato'], '') for c in camiones]
+    km_camion = np.array([km_ruta.get(destino, km_defecto) for destino in destino_camion])
+    riesgo_camion = np.array([bool(c.get('en_riesgo')) for c in camiones])
+    costo_turno = np.array([costo_km.get(chofer['documento'], costo_defecto) for chofer, _ in turnos])
+    dia_turno = np.array([dia for _, dia in turnos])
+
+    # Matriz camiones x turnos: todo vectorizado salvo el conocimiento de la ruta
+    destinos_unicos = {destino: i for i, destino in enumerate(sorted(set(destino_camion)))}
+    indice_destino = np.array([destinos_unicos[d] for d in destino_camion])
+    conoce = np.array([[viajes_chofer.get((chofer['documento'], destino), 0) > 0 for chofer, _ in turnos]
+                       for destino in destinos_unicos]).reshape(len(destinos_unicos), len(turnos))
+    recargo_ruta = np.where(conoce[indice_destino], 1.0, 1.0 + PLAN_RECARGO_RUTA_NUEVA)
+    costo_ruta = km_camion[:, None] * costo_turno[None, :] * recargo_ruta
+    recargo_dia = float(np.max(costo_ruta.max(axis=1) - costo_ruta.min(axis=1))) + 1.0
+    recargo_camion = np.where(riesgo_camion, PLAN_FACTOR_DIA_RIESGO * recargo_dia, recargo_dia)
+    costos = costo_ruta + np.outer(recargo_camion, dia_turno)
+
+    filas, columnas = linear_sum_assignment(costos)
+
+    plan = []
+    for fila, columna in zip(filas, columnas):
+        camion = camiones[fila]
+        chofer, dia = turnos[columna]
+        plan.append({
+            'fecha': (fecha_inicio + datetime.timedelta(days=dia)).strftime('%Y-%m-%d'),
+            'chofer_documento': chofer['documento'],
+            'chofer': chofer['nombre'],
+            'contrato': camion['contrato'],
+            'comprador': camion.get('comprador'),
+            'grano': camion.get('grano'),
+            'cosecha': camion.get('cosecha'),
+            'destino': destino_camion[fila] or None,
+            'km': round(float(km_camion[fila]), 1),
+            'ruta_conocida': bool(recargo_ruta[fila, columna] == 1.0),
+            'en_riesgo': bool(riesgo_camion[fila]),
+            'costo_estimado': round(float(costo_ruta[fila, columna]), 2),
+        })
+    plan.sort(key=lambda viaje: (viaje['fecha'], viaje['chofer'] or '', viaje['contrato']))
+    sin_asignar += len(camiones) - len(plan)
+    return plan, sin_asignar
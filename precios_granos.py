@@ -0,0 +1,96 @@
+# precios_granos.py
+# Índice de precios de granos ponderado por volumen, a partir de las
+# liquidaciones de venta (liqven).
+#
+# 'precios_granos' guarda, por escala (semana o mes), período, grano y
+# cosecha, la cantidad de liquidaciones, los kilos y el importe a precio de
+# operación (preope, por tonelada). El precio promedio ponderado es
+# importe_operacion * 1000 / kilos, y como se guardan las sumas se puede volver
+# a agregar (por ejemplo, todas las cosechas de un grano) sin perder exactitud.
+#
+# Después de cada sincronización sólo se recalculan los períodos desde la
+# fecha a partir de la cual se reemplazaron las liquidaciones.
+
+ESCALAS_PRECIOS = {
+    'semana': 'week',
+    'mes': 'month',
+}
+
+def crear_tabla_precios(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS precios_granos (
+        escala VARCHAR(10) NOT NULL, periodo DATE NOT NULL,
+        grano VARCHAR(255) NOT NULL DEFAULT '', cosecha VARCHAR(255) NOT NULL DEFAULT '',
+        liquidaciones INTEGER NOT NULL DEFAULT 0,
+        kilos NUMERIC NOT NULL DEFAULT 0,
+        importe_operacion NUMERIC NOT NULL DEFAULT 0,
+        importe_bruto NUMERIC NOT NULL DEFAULT 0,
+        precio_minimo NUMERIC, precio_maximo NUMERIC,
+        PRIMARY KEY (escala, periodo, grano, cosecha)
+    );""")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_precios_granos_grano ON precios_granos (escala, grano, periodo)")
+
+def refresh_precios_granos(cursor, desde=None):
+    """
+    Recalcula 'precios_granos'. Con 'desde' sólo se rehacen las semanas y los
+    meses que contienen liquidaciones a partir de esa fecha; sin 'desde' (o si
+    la tabla no existía) se reconstruye completa.
+
+    Sólo entran liquidaciones con peso y precio de operación mayores a cero.
+    'grano' es el código de acogran del producto del contrato.
+    """
+    cursor.execute("SELECT to_regclass('precios_granos') IS NOT NULL")
+    existia = cursor.fetchone()[0]
+    crear_tabla_precios(cursor)
+    if not existia:
+        desde = None
+
+    for escala, unidad in ESCALAS_PRECIOS.items():
+        if desde is None:
+            cursor.execute("DELETE FROM precios_granos WHERE escala = %s", (escala,))
+        else:
+            cursor.execute(
+                "DELETE FROM precios_granos WHERE escala = %s AND periodo >= date_trunc(%s, %s::date)::date",
+                (escala, unidad, desde)
+            )
+        cursor.execute("""
+            INSERT INTO precios_granos (escala, periodo, grano, cosecha, liquidaciones, kilos,
+                                        importe_operacion, importe_bruto, precio_minimo, precio_maximo)
+            SELECT %(escala)s, date_trunc(%(unidad)s, l.fec_c)::date,
+                   COALESCE(g.g_codi, ''), COALESCE(c.cosecha_c, ''),
+                   COUNT(*), SUM(l.peso), SUM(l.preope * l.peso / 1000), SUM(COALESCE(l.bru_c, 0)),
+                   MIN(l.preope), MAX(l.preope)
+            FROM liqven l
+            LEFT JOIN contrat c ON c.nrocont_c = l.contrato
+            -- Un código por descripción: si dos códigos comparten descripción, la liquidación no se duplica
+            LEFT JOIN (SELECT DISTINCT ON (g_desc) g_desc, g_codi FROM acogran ORDER BY g_desc, g_codi) g ON g.g_desc = c.product_c
+            WHERE l.fec_c IS NOT NULL AND l.peso > 0 AND l.preope > 0
+              AND (%(desde)s::date IS NULL OR l.fec_c >= date_trunc(%(unidad)s, %(desde)s::date))
+            GROUP BY 2, 3, 4
+        """, {'escala': escala, 'unidad': unidad, 'desde': desde})
+        print(f"Tabla 'precios_granos' ({escala}) actualizada. Filas recalculadas: {cursor.rowcount}.")
+
+def get_serie_precios(cursor, escala, fecha_desde, fecha_hasta, grano=None, cosecha=None):
+    """
+    Serie de precios promedio ponderados por período y grano (todas las
+    cosechas juntas salvo que se filtre una). Lee sólo la tabla precalculada.
+    """
+    if escala not in ESCALAS_PRECIOS:
+        escala = 'mes'
+    cursor.execute("""
+        SELECT p.periodo, p.grano, COALESCE(g.g_desc, p.grano) AS grano_desc,
+               SUM(p.liquidaciones) AS liquidaciones, SUM(p.kilos) AS kilos,
+               SUM(p.importe_operacion) AS importe_operacion, SUM(p.importe_bruto) AS importe_bruto,
+               SUM(p.importe_operacion) * 1000 / SUM(p.kilos) AS precio_promedio,
+               MIN(p.precio_minimo) AS precio_minimo, MAX(p.precio_maximo) AS precio_maximo
+        FROM precios_granos p
+        LEFT JOIN acogran g ON g.g_codi = p.grano
+        WHERE p.escala = %(escala)s
+          AND p.periodo BETWEEN date_trunc(%(unidad)s, %(desde)s::date)::date AND %(hasta)s
+          AND (%(grano)s::varchar IS NULL OR p.grano = %(grano)s)
+          AND (%(cosecha)s::varchar IS NULL OR p.cosecha = %(cosecha)s)
+        GROUP BY p.periodo, p.grano, g.g_desc
+        ORDER BY p.periodo, grano_desc
+    """, {'escala': escala, 'unidad': ESCALAS_PRECIOS[escala], 'desde': fecha_desde, 'hasta': fecha_hasta,
+          'grano': grano, 'cosecha': cosecha})
+    return cursor.fetchall()
@@ -0,0 +1,133 @@
+# pronostico_entregas.py
+# Fecha estimada de finalización de los contratos con saldo pendiente.
+#
+# Para cada contrato abierto se mira el ritmo de entregas (acocarpo) de las
+# últimas PRONOSTICO_SEMANAS semanas: kilos por semana, su desvío y los días
+# con entregas. Con el promedio se proyecta la fecha en que se completa el
+# saldo; con el promedio menos el error estándar, una fecha pesimista.
+#
+# Todo se calcula de una vez para todos los contratos con arreglos de NumPy
+# (una consulta para los contratos, otra para las entregas de la ventana) y se
+# guarda en 'pronostico_entregas', de modo que /ventas sólo lee la tabla.
+
+import datetime
+
+import numpy as np
+from psycopg2.extras import execute_values
+
+PRONOSTICO_SEMANAS = 8
+# Contratos que, a este ritmo, no terminan dentro de este plazo quedan marcados en riesgo
+PRONOSTICO_HORIZONTE_DIAS = 90
+# Más allá de esto la proyección no tiene sentido como fecha y se deja vacía
+PRONOSTICO_MAXIMO_DIAS = 3650
+
+def crear_tabla_pronostico(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS pronostico_entregas (
+        contrato VARCHAR(255) PRIMARY KEY,
+        kilos_pendientes NUMERIC NOT NULL DEFAULT 0,
+        kilos_ventana NUMERIC NOT NULL DEFAULT 0,
+        dias_con_entregas INTEGER NOT NULL DEFAULT 0,
+        ultima_entrega DATE,
+        kilos_por_dia NUMERIC NOT NULL DEFAULT 0,
+        desvio_semanal NUMERIC NOT NULL DEFAULT 0,
+        fecha_estimada DATE, fecha_estimada_pesimista DATE,
+        en_riesgo BOOLEAN NOT NULL DEFAULT FALSE,
+        motivo VARCHAR(255),
+        calculado DATE NOT NULL
+    );""")
+
+def refresh_pronostico_entregas(cursor, hoy=None):
+    """
+    Recalcula 'pronostico_entregas' para todos los contratos con saldo
+    pendiente (los mismos que lista /ventas: pedido mayor que entregado y no
+    cerrado con entregado = liquidado).
+    """
+    hoy = hoy or datetime.date.today()
+    inicio_ventana = hoy - datetime.timedelta(days=7 * PRONOSTICO_SEMANAS)
+    crear_tabla_pronostico(cursor)
+
+    cursor.execute("""
+        SELECT nrocont_c, COALESCE(kiloped_c, 0) - COALESCE(entrega_c, 0)
+        FROM contrat
+        WHERE COALESCE(kiloped_c, 0) > COALESCE(entrega_c, 0)
+          AND NOT (COALESCE(entrega_c, 0) = COALESCE(liquiya_c, 0) AND COALESCE(entrega_c, 0) <> 0)
+    """)
+    filas = cursor.fetchall()
+    cursor.execute("DELETE FROM pronostico_entregas")
+    if not filas:
+        print("Tabla 'pronostico_entregas' sin contratos pendientes.")
+        return
+
+    contratos = np.array([fila[0] for fila in filas])
+    pendientes = np.array([float(fila[1]) for fila in filas])
+
+    cursor.execute("""
+        SELECT g_contrato, g_fecha, COALESCE(g_saldo, 0)
+        FROM acocarpo
+        WHERE g_fecha > %s AND g_fecha <= %s AND g_contrato = ANY(%s)
+    """, (inicio_ventana, hoy, list(contratos)))
+    entregas = cursor.fetchall()
+
+    n = len(contratos)
+    kilos_semana = np.zeros((n, PRONOSTICO_SEMANAS))
+    dias_con_entregas = np.zeros(n, dtype=int)
+    ultima_entrega = np.full(n, -1)
+    if entregas:
+        # Índice de cada entrega en 'contratos'. El orden se arma en NumPy: el
+        # ORDER BY de la base depende de su collation y no coincide con el de NumPy
+        orden = np.argsort(contratos)
+        indice = orden[np.searchsorted(contratos, np.array([e[0] for e in entregas]), sorter=orden)]
+        antiguedad = np.array([(hoy - e[1]).days for e in entregas])
+        kilos = np.array([float(e[2]) for e in entregas])
+        semana = np.minimum(antiguedad // 7, PRONOSTICO_SEMANAS - 1)
+        np.add.at(kilos_semana, (indice, semana), kilos)
+        # Días distintos con entregas por contrato
+        pares = np.unique(np.stack([indice, antiguedad]), axis=1)
+        dias_con_entregas = np.bincount(pares[0], minlength=n)
+        ultima_entrega = np.full(n, np.iinfo(np.int64).max)
+        np.minimum.at(ultima_entrega, indice, antiguedad)
+        ultima_entrega[ultima_entrega == np.iinfo(np.int64).max] = -1
+
+    kilos_ventana = kilos_semana.sum(axis=1)
+    media_semanal = kilos_semana.mean(axis=1)
+    desvio_semanal = kilos_semana.std(axis=1, ddof=1) if PRONOSTICO_SEMANAS > 1 else np.zeros(n)
+    media_pesimista = np.maximum(media_semanal - desvio_semanal / np.sqrt(PRONOSTICO_SEMANAS), 0)
+
+    with np.errstate(divide='ignore'):
+        dias_estimados = np.where(media_semanal > 0, np.ceil(pendientes / media_semanal * 7), np.inf)
+        dias_pesimistas = np.where(media_pesimista > 0, np.ceil(pendientes / media_pesimista * 7), np.inf)
+
+    sin_entregas = kilos_ventana <= 0
+    fuera_de_plazo = dias_estimados > PRONOSTICO_HORIZONTE_DIAS
+    pesimista_fuera = dias_pesimistas > PRONOSTICO_HORIZONTE_DIAS
+    en_riesgo = sin_entregas | fuera_de_plazo | pesimista_fuera
+
+    def fecha(dias):
+        return hoy + datetime.timedelta(days=int(dias)) if dias <= PRONOSTICO_MAXIMO_DIAS else None
+
+    registros = []
+    for i in range(n):
+        if sin_entregas[i]:
+            motivo = f"Sin entregas en las últimas {PRONOSTICO_SEMANAS} semanas"
+        elif fuera_de_plazo[i]:
+            motivo = f"Al ritmo actual termina en más de {PRONOSTICO_HORIZONTE_DIAS} días"
+        elif pesimista_fuera[i]:
+            motivo = "Ritmo irregular: la estimación pesimista supera el plazo"
+        else:
+            motivo = None
+        registros.append((
+            str(contratos[i]), float(pendientes[i]), float(kilos_ventana[i]), int(dias_con_entregas[i]),
+            hoy - datetime.timedelta(days=int(ultima_entrega[i])) if ultima_entrega[i] >= 0 else None,
+            float(media_semanal[i] / 7), float(desvio_semanal[i]),
+            fecha(dias_estimados[i]), fecha(dias_pesimistas[i]),
+            bool(en_riesgo[i]), motivo, hoy
+        ))
+    execute_values(cursor, """
+        INSERT INTO pronostico_entregas (contrato, kilos_pendientes, kilos_ventana, dias_con_entregas, ultima_entrega,
+                                         kilos_por_dia, desvio_semanal, fecha_estimada, fecha_estimada_pesimista,
+                                         en_riesgo, motivo, calculado)
+        VALUES %s
+        ON CONFLICT (contrato) DO NOTHING
+    """, registros)
+    print(f"Tabla 'pronostico_entregas' actualizada. Contratos: {n}, en riesgo: {int(en_riesgo.sum())}.")
@@ -26,11 +26,11 @@ document.addEventListener('DOMContentLoaded', function() {
     const editTareaModalEl = document.getElementById("editTareaModal");
     const editTareaModal = new bootstrap.Modal(editTareaModalEl);
     const editTareaForm = document.getElementById("editTareaForm");
-    const editButtons = document.querySelectorAll(".edit-tarea-btn");
-
-    editButtons.forEach(button => {
-        button.addEventListener("click", function() {
-            const tareaId = this.dataset.id;
+    // Delegado en la tabla: las filas se reemplazan cuando otro usuario cambia la agenda
+    document.getElementById("dataTable").addEventListener("click", function(event) {
+        const button = event.target.closest(".edit-tarea-btn");
+        if (button) {
+            const tareaId = button.dataset.id;
             
             fetch(`/agenda/${tareaId}`)
                 .then(response => response.json())
@@ -56,7 +56,7 @@ document.addEventListener('DOMContentLoaded', function() {
                     console.error('Error fetching task data:', error);
                     alert('No se pudieron cargar los datos de la tarea.');
                 });
-        });
+        }
     });
 
     // Form validation for editTareaForm (optional, but good practice)
@@ -0,0 +1,172 @@
+// Autocompletado para los selectores con muchas opciones (choferes, clientes,
+// localidades, contratos, ...).
+//
+// Un <select data-buscar="tipo"> se renderiza sólo con la opción vacía y la
+// seleccionada. Este script lo oculta y pone en su lugar un campo de texto que
+// consulta /buscar?tipo=...&q=... mientras se escribe. Al elegir una sugerencia
+// se agrega como opción del select, se selecciona y se dispara 'change', así el
+// resto del código sigue leyendo el select como antes.
+//
+// Para asignar un valor desde código (por ejemplo al abrir un modal de edición)
+// usar seleccionarBusqueda(select, valor), que busca la etiqueta si hace falta.
+(function () {
+    const ESPERA_MS = 200;
+    const sincronizadores = new WeakMap();
+
+    const textoSeleccionado = (select) => {
+        const opcion = select.options[select.selectedIndex];
+        return opcion && opcion.value ? opcion.text.trim() : '';
+    };
+
+    const fijarOpcion = (select, valor, etiqueta) => {
+        let opcion = Array.from(select.options).find(o => o.value === valor);
+        if (!opcion) {
+            opcion = new Option(etiqueta, valor);
+            select.add(opcion);
+        }
+        select.value = valor;
+    };
+
+    const mejorar = (select) => {
+        if (sincronizadores.has(select)) return;
+        const tipo = select.dataset.buscar;
+        const vacia = Array.from(select.options).find(o => o.value === '');
+
+        const contenedor = document.createElement('div');
+        contenedor.className = 'busqueda-contenedor';
+        const input = document.createElement('input');
+        input.type = 'text';
+        input.className = 'form-control';
+        input.autocomplete = 'off';
+        input.placeholder = vacia ? vacia.text : 'Buscar...';
+        if (select.id) {
+            input.id = `${select.id}_buscar`;
+            const etiqueta = document.querySelector(`label[for="${select.id}"]`);
+            if (etiqueta) etiqueta.htmlFor = input.id;
+        }
+        // El select oculto no puede mostrar el aviso de obligatorio: lo muestra el campo de texto
+        input.required = select.required;
+        select.required = false;
+        const lista = document.createElement('div');
+        lista.className = 'list-group busqueda-sugerencias';
+        lista.hidden = true;
+
+        select.parentNode.insertBefore(contenedor, select);
+        contenedor.append(input, lista, select);
+        select.hidden = true;
+
+        let resultados = [];
+        let activo = -1;
+        let temporizador = null;
+        let pedido = 0;
+
+        const sincronizar = () => { input.value = textoSeleccionado(select); };
+        const cerrar = () => {
+            lista.hidden = true;
+            activo = -1;
+        };
+        const pintar = () => {
+            lista.innerHTML = '';
+            resultados.forEach((resultado, i) => {
+                const item = document.createElement('button');
+                item.type = 'button';
+                item.className = 'list-group-item list-group-item-action' + (i === activo ? ' active' : '');
+                item.textContent = resultado.etiqueta;
+                // mousedown para elegir antes de que el blur cierre la lista
+                item.addEventListener('mousedown', (event) => {
+                    event.preventDefault();
+                    elegir(resultado);
+                });
+                lista.appendChild(item);
+            });
+            lista.hidden = resultados.length === 0;
+        };
+        const elegir = (resultado) => {
+            fijarOpcion(select, resultado.valor, resultado.etiqueta);
+            sincronizar();
+            cerrar();
+            select.dispatchEvent(new Event('change', { bubbles: true }));
+        };
+        const consultar = () => {
+            const texto = input.value.trim();
+            const numero = ++pedido;
+            if (!texto) {
+                resultados = [];
+                pintar();
+                return;
+            }
+            fetch(`/buscar?tipo=${encodeURIComponent(tipo)}&q=${encodeURIComponent(texto)}`)
+                .then(response => response.json())
+                .then(data => {
+                    // Descartar respuestas de consultas ya superadas por otra tecla
+                    if (numero !== pedido || !data.success) return;
+                    resultados = data.resultados;
+                    activo = resultados.length ? 0 : -1;
+                    pintar();
+                })
+                .catch(error => console.error('Error en la búsqueda:', error));
+        };
+
+        input.addEventListener('input', () => {
+            clearTimeout(temporizador);
+            temporizador = setTimeout(consultar, ESPERA_MS);
+        });
+        input.addEventListener('keydown', (event) => {
+            if (lista.hidden) return;
+            if (event.key === 'ArrowDown' || event.key === 'ArrowUp') {
+                event.preventDefault();
+                activo = (activo + (event.key === 'ArrowDown' ? 1 : -1) + resultados.length) % resultados.length;
+                pintar();
+            } else if (event.key === 'Enter' && activo >= 0) {
+                event.preventDefault();
+                elegir(resultados[activo]);
+            } else if (event.key === 'Escape') {
+                cerrar();
+            }
+        });
+        input.addEventListener('blur', () => {
+            clearTimeout(temporizador);
+            pedido++;
+            cerrar();
+            // Borrar el texto limpia la selección; un texto sin elegir vuelve a la selección actual
+            if (!input.value.trim() && select.value !== '' && vacia) {
+                select.value = '';
+                select.dispatchEvent(new Event('change', { bubbles: true }));
+            }
+            sincronizar();
+        });
+        select.addEventListener('change', sincronizar);
+        if (select.form) {
+            select.form.addEventListener('reset', () => setTimeout(sincronizar));
+        }
+
+        sincronizadores.set(select, sincronizar);
+        sincronizar();
+    };
+
+    window.seleccionarBusqueda = (select, valor) => {
+        const sincronizar = () => (sincronizadores.get(select) || (() => {}))();
+        valor = (valor || '').trim();
+        if (!valor || Array.from(select.options).some(o => o.value === valor)) {
+            select.value = valor;
+            sincronizar();
+            return Promise.resolve();
+        }
+        return fetch(`/buscar?tipo=${encodeURIComponent(select.dataset.buscar)}&valor=${encodeURIComponent(valor)}`)
+            .then(response => response.json())
+            .then(data => {
+                const resultado = data.success && data.resultados.length ? data.resultados[0] : null;
+                fijarOpcion(select, valor, resultado ? resultado.etiqueta : valor);
+                sincronizar();
+            })
+            .catch(error => {
+                console.error('Error en la búsqueda:', error);
+                fijarOpcion(select, valor, valor);
+                sincronizar();
+            });
+    };
+
+    document.addEventListener('DOMContentLoaded', () => {
+        document.querySelectorAll('select[data-buscar]').forEach(mejorar);
+    });
+})();
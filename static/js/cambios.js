@@ -0,0 +1,83 @@
+// Actualización en vivo de las partes de página que otros usuarios modifican.
+//
+// Un elemento con data-fragmento="nombre" y data-actualizar="tabla1 tabla2"
+// se vuelve a pedir a /fragmento/nombre cuando /eventos avisa un cambio en
+// alguna de esas tablas ('sync' para las sincronizaciones). La respuesta trae
+// elementos con id, que reemplazan a los de la página con el mismo id. Los
+// filtros se toman del formulario indicado en data-fragmento-form o, si no
+// hay, de la query string de la página.
+//
+// Después de reemplazar se dispara 'fragmento-actualizado' sobre el elemento,
+// para que cada página recalcule lo que dependa de las filas.
+// window.actualizarFragmento(elemento) lo vuelve a pedir en el momento (por
+// ejemplo, después de un guardado que el servidor rechazó).
+(function () {
+    const ESPERA_MS = 300;
+
+    const pendientes = new Map();
+
+    const parametros = (elemento) => {
+        const form = elemento.dataset.fragmentoForm && document.getElementById(elemento.dataset.fragmentoForm);
+        if (form) return new URLSearchParams(new FormData(form)).toString();
+        return location.search.replace(/^\?/, '');
+    };
+
+    const actualizar = (elemento) => {
+        // No pisar lo que el usuario está editando: se actualiza al salir
+        if (elemento.contains(document.activeElement)) {
+            elemento.addEventListener('focusout', () => programar(elemento), { once: true });
+            return;
+        }
+        fetch(`/fragmento/${encodeURIComponent(elemento.dataset.fragmento)}?${parametros(elemento)}`)
+            .then(response => {
+                if (!response.ok) throw new Error(`HTTP ${response.status}`);
+                return response.text();
+            })
+            .then(html => {
+                const plantilla = document.createElement('template');
+                plantilla.innerHTML = html;
+                plantilla.content.querySelectorAll('[id]').forEach(nuevo => {
+                    const actual = document.getElementById(nuevo.id);
+                    if (actual && elemento.contains(actual)) actual.replaceWith(nuevo);
+                });
+                elemento.dispatchEvent(new CustomEvent('fragmento-actualizado', { bubbles: true }));
+            })
+            .catch(error => console.error('Error al actualizar la página:', error));
+    };
+
+    const programar = (elemento) => {
+        clearTimeout(pendientes.get(elemento));
+        pendientes.set(elemento, setTimeout(() => {
+            pendientes.delete(elemento);
+            actualizar(elemento);
+        }, ESPERA_MS));
+    };
+
+    window.actualizarFragmento = programar;
+
+    document.addEventListener('DOMContentLoaded', () => {
+        const elementos = Array.from(document.querySelectorAll('[data-fragmento][data-actualizar]'));
+        if (!elementos.length || !window.EventSource) return;
+
+        let caido = false;
+        const eventos = new EventSource('/eventos');
+        eventos.addEventListener('message', (event) => {
+            let aviso;
+            try {
+                aviso = JSON.parse(event.data);
+            } catch (error) {
+                return;
+            }
+            elementos.forEach(elemento => {
+                const tablas = elemento.dataset.actualizar.split(/\s+/);
+                if (aviso.tabla === '*' || tablas.includes(aviso.tabla)) programar(elemento);
+            });
+        });
+        eventos.addEventListener('error', () => { caido = true; });
+        eventos.addEventListener('open', () => {
+            // Mientras estuvo cortado se pudo perder cualquier aviso
+            if (caido) elementos.forEach(programar);
+            caido = false;
+        });
+    });
+})();
@@ -1,9 +1,13 @@
 document.addEventListener('DOMContentLoaded', function() {
+    // Los eventos de las filas se escuchan en la tabla: el cuerpo se reemplaza
+    // cuando otro usuario modifica fletes (static/js/cambios.js)
+    const fletesTable = document.getElementById('fletes-table');
+
     // --- Script existente para guardar KM ---
-    const saveButtons = document.querySelectorAll('.save-km');
-    saveButtons.forEach(button => {
-        button.addEventListener('click', function() {
-            const row = this.closest('tr');
+    fletesTable.addEventListener('click', function(event) {
+        const button = event.target.closest('.save-km');
+        if (button) {
+            const row = button.closest('tr');
             const id = row.dataset.id;
             const kmInput = row.querySelector('.km-input');
             const km = kmInput.value;
@@ -28,28 +32,54 @@ document.addEventListener('DOMContentLoaded', function() {
                 console.error('Error:', error);
                 alert('Ocurrió un error de red.');
             });
-        });
+        }
     });
 
+    // --- Índice de distancias por ruta (origen|destino) ---
+    const destinoFlete = (ctg, categoria) => {
+        if (ctg && ctg.startsWith('102')) return 'ROSARIO';
+        if (ctg && ctg.startsWith('101')) return 'ARRIMES';
+        return categoria || '';
+    };
+    const kmAtipico = (ruta, km) => {
+        const distancia = distanciasRutas[ruta];
+        if (!distancia || isNaN(km)) return false;
+        return km <= 0 || km < distancia.minimo || km > distancia.maximo;
+    };
+    const marcarKm = (input, ruta) => {
+        const km = parseInt(input.value, 10);
+        const atipico = kmAtipico(ruta, km);
+        input.classList.toggle('km-atipico', atipico);
+        input.title = atipico ? `Habitual para esta ruta: ${distanciasRutas[ruta].km} km` : '';
+    };
+    const marcarFilas = () => {
+        fletesTable.querySelectorAll('tr[data-ruta] .km-input').forEach(input => marcarKm(input, input.closest('tr').dataset.ruta));
+    };
+
     // --- Script existente para total KM ---
-    const kmInputs = document.querySelectorAll('.km-input');
-    const totalKmCell = document.getElementById('total-km');
     const updateAndFormatTotal = () => {
         let total = 0;
-        kmInputs.forEach(input => {
+        fletesTable.querySelectorAll('.km-input').forEach(input => {
             const value = parseInt(input.value, 10);
             if (!isNaN(value)) {
                 total += value;
             }
         });
-        totalKmCell.innerHTML = `<strong>${total.toLocaleString('es-AR')}</strong>`;
+        document.getElementById('total-km').innerHTML = `<strong>${total.toLocaleString('es-AR')}</strong>`;
     };
-    kmInputs.forEach(input => {
-        input.addEventListener('input', () => {
+    fletesTable.addEventListener('input', function(event) {
+        const input = event.target;
+        if (input.classList.contains('km-input')) {
             input.value = input.value.replace(/\D/g, '');
+            marcarKm(input, input.closest('tr').dataset.ruta);
             updateAndFormatTotal();
-        });
+        }
+    });
+    fletesTable.addEventListener('fragmento-actualizado', () => {
+        marcarFilas();
+        updateAndFormatTotal();
     });
+    marcarFilas();
     updateAndFormatTotal();
 
     // --- Nuevo script para el modal de edición/creación ---
@@ -57,14 +87,52 @@ document.addEventListener('DOMContentLoaded', function() {
     const fleteModal = new bootstrap.Modal(fleteModalEl);
     const modalTitle = document.getElementById("fleteModalLabel");
     const newFleteBtn = document.getElementById("new-flete-btn");
-    const editButtons = document.querySelectorAll(".edit-flete-btn");
     const fleteForm = document.getElementById("fleteForm");
     const deleteFleteBtn = document.getElementById("deleteFleteBtn");
     const saveBtn = fleteModalEl.querySelector(".save-btn");
 
+    // Completar y validar los km del modal con la distancia habitual de la ruta
+    const kmInput = document.getElementById('g_kilomet');
+    const kmAyuda = document.getElementById('g_kilomet_ayuda');
+    let kmAutocompletado = false;
+    const rutaModal = () => {
+        const localidad = document.getElementById('g_ctaplade');
+        const opcion = localidad.options[localidad.selectedIndex];
+        const origen = opcion && opcion.value ? opcion.text.trim() : '';
+        const destino = destinoFlete(document.getElementById('g_ctg').value.trim(), document.getElementById('categoria').value);
+        return `${origen}|${destino}`;
+    };
+    const actualizarKmModal = (completar) => {
+        const ruta = rutaModal();
+        const distancia = distanciasRutas[ruta];
+        if (completar && distancia && (kmInput.value === '' || kmAutocompletado)) {
+            kmInput.value = distancia.km;
+            kmAutocompletado = true;
+        }
+        const km = parseInt(kmInput.value, 10);
+        if (!distancia) {
+            kmAyuda.textContent = '';
+        } else if (kmAtipico(ruta, km)) {
+            kmAyuda.textContent = `Atención: lo habitual para esta ruta es ${distancia.km} km (${distancia.minimo}–${distancia.maximo}, ${distancia.viajes} viajes).`;
+        } else {
+            kmAyuda.textContent = `Habitual para esta ruta: ${distancia.km} km (${distancia.viajes} viajes).`;
+        }
+        kmInput.classList.toggle('km-atipico', kmAtipico(ruta, km));
+    };
+    ['g_ctaplade', 'categoria', 'g_ctg'].forEach(id => {
+        document.getElementById(id).addEventListener('change', () => actualizarKmModal(true));
+    });
+    kmInput.addEventListener('input', () => {
+        kmAutocompletado = false;
+        actualizarKmModal(false);
+    });
+
     // Form validation on submit
     fleteForm.addEventListener('submit', function(event) {
-        
+        if (kmAtipico(rutaModal(), parseInt(kmInput.value, 10)) &&
+            !confirm('Los kilómetros están fuera del rango habitual para esta ruta. ¿Guardar igual?')) {
+            event.preventDefault();
+        }
     });
 
     // Open modal for new flete
@@ -75,13 +143,16 @@ document.addEventListener('DOMContentLoaded', function() {
         deleteFleteBtn.style.display = "none";
         saveBtn.textContent = "Guardar Flete";
         document.getElementById('g_fecha').value = new Date().toISOString().slice(0, 10);
+        kmAutocompletado = false;
+        actualizarKmModal(false);
         fleteModal.show();
     });
 
     // Open modal for editing flete
-    editButtons.forEach(button => {
-        button.addEventListener("click", function() {
-            const fleteId = this.dataset.id;
+    fletesTable.addEventListener("click", function(event) {
+        const button = event.target.closest(".edit-flete-btn");
+        if (button) {
+            const fleteId = button.dataset.id;
             
             fetch(`/fletes/${fleteId}`)
                 .then(response => response.json())
@@ -99,16 +170,18 @@ document.addEventListener('DOMContentLoaded', function() {
                     // Populate form
                     document.getElementById("g_fecha").value = data.g_fecha.split(' ')[0]; // Handle date format if needed
                     document.getElementById("g_ctg").value = data.g_ctg;
-                    document.getElementById("g_cuilchof").value = data.g_cuilchof;
+                    seleccionarBusqueda(document.getElementById("g_cuilchof"), data.g_cuilchof);
                     document.getElementById("g_codi").value = data.g_codi;
                     document.getElementById("g_cose").value = data.g_cose;
-                    document.getElementById("g_ctaplade").value = data.g_ctaplade;
+                    const localidadCargada = seleccionarBusqueda(document.getElementById("g_ctaplade"), data.g_ctaplade);
                     document.getElementById("categoria").value = data.categoria;
                     document.getElementById("o_peso").value = data.o_peso;
                     document.getElementById("o_neto").value = data.o_neto;
 
                     document.getElementById("g_tarflet").value = data.g_tarflet;
                     document.getElementById("g_kilomet").value = data.g_kilomet;
+                    kmAutocompletado = false;
+                    localidadCargada.then(() => actualizarKmModal(false));
 
                     // Set form actions
                     fleteForm.action = `/fletes/edit/${fleteId}`;
@@ -122,7 +195,7 @@ document.addEventListener('DOMContentLoaded', function() {
                     console.error('Error fetching flete data:', error);
                     alert('No se pudieron cargar los datos del flete.');
                 });
-        });
+        }
     });
 
     // Delete button handler
@@ -184,15 +184,77 @@ document.addEventListener('DOMContentLoaded', function() {
     const asignarViajeForm = document.getElementById('asignarViajeForm');
     const confirmarAsignacionBtn = document.getElementById('confirmarAsignacionBtn');
     const cupoIdInput = document.getElementById('cupoIdInput');
-    const cuposSolicitadosTableBody = document.querySelector('#cupos-solicitados-table tbody'); // Asumiendo que la tabla tiene id="cupos-solicitados-table"
+    // Los eventos se escuchan en la tabla y no en el tbody: las filas se reemplazan
+    // cuando otro usuario modifica cupos (static/js/cambios.js)
+    const cuposSolicitadosTable = document.getElementById('cupos-solicitados-table');
 
-    if(cuposSolicitadosTableBody) {
-        cuposSolicitadosTableBody.addEventListener('click', function(event) {
+    // Los viajes se buscan en el servidor a medida que se escribe (/fletes/buscar),
+    // en lugar de cargar todos los fletes en la página.
+    const fleteBuscarInput = document.getElementById('fleteBuscar');
+    const fleteFechaInput = document.getElementById('fleteFecha');
+    const fleteSelect = document.getElementById('fleteSelect');
+    const fleteMasBtn = document.getElementById('fleteMasBtn');
+    let fleteSiguienteOffset = null;
+    let fleteBusquedaTimer = null;
+
+    function buscarFletes(offset) {
+        const texto = fleteBuscarInput.value.trim();
+        const params = new URLSearchParams({ offset: offset });
+        if (/^\d+$/.test(texto)) {
+            params.append('ctg', texto);
+        } else if (texto) {
+            params.append('chofer', texto);
+        }
+        if (fleteFechaInput.value) {
+            params.append('fecha', fleteFechaInput.value);
+        }
+
+        fetch(`/fletes/buscar?${params.toString()}`)
+        .then(response => response.json())
+        .then(data => {
+            if (data.error) {
+                alert('Error al buscar viajes: ' + data.error);
+                return;
+            }
+            if (offset === 0) {
+                fleteSelect.innerHTML = '';
+            }
+            data.fletes.forEach(flete => {
+                const option = document.createElement('option');
+                option.value = flete.id;
+                option.textContent = `${flete.g_fecha} - ${flete.g_ctg} - ${flete.o_neto} kg` + (flete.chofer ? ` - ${flete.chofer}` : '');
+                fleteSelect.appendChild(option);
+            });
+            fleteSiguienteOffset = data.siguiente_offset;
+            fleteMasBtn.classList.toggle('d-none', fleteSiguienteOffset === null);
+        })
+        .catch(error => {
+            console.error('Error:', error);
+        });
+    }
+
+    function programarBusquedaFletes() {
+        clearTimeout(fleteBusquedaTimer);
+        fleteBusquedaTimer = setTimeout(() => buscarFletes(0), 300);
+    }
+
+    fleteBuscarInput.addEventListener('input', programarBusquedaFletes);
+    fleteFechaInput.addEventListener('change', programarBusquedaFletes);
+    fleteMasBtn.addEventListener('click', function() {
+        if (fleteSiguienteOffset !== null) {
+            buscarFletes(fleteSiguienteOffset);
+        }
+    });
+
+    if(cuposSolicitadosTable) {
+        cuposSolicitadosTable.addEventListener('click', function(event) {
             const target = event.target;
             if (target.classList.contains('asignar-viaje-btn')) {
                 const row = target.closest('tr');
                 const cupoId = row.dataset.cupoId;
+                asignarViajeForm.reset();
                 cupoIdInput.value = cupoId;
+                buscarFletes(0);
                 asignarViajeModal.show();
             }
         });
@@ -217,7 +279,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 if (data.success) {
                     asignarViajeModal.hide();
                     // Eliminar la fila de la tabla
-                    const row = document.querySelector(`tr[data-cupo-id="${cupoId}"]`);
+                    const row = document.querySelector(`#cupos-solicitados-table tr[data-cupo-id="${cupoId}"]`);
                     if (row) {
                         row.remove();
                     }
@@ -228,63 +290,216 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     });
 
+    // Operaciones de cupos por lote: los cambios se acumulan y se envían juntos
+    // a /cupos/bulk, que los aplica en una sola transacción.
+    const operacionesCupos = { codigos: {}, eliminar: [] };
+    let operacionesCuposTimer = null;
+
+    // Si el envío no llega al servidor (error de red), el lote vuelve a la cola
+    // para el próximo envío; un código editado de nuevo mientras tanto vale más
+    // que el del lote. Un lote que el servidor rechaza no se reintenta: fallaría
+    // igual y trabaría todos los envíos siguientes.
+    function devolverOperacionesCupos(lote) {
+        lote.codigos.forEach(({ cupo_id, codigo_cupo }) => {
+            if (!(cupo_id in operacionesCupos.codigos)) {
+                operacionesCupos.codigos[cupo_id] = codigo_cupo;
+            }
+        });
+        lote.eliminar.forEach(cupoId => {
+            if (!operacionesCupos.eliminar.includes(cupoId)) {
+                operacionesCupos.eliminar.push(cupoId);
+            }
+        });
+    }
+
+    function enviarOperacionesCupos() {
+        clearTimeout(operacionesCuposTimer);
+        const lote = {
+            codigos: Object.entries(operacionesCupos.codigos).map(([cupoId, codigo]) => ({ cupo_id: cupoId, codigo_cupo: codigo })),
+            eliminar: operacionesCupos.eliminar.slice()
+        };
+        if (lote.codigos.length === 0 && lote.eliminar.length === 0) {
+            return Promise.resolve({ success: true });
+        }
+        operacionesCupos.codigos = {};
+        operacionesCupos.eliminar = [];
+
+        return fetch('/cupos/bulk', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify(lote),
+        })
+        .then(response => response.json()
+            .catch(() => ({ success: false, error: `Respuesta inválida del servidor (HTTP ${response.status}).` }))
+            .then(data => {
+                if (data.success) {
+                    lote.eliminar.forEach(cupoId => {
+                        const row = document.querySelector(`#cupos-solicitados-table tr[data-cupo-id="${cupoId}"]`);
+                        if (row) {
+                            row.remove();
+                        }
+                    });
+                } else {
+                    alert('Error al guardar los cambios de cupos: ' + data.error + '\nNo se guardó ninguno de los cambios del envío; la tabla se vuelve a cargar.');
+                    if (cuposSolicitadosTable && window.actualizarFragmento) {
+                        window.actualizarFragmento(cuposSolicitadosTable);
+                    }
+                }
+                return data;
+            }),
+        error => {
+            console.error('Error:', error);
+            devolverOperacionesCupos(lote);
+            alert('Ocurrió un error de red. Los cambios de cupos quedan pendientes y se reintentan con el próximo envío.');
+            return { success: false, error: String(error) };
+        });
+    }
+
+    function programarEnvioCupos() {
+        clearTimeout(operacionesCuposTimer);
+        operacionesCuposTimer = setTimeout(enviarOperacionesCupos, 800);
+    }
+
+    // Si quedan cambios pendientes al salir de la página, se envían igual.
+    window.addEventListener('beforeunload', function() {
+        const codigos = Object.entries(operacionesCupos.codigos).map(([cupoId, codigo]) => ({ cupo_id: cupoId, codigo_cupo: codigo }));
+        if (codigos.length > 0 || operacionesCupos.eliminar.length > 0) {
+            const lote = JSON.stringify({ codigos: codigos, eliminar: operacionesCupos.eliminar });
+            navigator.sendBeacon('/cupos/bulk', new Blob([lote], { type: 'application/json' }));
+        }
+    });
+
     // Lógica para guardar el código de cupo
-    if(cuposSolicitadosTableBody) {
-        cuposSolicitadosTableBody.addEventListener('blur', function(event) {
+    if(cuposSolicitadosTable) {
+        cuposSolicitadosTable.addEventListener('blur', function(event) {
             const target = event.target;
             if (target.classList.contains('codigo-cupo-input')) {
                 const row = target.closest('tr');
-                const cupoId = row.dataset.cupoId;
-                const codigoCupo = target.value;
-
-                const data = { cupo_id: cupoId, codigo_cupo: codigoCupo };
-
-                fetch('/cupos/update_codigo', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json',
-                    },
-                    body: JSON.stringify(data),
-                })
-                .then(response => response.json())
-                .then(data => {
-                    if (!data.success) {
-                        alert('Error al guardar el código de cupo.');
-                    }
-                });
+                operacionesCupos.codigos[row.dataset.cupoId] = target.value;
+                programarEnvioCupos();
             }
         }, true); // Use event capturing to handle blur events
     }
 
     // Lógica para eliminar un cupo solicitado
-    if(cuposSolicitadosTableBody) {
-        cuposSolicitadosTableBody.addEventListener('click', function(event) {
+    if(cuposSolicitadosTable) {
+        cuposSolicitadosTable.addEventListener('click', function(event) {
             const target = event.target;
             if (target.classList.contains('delete-cupo-btn')) {
                 const row = target.closest('tr');
-                const cupoId = row.dataset.cupoId;
 
                 if (confirm('¿Está seguro de que desea eliminar este pedido de cupo?')) {
-                    fetch(`/cupos/delete/${cupoId}`, {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/json',
-                        }
-                    })
-                    .then(response => response.json())
-                    .then(data => {
-                        if (data.success) {
+                    operacionesCupos.eliminar.push(row.dataset.cupoId);
+                    enviarOperacionesCupos();
+                }
+            }
+        });
+    }
+
+    // Eliminar todos los cupos seleccionados en un solo envío
+    const eliminarSeleccionadosBtn = document.getElementById('eliminarCuposSeleccionadosBtn');
+    if (eliminarSeleccionadosBtn) {
+        eliminarSeleccionadosBtn.addEventListener('click', function() {
+            const seleccionados = Array.from(document.querySelectorAll('.cupo-select:checked'))
+                .map(checkbox => checkbox.closest('tr').dataset.cupoId);
+            if (seleccionados.length === 0) {
+                alert('No hay cupos seleccionados.');
+                return;
+            }
+            if (confirm(`¿Está seguro de que desea eliminar ${seleccionados.length} pedido/s de cupo?`)) {
+                operacionesCupos.eliminar.push(...seleccionados);
+                enviarOperacionesCupos();
+            }
+        });
+    }
+
+    const seleccionarTodosCupos = document.getElementById('seleccionarTodosCupos');
+    if (seleccionarTodosCupos) {
+        seleccionarTodosCupos.addEventListener('change', function() {
+            document.querySelectorAll('.cupo-select').forEach(checkbox => {
+                checkbox.checked = seleccionarTodosCupos.checked;
+            });
+        });
+    }
+    // Propuesta automática de asignación de cupos a viajes (/cupos/propuestas).
+    // Las propuestas aceptadas se guardan juntas con /cupos/bulk.
+    const proponerAsignacionesBtn = document.getElementById('proponerAsignacionesBtn');
+    const propuestasModalEl = document.getElementById('propuestasModal');
+    if (proponerAsignacionesBtn && propuestasModalEl) {
+        const propuestasModal = new bootstrap.Modal(propuestasModalEl);
+        const propuestasTableBody = document.querySelector('#propuestasTable tbody');
+        const seleccionarTodasPropuestas = document.getElementById('seleccionarTodasPropuestas');
+
+        proponerAsignacionesBtn.addEventListener('click', function() {
+            fetch('/cupos/propuestas')
+            .then(response => response.json())
+            .then(data => {
+                if (data.error) {
+                    alert('Error al calcular las propuestas: ' + data.error);
+                    return;
+                }
+                propuestasTableBody.innerHTML = '';
+                data.propuestas.forEach(p => {
+                    const row = document.createElement('tr');
+                    row.dataset.cupoId = p.cupo_id;
+                    row.dataset.fleteId = p.flete_id;
+                    row.innerHTML = `<td><input type="checkbox" class="propuesta-select" checked></td>
+                        <td>${p.contrato}</td><td>${p.grano}</td><td>${p.fecha_cupo}</td>
+                        <td>${p.ctg}</td><td>${p.fecha_flete}</td>
+                        <td>${p.criterio === 'contrato' ? 'Contrato' : 'Grano/Cosecha'}</td>`;
+                    propuestasTableBody.appendChild(row);
+                });
+                document.getElementById('propuestasResumen').textContent =
+                    `${data.propuestas.length} propuesta/s para ${data.cupos_abiertos} cupo/s abierto/s y ${data.fletes_libres} viaje/s sin asignar.`;
+                seleccionarTodasPropuestas.checked = true;
+                propuestasModal.show();
+            })
+            .catch(error => {
+                console.error('Error:', error);
+                alert('Ocurrió un error de red.');
+            });
+        });
+
+        seleccionarTodasPropuestas.addEventListener('change', function() {
+            propuestasTableBody.querySelectorAll('.propuesta-select').forEach(checkbox => {
+                checkbox.checked = seleccionarTodasPropuestas.checked;
+            });
+        });
+
+        document.getElementById('aceptarPropuestasBtn').addEventListener('click', function() {
+            const asignar = Array.from(propuestasTableBody.querySelectorAll('.propuesta-select:checked'))
+                .map(checkbox => {
+                    const row = checkbox.closest('tr');
+                    return { cupo_id: row.dataset.cupoId, flete_id: row.dataset.fleteId };
+                });
+            if (asignar.length === 0) {
+                propuestasModal.hide();
+                return;
+            }
+
+            fetch('/cupos/bulk', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({ asignar: asignar }),
+            })
+            .then(response => response.json())
+            .then(data => {
+                if (data.success) {
+                    propuestasModal.hide();
+                    asignar.forEach(a => {
+                        const row = document.querySelector(`#cupos-solicitados-table tr[data-cupo-id="${a.cupo_id}"]`);
+                        if (row) {
                             row.remove();
-                        } else {
-                            alert('Error al eliminar el cupo: ' + data.error);
                         }
-                    })
-                    .catch(error => {
-                        console.error('Error:', error);
-                        alert('Ocurrió un error de red.');
                     });
+                } else {
+                    alert('Error al asignar los viajes: ' + data.error);
                 }
-            }
+            });
         });
     }
 });
\ No newline at end of file
@@ -1,8 +1,17 @@
 import psycopg2
 from psycopg2 import sql
+from psycopg2.extras import execute_values
 from dbfread import DBF
 import datetime
 import os
+import sys
+from decimal import Decimal
+
+from valuacion_combustible import refresh_valuacion_combustible
+from precios_granos import refresh_precios_granos
+from pronostico_entregas import refresh_pronostico_entregas
+from busqueda import refresh_busqueda
+from notificaciones import notificar
 
 # --- CONFIGURACIÓN ---
 # Ruta base donde se encuentran los archivos .dbf
@@ -46,173 +55,1041 @@ def clean_numeric(n):
     except (ValueError, TypeError):
         return None
 
+# --- NORMALIZACIÓN DE CLAVES Y TEXTOS ---
+# Los DBF guardan los textos con ancho fijo (rellenos con espacios) y algunos
+# números de contrato como campos numéricos. Se limpian una sola vez al cargar
+# para que la aplicación una las tablas por igualdad, con índices comunes, sin
+# TRIM() en las consultas ni .strip() al leer.
+COLUMNAS_NUMERICAS = {
+    'G_SALDO', 'PESO', 'NET_CTA', 'BRU_C', 'IVA_C', 'PREOPE', 'OTR_GAS', 'IVA_GAS', 'GAS_COM', 'IVA_COM',
+    'GAS_VAR', 'IVA_VAR', 'G_STOK', 'KILOPED_C', 'ENTREGA_C', 'LIQUIYA_C', 'O_PESO', 'O_NETO',
+    'G_TARFLET', 'G_KILOMETR', 'IMP_F'
+}
+# Número de contrato en contrat, acocarpo y liqven: siempre texto, sin ".0" si el DBF lo guarda como número
+COLUMNAS_CONTRATO = {'NROCONT_C', 'G_CONTRATO', 'CONTRATO'}
+# Códigos que la aplicación compara en mayúsculas
+COLUMNAS_CODIGO = {'TIP_F', 'G_CONFIRM'}
+
+# Columnas que se leen de cada DBF (el archivo es <tabla>.dbf)
+COLUMNAS_DBF = {
+    'acocarpo': ['G_FECHA', 'G_CONTRATO', 'G_CODI', 'G_COSE', 'G_SALDO', 'G_CONFIRM', 'G_ROMAN', 'G_CTG', 'G_DESTINO'],
+    'liqven': ['FEC_C', 'CONTRATO', 'PESO', 'NET_CTA', 'NOM_C', 'FAC_C', 'FA1_C', 'BRU_C', 'IVA_C', 'PREOPE', 'OTR_GAS', 'IVA_GAS', 'GAS_COM', 'IVA_COM', 'GAS_VAR', 'IVA_VAR'],
+    'acogran': ['G_CODI', 'G_DESC'],
+    'acograst': ['G_CODI', 'G_COSE', 'G_STOK'],
+    'contrat': ['NROCONT_C', 'KILOPED_C', 'ENTREGA_C', 'LIQUIYA_C', 'COSECHA_C', 'PRODUCT_C', 'APELCOM_C', 'FECONT_C'],
+    'acohis': ['G_FECHA', 'G_CTG', 'G_CODI', 'G_COSE', 'O_PESO', 'O_NETO', 'G_TARFLET', 'G_KILOMETR', 'G_CTAPLADE', 'G_CUILCHOF', 'G_CUITRAN', 'G_CTL', 'CLI_C', 'G_LOCALI'],
+    'sysmae': ['CLI_C', 'S_APELLI', 'S_LOCALI', 'S_ZONACU'],
+    'choferes': ['C_DOCUMENT', 'C_NOMBRE'],
+    'ccbcta': ['VTO_F', 'TIP_F', 'IMP_F', 'CLI_F', 'FA1_F', 'FAC_F', 'CTA_P'],
+}
+TABLAS_DBF = tuple(COLUMNAS_DBF)
+
+# Las sincronizaciones (completa e incremental) cargan sólo desde este año en
+# las tablas con fecha. La historia anterior se carga aparte, por años, con backfill_db.py.
+ANIO_CORTE = 2023
+CAMPOS_FECHA = {'acohis': 'G_FECHA', 'liqven': 'FEC_C', 'ccbcta': 'VTO_F', 'acocarpo': 'G_FECHA', 'contrat': 'FECONT_C'}
+# Estructura de cada tabla ({} es el nombre: la tabla real o su tabla de carga)
+ESQUEMAS_DBF = {
+    'acocarpo': """CREATE TABLE IF NOT EXISTS {} (
+        G_FECHA DATE, G_CONTRATO VARCHAR(255), G_CODI VARCHAR(255), G_COSE VARCHAR(255),
+        G_SALDO NUMERIC, G_CONFIRM VARCHAR(1), G_ROMAN VARCHAR(255), G_CTG VARCHAR(255), G_DESTINO VARCHAR(255)
+    );""",
+    'liqven': """CREATE TABLE IF NOT EXISTS {} (
+        FEC_C DATE, CONTRATO VARCHAR(255), PESO NUMERIC, NET_CTA NUMERIC, NOM_C VARCHAR(255), FAC_C VARCHAR(255),
+        FA1_C VARCHAR(255), BRU_C NUMERIC, IVA_C NUMERIC, PREOPE NUMERIC, OTR_GAS NUMERIC, IVA_GAS NUMERIC,
+        GAS_COM NUMERIC, IVA_COM NUMERIC, GAS_VAR NUMERIC, IVA_VAR NUMERIC
+    );""",
+    'acogran': "CREATE TABLE IF NOT EXISTS {} (G_CODI VARCHAR(255) PRIMARY KEY, G_DESC VARCHAR(255));",
+    'acograst': "CREATE TABLE IF NOT EXISTS {} (G_CODI VARCHAR(255), G_COSE VARCHAR(255), G_STOK NUMERIC, PRIMARY KEY (G_CODI, G_COSE));",
+    'contrat': """CREATE TABLE IF NOT EXISTS {} (
+        NROCONT_C VARCHAR(255) PRIMARY KEY, KILOPED_C NUMERIC, ENTREGA_C NUMERIC, LIQUIYA_C NUMERIC,
+        COSECHA_C VARCHAR(255), PRODUCT_C VARCHAR(255), APELCOM_C VARCHAR(255), FECONT_C DATE
+    );""",
+    'acohis': """CREATE TABLE IF NOT EXISTS {} (
+        G_FECHA DATE, G_CTG VARCHAR(255), G_CODI VARCHAR(255), G_COSE VARCHAR(255), O_PESO NUMERIC, O_NETO NUMERIC,
+        G_TARFLET NUMERIC, G_KILOMETR NUMERIC, G_CTAPLADE VARCHAR(255), G_CUILCHOF VARCHAR(255), G_CUITRAN VARCHAR(255),
+        G_CTL VARCHAR(255), CLI_C VARCHAR(255), G_LOCALI VARCHAR(255)
+    );""",
+    'sysmae': "CREATE TABLE IF NOT EXISTS {} (CLI_C VARCHAR(255) PRIMARY KEY, S_APELLI VARCHAR(255), S_LOCALI VARCHAR(255), S_ZONACU VARCHAR(255));",
+    'choferes': "CREATE TABLE IF NOT EXISTS {} (C_DOCUMENT VARCHAR(255) PRIMARY KEY, C_NOMBRE VARCHAR(255));",
+    'ccbcta': """CREATE TABLE IF NOT EXISTS {} (
+        VTO_F DATE, TIP_F VARCHAR(255), IMP_F NUMERIC, CLI_F VARCHAR(255),
+        FA1_F VARCHAR(255), FAC_F VARCHAR(255), CTA_P VARCHAR(255)
+    );""",
+}
+# Clave primaria de las tablas que la tienen
+CLAVES_DBF = {
+    'acogran': ['G_CODI'],
+    'acograst': ['G_CODI', 'G_COSE'],
+    'contrat': ['NROCONT_C'],
+    'sysmae': ['CLI_C'],
+    'choferes': ['C_DOCUMENT'],
+}
+# Columnas de tablas propias que se unen con claves de los DBF
+CLAVES_TABLAS_PROPIAS = {
+    'fletes': ['g_ctg', 'g_codi', 'g_cose', 'g_ctaplade', 'g_cuilchof'],
+    'combustible_movimientos': ['proveedor_id', 'chofer_documento'],
+}
+
+def clean_text(s):
+    """Quita el relleno de espacios de los textos del DBF."""
+    if isinstance(s, str):
+        return s.strip()
+    return s
+
+def clean_contrato(n):
+    """Número de contrato como texto recortado (12345.0 -> '12345')."""
+    if n is None:
+        return None
+    if isinstance(n, (int, float, Decimal)):
+        return str(int(n)) if n == int(n) else str(n)
+    return str(n).strip()
+
+def limpiar_registro(rec, columns):
+    """Valores de un registro DBF listos para insertar, en el orden de 'columns'."""
+    values = []
+    for col in columns:
+        val = rec.get(col)
+        col_upper = col.upper()
+        if 'FECHA' in col_upper or 'FEC_' in col_upper or 'VTO_' in col_upper:
+            values.append(clean_date(val))
+        elif col_upper in COLUMNAS_NUMERICAS:
+            values.append(clean_numeric(val))
+        elif col_upper in COLUMNAS_CONTRATO:
+            values.append(clean_contrato(val))
+        elif col_upper in COLUMNAS_CODIGO:
+            val = clean_text(val)
+            values.append(val.upper() if isinstance(val, str) else val)
+        else:
+            values.append(clean_text(val))
+    return tuple(values)
+
+def normalizar_textos(cursor, tablas=None):
+    """
+    Recorta (y pasa a mayúsculas los códigos) los textos ya guardados por
+    versiones anteriores de la carga. La sincronización completa recrea las
+    tablas, pero la actualización incremental hace upsert sobre las existentes:
+    sin esto, una clave vieja con espacios no coincidiría con la nueva.
+    Sólo toca las filas que cambian, así que después de la primera vez no hace nada.
+    Con 'tablas' sólo se revisan esas tablas DBF; si no, todas y también las
+    claves de las tablas propias.
+    """
+    cursor.execute("""
+        SELECT table_name, column_name
+        FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = ANY(%s)
+          AND data_type IN ('character varying', 'character', 'text')
+        ORDER BY table_name, ordinal_position
+    """, (list(TABLAS_DBF if tablas is None else tablas),))
+    columnas = [(rec[0], rec[1]) for rec in cursor.fetchall()]
+    if tablas is None:
+        columnas += [(tabla, columna) for tabla, lista in CLAVES_TABLAS_PROPIAS.items() for columna in lista]
+    total = 0
+    for tabla, columna in columnas:
+        expresion = "UPPER(TRIM({col}))" if columna.upper() in COLUMNAS_CODIGO else "TRIM({col})"
+        expresion = sql.SQL(expresion).format(col=sql.Identifier(columna))
+        # El savepoint evita que una clave duplicada al recortar aborte toda la sincronización.
+        cursor.execute("SAVEPOINT normalizar_textos")
+        try:
+            cursor.execute(sql.SQL("UPDATE {tabla} SET {col} = {expr} WHERE {col} <> {expr}").format(
+                tabla=sql.Identifier(tabla), col=sql.Identifier(columna), expr=expresion))
+            total += cursor.rowcount
+            cursor.execute("RELEASE SAVEPOINT normalizar_textos")
+        except Exception as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT normalizar_textos")
+            print(f"  [Error] No se pudo normalizar {tabla}.{columna}. Causa: {e}")
+    print(f"Textos normalizados. Valores corregidos: {total}.")
+
+# --- ÍNDICES SOBRE LAS TABLAS SINCRONIZADAS ---
+# Las tablas DBF se recrean en cada sincronización completa, por lo que los
+# índices deben volver a crearse después de la carga.
+INDICES = [
+    "CREATE INDEX IF NOT EXISTS idx_ccbcta_cli_vto ON ccbcta (cli_f, vto_f)",
+    "CREATE INDEX IF NOT EXISTS idx_acocarpo_contrato_fecha ON acocarpo (g_contrato, g_fecha)",
+    "CREATE INDEX IF NOT EXISTS idx_liqven_contrato_fecha ON liqven (contrato, fec_c)",
+    # Consulta de entregas: el comprador se resuelve uniendo contrat por número de contrato.
+    "CREATE INDEX IF NOT EXISTS idx_acocarpo_fecha ON acocarpo (g_fecha)",
+    # Las claves llegan recortadas desde la carga (ver limpiar_registro), así que
+    # alcanzan índices comunes: el contrato de acocarpo usa idx_acocarpo_contrato_fecha
+    # y el de contrat su clave primaria.
+    "CREATE INDEX IF NOT EXISTS idx_contrat_comprador ON contrat (apelcom_c)",
+    # Búsqueda de viajes (/fletes/buscar): prefijo de CTG, chofer y orden por fecha.
+    "CREATE INDEX IF NOT EXISTS idx_fletes_ctg_prefijo ON fletes (g_ctg varchar_pattern_ops)",
+    "CREATE INDEX IF NOT EXISTS idx_fletes_fecha ON fletes (g_fecha DESC, id DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_fletes_chofer ON fletes (g_cuilchof varchar_pattern_ops)",
+    # Propuesta de asignación de cupos: contrato de cada flete por CTG y fletes ya asignados.
+    "CREATE INDEX IF NOT EXISTS idx_acocarpo_ctg ON acocarpo (g_ctg)",
+    "CREATE INDEX IF NOT EXISTS idx_cupos_flete ON cupos_solicitados (flete_id)",
+    # Stock de combustible a una fecha: delta desde el último cierre mensual.
+    "CREATE INDEX IF NOT EXISTS idx_combustible_mov_fecha ON combustible_movimientos (fecha)",
+    "CREATE INDEX IF NOT EXISTS idx_combustible_mov_chofer ON combustible_movimientos (chofer_documento, fecha)",
+]
+
+# Índices sobre TRIM() de versiones anteriores, que ya no usa ninguna consulta.
+INDICES_OBSOLETOS = [
+    "idx_acocarpo_contrato_trim",
+    "idx_contrat_nrocont_trim",
+    "idx_contrat_comprador_trim",
+    "idx_acocarpo_ctg_trim",
+]
+
+def crear_indices(cursor):
+    """Crea (si no existen) los índices usados por las consultas de la aplicación."""
+    for nombre in INDICES_OBSOLETOS:
+        cursor.execute(sql.SQL("DROP INDEX IF EXISTS {}").format(sql.Identifier(nombre)))
+    for create_index_sql in INDICES:
+        # El savepoint evita que un índice fallido aborte toda la transacción de la sincronización.
+        cursor.execute("SAVEPOINT crear_indice")
+        try:
+            cursor.execute(create_index_sql)
+            cursor.execute("RELEASE SAVEPOINT crear_indice")
+        except Exception as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT crear_indice")
+            print(f"  [Error] No se pudo crear el índice: {create_index_sql}. Causa: {e}")
+    print("Índices creados o ya existentes.")
+
+def reiniciar_backfill(cursor, tabla):
+    """La tabla se recreó sin historia: backfill_db.py debe volver a cargar todos sus años."""
+    cursor.execute("SELECT to_regclass('backfill_progreso') IS NOT NULL")
+    if cursor.fetchone()[0]:
+        cursor.execute("DELETE FROM backfill_progreso WHERE tabla = %s", (tabla,))
+
+# --- TABLAS DERIVADAS (RESÚMENES PRECALCULADOS) ---
+
+def refresh_ccbcta_abierta(cursor):
+    """
+    Recalcula la tabla 'ccbcta_abierta' con los comprobantes de ccbcta que siguen
+    impagos. El saldo de cada cliente (vencimientos - cobranzas) se imputa a sus
+    comprobantes más recientes mediante una suma acumulada, de modo que los pagos
+    cancelan primero la deuda más antigua. La tabla resultante sólo contiene deuda
+    abierta, por lo que su tamaño no crece con el historial de ccbcta.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS ccbcta_abierta (
+        cli_f VARCHAR(255), vto_f DATE, tip_f VARCHAR(255), fa1_f VARCHAR(255), fac_f VARCHAR(255),
+        imp_f NUMERIC, saldo_abierto NUMERIC
+    );""")
+    cursor.execute("DELETE FROM ccbcta_abierta")
+    cursor.execute("""
+        WITH movimientos AS (
+            SELECT cli_f, vto_f, tip_f, fa1_f, fac_f, COALESCE(imp_f, 0) AS imp_f
+            FROM ccbcta
+            WHERE cli_f IS NOT NULL AND vto_f IS NOT NULL
+        ),
+        saldos AS (
+            SELECT cli_f,
+                   SUM(CASE WHEN tip_f IN ('LF', 'LP', 'FA') THEN imp_f ELSE 0 END)
+                 - SUM(CASE WHEN tip_f IN ('RI', 'SI', 'SG', 'SB') THEN imp_f ELSE 0 END) AS saldo
+            FROM movimientos
+            GROUP BY cli_f
+        ),
+        vencimientos AS (
+            SELECT m.cli_f, m.vto_f, m.tip_f, m.fa1_f, m.fac_f, m.imp_f, s.saldo,
+                   SUM(m.imp_f) OVER (
+                       PARTITION BY m.cli_f
+                       ORDER BY m.vto_f DESC, m.fa1_f DESC, m.fac_f DESC
+                       ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                   ) AS posteriores
+            FROM movimientos m
+            JOIN saldos s ON s.cli_f = m.cli_f
+            WHERE m.tip_f IN ('LF', 'LP', 'FA') AND s.saldo > 0
+        )
+        INSERT INTO ccbcta_abierta (cli_f, vto_f, tip_f, fa1_f, fac_f, imp_f, saldo_abierto)
+        SELECT cli_f, vto_f, tip_f, fa1_f, fac_f, imp_f,
+               LEAST(imp_f, saldo - COALESCE(posteriores, 0))
+        FROM vencimientos
+        WHERE saldo - COALESCE(posteriores, 0) > 0
+    """)
+    abiertos = cursor.rowcount
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ccbcta_abierta_vto ON ccbcta_abierta (vto_f)")
+    print(f"Tabla 'ccbcta_abierta' recalculada. Comprobantes con saldo abierto: {abiertos}.")
+
+def refresh_facetas(cursor):
+    """
+    Recalcula la tabla 'facetas': los valores distintos de cada dimensión que se
+    ofrece como filtro en Compras y Consultas (granos, cosechas, vendedores,
+    orígenes, compradores y contratos). La aplicación la lee una sola vez y la
+    mantiene en memoria, así los desplegables no recorren las tablas grandes.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS facetas (
+        dimension VARCHAR(50), valor VARCHAR(255), descripcion VARCHAR(255), orden INTEGER
+    );""")
+    cursor.execute("DELETE FROM facetas")
+    cursor.execute("""
+        INSERT INTO facetas (dimension, valor, descripcion, orden)
+        -- Compras (acohis, ingresos)
+        SELECT 'compras_grano', g.g_codi, g.g_desc, ROW_NUMBER() OVER (ORDER BY g.g_codi)
+        FROM acogran g
+        WHERE g.g_desc IS NOT NULL
+          AND g.g_codi IN (SELECT DISTINCT g_codi FROM acohis WHERE g_ctl = 'I' AND g_codi IS NOT NULL)
+        UNION ALL
+        SELECT 'compras_cosecha', g_cose, g_cose, ROW_NUMBER() OVER (ORDER BY g_cose DESC)
+        FROM (SELECT DISTINCT g_cose FROM acohis WHERE g_ctl = 'I' AND g_cose IS NOT NULL) x
+        UNION ALL
+        SELECT 'compras_vendedor', s.cli_c, s.s_apelli, ROW_NUMBER() OVER (ORDER BY s.cli_c)
+        FROM sysmae s
+        WHERE s.s_apelli IS NOT NULL
+          AND s.cli_c IN (SELECT DISTINCT cli_c FROM acohis WHERE g_ctl = 'I' AND cli_c IS NOT NULL)
+        UNION ALL
+        SELECT 'compras_origen', g_locali, g_locali, ROW_NUMBER() OVER (ORDER BY g_locali)
+        FROM (SELECT DISTINCT g_locali FROM acohis WHERE g_ctl = 'I' AND g_locali IS NOT NULL AND g_locali != '') x
+        UNION ALL
+        -- Consultas (entregas y cuenta corriente granaria)
+        SELECT 'grano', g_codi, g_desc, ROW_NUMBER() OVER (ORDER BY g_codi)
+        FROM acogran
+        WHERE g_codi IS NOT NULL AND g_desc IS NOT NULL
+        UNION ALL
+        SELECT 'entregas_cosecha', g_cose, g_cose, ROW_NUMBER() OVER (ORDER BY g_cose DESC)
+        FROM (SELECT DISTINCT g_cose FROM acocarpo WHERE g_cose IS NOT NULL) x
+        UNION ALL
+        SELECT 'comprador', apelcom_c, apelcom_c, ROW_NUMBER() OVER (ORDER BY apelcom_c)
+        FROM (SELECT DISTINCT apelcom_c FROM contrat WHERE apelcom_c IS NOT NULL) x
+        UNION ALL
+        SELECT 'contrato_granaria', g_contrato, g_contrato, ROW_NUMBER() OVER (ORDER BY g_contrato DESC)
+        FROM (
+            SELECT DISTINCT g_contrato FROM acocarpo
+            WHERE g_contrato IS NOT NULL
+              AND g_cose IN (SELECT DISTINCT g_cose FROM acocarpo WHERE g_cose IS NOT NULL ORDER BY g_cose DESC LIMIT 3)
+        ) x
+    """)
+    print(f"Tabla 'facetas' recalculada. Valores: {cursor.rowcount}.")
+
+def refresh_contract_summary(cursor, contratos=None):
+    """
+    Mantiene la tabla 'contract_summary' con un resumen por contrato: última
+    entrega, kilos y registros confirmados / no confirmados (acocarpo), kilos y
+    registros liquidados (liqven), grano, cosecha y comprador.
+
+    Si 'contratos' es None se recalcula la tabla completa (sincronización total).
+    Si es una colección, sólo se recalculan esos contratos (sincronización por
+    actualización), de modo que el costo depende de lo que cambió y no del historial.
+    """
+    cursor.execute("SELECT to_regclass('contract_summary') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        contratos = None  # Primera vez: hace falta la tabla completa
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS contract_summary (
+        contrato VARCHAR(255) PRIMARY KEY, ultima_entrega DATE,
+        kilos_confirmados NUMERIC, kilos_no_confirmados NUMERIC,
+        registros_confirmados INTEGER, registros_no_confirmados INTEGER,
+        kilos_liquidados NUMERIC, registros_liquidaciones INTEGER,
+        grano VARCHAR(255), cosecha VARCHAR(255), comprador VARCHAR(255)
+    );""")
+
+    params = {}
+    filtro_entregas = ""
+    filtro_liquidaciones = ""
+    if contratos is None:
+        cursor.execute("DELETE FROM contract_summary")
+    else:
+        params['contratos'] = [c for c in contratos if c]
+        if not params['contratos']:
+            print("Tabla 'contract_summary' sin contratos modificados.")
+            return
+        cursor.execute("DELETE FROM contract_summary WHERE contrato = ANY(%(contratos)s)", params)
+        filtro_entregas = "AND g_contrato = ANY(%(contratos)s)"
+        filtro_liquidaciones = "AND contrato = ANY(%(contratos)s)"
+
+    cursor.execute(f"""
+        WITH entregas AS (
+            SELECT g_contrato AS contrato,
+                   MAX(g_fecha) AS ultima_entrega,
+                   SUM(CASE WHEN g_confirm = 'S' THEN COALESCE(g_saldo, 0) ELSE 0 END) AS kilos_confirmados,
+                   SUM(CASE WHEN g_confirm = 'S' THEN 0 ELSE COALESCE(g_saldo, 0) END) AS kilos_no_confirmados,
+                   COUNT(*) FILTER (WHERE g_confirm = 'S') AS registros_confirmados,
+                   COUNT(*) FILTER (WHERE g_confirm IS DISTINCT FROM 'S') AS registros_no_confirmados,
+                   (ARRAY_AGG(g_codi ORDER BY g_fecha DESC NULLS LAST))[1] AS g_codi,
+                   (ARRAY_AGG(g_cose ORDER BY g_fecha DESC NULLS LAST))[1] AS cosecha
+            FROM acocarpo
+            WHERE g_contrato IS NOT NULL {filtro_entregas}
+            GROUP BY g_contrato
+        ),
+        liquidaciones AS (
+            SELECT contrato,
+                   SUM(COALESCE(peso, 0)) AS kilos_liquidados,
+                   COUNT(*) AS registros_liquidaciones,
+                   (ARRAY_AGG(nom_c ORDER BY fec_c NULLS LAST))[1] AS comprador
+            FROM liqven
+            WHERE contrato IS NOT NULL {filtro_liquidaciones}
+            GROUP BY contrato
+        )
+        INSERT INTO contract_summary (
+            contrato, ultima_entrega, kilos_confirmados, kilos_no_confirmados,
+            registros_confirmados, registros_no_confirmados, kilos_liquidados,
+            registros_liquidaciones, grano, cosecha, comprador
+        )
+        SELECT COALESCE(e.contrato, l.contrato), e.ultima_entrega,
+               COALESCE(e.kilos_confirmados, 0), COALESCE(e.kilos_no_confirmados, 0),
+               COALESCE(e.registros_confirmados, 0), COALESCE(e.registros_no_confirmados, 0),
+               COALESCE(l.kilos_liquidados, 0), COALESCE(l.registros_liquidaciones, 0),
+               COALESCE(g.g_desc, e.g_codi), e.cosecha, l.comprador
+        FROM entregas e
+        FULL OUTER JOIN liquidaciones l ON l.contrato = e.contrato
+        LEFT JOIN acogran g ON g.g_codi = e.g_codi
+    """, params)
+    recalculados = cursor.rowcount
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_contract_summary_ultima_entrega ON contract_summary (ultima_entrega DESC)")
+    print(f"Tabla 'contract_summary' actualizada. Contratos recalculados: {recalculados}.")
+
+def refresh_combustible_stock(cursor):
+    """
+    Reconstruye el libro de stock de combustible a partir de todo el historial:
+    'combustible_stock' (stock actual por proveedor y producto) y
+    'combustible_stock_mensual' (movimiento neto de cada mes). La aplicación los
+    mantiene al registrar, editar o borrar movimientos; esta reconstrucción sólo
+    hace falta la primera vez y como conciliación al sincronizar.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS combustible_stock (
+        proveedor_id VARCHAR(255) NOT NULL DEFAULT '', producto_id INTEGER NOT NULL DEFAULT 0,
+        stock NUMERIC(14, 4) NOT NULL DEFAULT 0,
+        PRIMARY KEY (proveedor_id, producto_id)
+    );""")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS combustible_stock_mensual (
+        mes DATE NOT NULL, proveedor_id VARCHAR(255) NOT NULL DEFAULT '', producto_id INTEGER NOT NULL DEFAULT 0,
+        movimiento_neto NUMERIC(14, 4) NOT NULL DEFAULT 0,
+        PRIMARY KEY (mes, proveedor_id, producto_id)
+    );""")
+    cursor.execute("DELETE FROM combustible_stock")
+    cursor.execute("DELETE FROM combustible_stock_mensual")
+    cursor.execute("""
+        INSERT INTO combustible_stock_mensual (mes, proveedor_id, producto_id, movimiento_neto)
+        SELECT DATE_TRUNC('month', fecha)::date, COALESCE(proveedor_id, ''), COALESCE(producto_id, 0), SUM(COALESCE(cantidad, 0))
+        FROM combustible_movimientos
+        WHERE fecha IS NOT NULL
+        GROUP BY 1, 2, 3
+    """)
+    cursor.execute("""
+        INSERT INTO combustible_stock (proveedor_id, producto_id, stock)
+        SELECT COALESCE(proveedor_id, ''), COALESCE(producto_id, 0), SUM(COALESCE(cantidad, 0))
+        FROM combustible_movimientos
+        GROUP BY 1, 2
+    """)
+    print(f"Tablas de stock de combustible recalculadas. Combinaciones proveedor/producto: {cursor.rowcount}.")
+
+# Fuentes del resumen diario y la tabla de la que sale cada una
+FUENTES_RESUMEN_DIARIO = {
+    'entregas': "acocarpo",
+    'compras': "acohis (g_ctl = 'I')",
+    'liquidaciones': "liqven",
+    'vencimientos': "ccbcta (LF, LP, FA)",
+    'cobranzas': "ccbcta (RI, SI, SG, SB)",
+}
+# Fuentes del resumen diario que cambian con cada tabla DBF (contrat da el
+# comprador y acogran el código de grano de las liquidaciones)
+FUENTES_RESUMEN_POR_TABLA = {
+    'acocarpo': ['entregas'],
+    'acohis': ['compras'],
+    'liqven': ['liquidaciones'],
+    'ccbcta': ['vencimientos', 'cobranzas'],
+    'contrat': ['entregas', 'liquidaciones'],
+    'acogran': ['liquidaciones'],
+}
+
+def refresh_resumen_diario(cursor, desde=None, fuentes=None):
+    """
+    Mantiene 'resumen_diario': registros, kilos e importes por fuente, día,
+    grano, cosecha y cliente. Las pantallas que muestran totales por rango de
+    fechas suman estas filas en lugar de recorrer las tablas originales.
+    Con 'desde' sólo se recalculan los días a partir de esa fecha (lo que la
+    sincronización por actualización borra y vuelve a insertar) y con
+    'fuentes' sólo esas fuentes.
+
+    'cliente' es el comprador del contrato en entregas y liquidaciones, el
+    vendedor (cli_c) en compras y el cliente de la cuenta corriente en
+    vencimientos y cobranzas. 'grano' es el código de acogran.
+    """
+    cursor.execute("SELECT to_regclass('resumen_diario') IS NOT NULL")
+    existia = cursor.fetchone()[0]
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS resumen_diario (
+        fuente VARCHAR(20) NOT NULL, fecha DATE NOT NULL,
+        grano VARCHAR(255) NOT NULL DEFAULT '', cosecha VARCHAR(255) NOT NULL DEFAULT '',
+        cliente VARCHAR(255) NOT NULL DEFAULT '',
+        registros INTEGER NOT NULL DEFAULT 0,
+        kilos NUMERIC NOT NULL DEFAULT 0, kilos_brutos NUMERIC NOT NULL DEFAULT 0,
+        importe NUMERIC NOT NULL DEFAULT 0,
+        PRIMARY KEY (fuente, fecha, grano, cosecha, cliente)
+    );""")
+    if not existia:
+        desde = fuentes = None
+    cursor.execute("""
+        DELETE FROM resumen_diario
+        WHERE (%(desde)s::date IS NULL OR fecha >= %(desde)s) AND (%(fuentes)s::text[] IS NULL OR fuente = ANY(%(fuentes)s))
+    """, {'desde': desde, 'fuentes': fuentes})
+
+    cursor.execute("""
+        INSERT INTO resumen_diario (fuente, fecha, grano, cosecha, cliente, registros, kilos, kilos_brutos, importe)
+        SELECT fuente, fecha, grano, cosecha, cliente, COUNT(*), SUM(kilos), SUM(kilos_brutos), SUM(importe)
+        FROM (
+            SELECT 'entregas' AS fuente, a.g_fecha AS fecha, COALESCE(a.g_codi, '') AS grano, COALESCE(a.g_cose, '') AS cosecha,
+                   COALESCE(c.apelcom_c, '') AS cliente,
+                   COALESCE(a.g_saldo, 0) AS kilos, COALESCE(a.g_saldo, 0) AS kilos_brutos, 0 AS importe
+            FROM acocarpo a
+            LEFT JOIN contrat c ON c.nrocont_c = a.g_contrato
+            WHERE a.g_fecha IS NOT NULL AND (%(desde)s::date IS NULL OR a.g_fecha >= %(desde)s)
+            UNION ALL
+            SELECT 'compras', h.g_fecha, COALESCE(h.g_codi, ''), COALESCE(h.g_cose, ''), COALESCE(h.cli_c, ''),
+                   COALESCE(h.o_neto, 0), COALESCE(h.o_peso, 0), 0
+            FROM acohis h
+            WHERE h.g_ctl = 'I' AND h.g_fecha IS NOT NULL AND (%(desde)s::date IS NULL OR h.g_fecha >= %(desde)s)
+            UNION ALL
+            SELECT 'liquidaciones', l.fec_c, COALESCE(g.g_codi, ''), COALESCE(c.cosecha_c, ''), COALESCE(c.apelcom_c, ''),
+                   COALESCE(l.peso, 0), COALESCE(l.peso, 0), COALESCE(l.net_cta, 0)
+            FROM liqven l
+            LEFT JOIN contrat c ON c.nrocont_c = l.contrato
+            -- Un código por descripción: si dos códigos comparten descripción, la liquidación no se duplica
+            LEFT JOIN (SELECT DISTINCT ON (g_desc) g_desc, g_codi FROM acogran ORDER BY g_desc, g_codi) g ON g.g_desc = c.product_c
+            WHERE l.fec_c IS NOT NULL AND (%(desde)s::date IS NULL OR l.fec_c >= %(desde)s)
+            UNION ALL
+            SELECT CASE WHEN b.tip_f IN ('LF', 'LP', 'FA') THEN 'vencimientos' ELSE 'cobranzas' END,
+                   b.vto_f, '', '', COALESCE(b.cli_f, ''), 0, 0, COALESCE(b.imp_f, 0)
+            FROM ccbcta b
+            WHERE b.tip_f IN ('LF', 'LP', 'FA', 'RI', 'SI', 'SG', 'SB')
+              AND b.vto_f IS NOT NULL AND (%(desde)s::date IS NULL OR b.vto_f >= %(desde)s)
+        ) movimientos
+        -- Con valores fijos, PostgreSQL ni siquiera lee las tablas de las fuentes excluidas
+        WHERE %(fuentes)s::text[] IS NULL OR fuente = ANY(%(fuentes)s)
+        GROUP BY fuente, fecha, grano, cosecha, cliente
+    """, {'desde': desde, 'fuentes': fuentes})
+    print(f"Tabla 'resumen_diario' actualizada. Filas recalculadas: {cursor.rowcount}.")
+
+# Método con el que se valoriza el combustible en los márgenes por viaje ('promedio' o 'fifo')
+METODO_VALUACION_MARGEN = 'promedio'
+
+def refresh_fletes_margen(cursor, metodo=METODO_VALUACION_MARGEN):
+    """
+    Reconstruye 'fletes_margen': ingreso, costo de combustible y margen de cada
+    viaje. Los retiros valorizados de cada chofer en un mes se reparten entre
+    sus viajes de ese mes en proporción a los kilómetros (por partes iguales si
+    no hay kilómetros cargados). Se calcula en una sola consulta para toda la flota.
+    """
+    columna_costo = 'costo_fifo' if metodo == 'fifo' else 'costo_promedio'
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS fletes_margen (
+        flete_id INTEGER PRIMARY KEY,
+        g_fecha DATE, periodo DATE, chofer VARCHAR(255), categoria VARCHAR(255),
+        km NUMERIC(12, 2), importe NUMERIC(16, 2),
+        litros NUMERIC(14, 4), costo_combustible NUMERIC(16, 2),
+        margen NUMERIC(16, 2), margen_por_km NUMERIC(16, 4)
+    );""")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fletes_margen_chofer ON fletes_margen (chofer, g_fecha)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fletes_margen_categoria ON fletes_margen (categoria, g_fecha)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fletes_margen_periodo ON fletes_margen (periodo)")
+    cursor.execute("DELETE FROM fletes_margen")
+    cursor.execute(f"""
+        INSERT INTO fletes_margen (flete_id, g_fecha, periodo, chofer, categoria, km, importe,
+                                   litros, costo_combustible, margen, margen_por_km)
+        WITH viajes AS (
+            SELECT f.id, f.g_fecha, DATE_TRUNC('month', f.g_fecha)::date AS periodo, f.g_cuilchof AS chofer,
+                   CASE WHEN f.g_ctg LIKE '102%' THEN 'ROSARIO'
+                        WHEN f.g_ctg LIKE '101%' THEN 'ARRIMES'
+                        ELSE COALESCE(f.categoria, '') END AS categoria,
+                   COALESCE(f.g_kilomet, 0) AS km, COALESCE(f.importe, 0) AS importe
+            FROM fletes f
+            WHERE f.g_fecha IS NOT NULL
+        ),
+        participacion AS (
+            SELECT v.*,
+                   CASE WHEN SUM(v.km) OVER w > 0 THEN v.km::numeric / SUM(v.km) OVER w
+                        ELSE 1.0 / COUNT(*) OVER w END AS parte
+            FROM viajes v
+            WINDOW w AS (PARTITION BY v.chofer, v.periodo)
+        ),
+        consumo AS (
+            SELECT chofer_documento AS chofer, DATE_TRUNC('month', fecha)::date AS periodo,
+                   -SUM(cantidad) AS litros, -SUM({columna_costo}) AS costo
+            FROM combustible_valuacion
+            WHERE tipo_operacion = 'Retiro' AND chofer_documento IS NOT NULL
+            GROUP BY 1, 2
+        )
+        SELECT p.id, p.g_fecha, p.periodo, p.chofer, p.categoria, p.km, p.importe,
+               COALESCE(c.litros, 0) * p.parte,
+               COALESCE(c.costo, 0) * p.parte,
+               p.importe - COALESCE(c.costo, 0) * p.parte,
+               CASE WHEN p.km > 0 THEN (p.importe - COALESCE(c.costo, 0) * p.parte) / p.km END
+        FROM participacion p
+        LEFT JOIN consumo c ON c.chofer = p.chofer AND c.periodo = p.periodo
+    """)
+    print(f"Tabla 'fletes_margen' actualizada. Viajes calculados: {cursor.rowcount}.")
+
+# Eficiencia de combustible: se compara cada mes contra los 12 meses previos
+# del mismo chofer y se marca como atípico si se aparta más de 2 desvíos.
+EFICIENCIA_VENTANA_MESES = 12
+EFICIENCIA_MINIMO_MESES = 3
+EFICIENCIA_UMBRAL_Z = 2
+# Meses que recalcula cada sincronización (los cambios suelen caer en los más recientes)
+EFICIENCIA_MESES_SYNC = 2
+
+def refresh_eficiencia_combustible(cursor, desde=None, chofer=None):
+    """
+    Mantiene 'eficiencia_combustible_mensual': km, litros de GAS-OIL retirados,
+    toneladas, viajes y consumo cada 100 km por chofer y mes, con el desvío
+    respecto del historial propio del chofer. Con 'desde' (y opcionalmente
+    'chofer') sólo se recalculan los meses a partir de esa fecha; sin 'desde'
+    o si la tabla no existía se reconstruye completa.
+    """
+    cursor.execute("SELECT to_regclass('eficiencia_combustible_mensual') IS NOT NULL")
+    existia = cursor.fetchone()[0]
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS eficiencia_combustible_mensual (
+        chofer VARCHAR(255) NOT NULL, mes DATE NOT NULL,
+        km NUMERIC(12, 2) NOT NULL DEFAULT 0, litros NUMERIC(14, 4) NOT NULL DEFAULT 0,
+        toneladas NUMERIC(14, 3) NOT NULL DEFAULT 0, viajes INTEGER NOT NULL DEFAULT 0,
+        consumo_100km NUMERIC(10, 4), desvio_z NUMERIC(10, 4), atipico BOOLEAN NOT NULL DEFAULT FALSE,
+        PRIMARY KEY (chofer, mes)
+    );""")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_eficiencia_combustible_mes ON eficiencia_combustible_mensual (mes)")
+
+    if not existia or desde is None:
+        desde, chofer = None, None
+        cursor.execute("DELETE FROM eficiencia_combustible_mensual")
+    else:
+        cursor.execute("SELECT DATE_TRUNC('month', %s::date)::date", (desde,))
+        desde = cursor.fetchone()[0]
+        cursor.execute("DELETE FROM eficiencia_combustible_mensual WHERE mes >= %s AND (%s IS NULL OR chofer = %s)",
+                       (desde, chofer, chofer))
+
+    filtro = {'desde': desde, 'chofer': chofer}
+    cursor.execute("""
+        INSERT INTO eficiencia_combustible_mensual (chofer, mes, km, litros, toneladas, viajes, consumo_100km)
+        WITH recorridos AS (
+            SELECT g_cuilchof AS chofer, DATE_TRUNC('month', g_fecha)::date AS mes,
+                   SUM(COALESCE(g_kilomet, 0)) AS km, SUM(COALESCE(o_neto, 0)) / 1000 AS toneladas, COUNT(*) AS viajes
+            FROM fletes
+            WHERE g_cuilchof IS NOT NULL AND g_cuilchof != '' AND g_fecha IS NOT NULL
+              AND (%(desde)s::date IS NULL OR g_fecha >= %(desde)s)
+              AND (%(chofer)s::varchar IS NULL OR g_cuilchof = %(chofer)s)
+            GROUP BY 1, 2
+        ),
+        retiros AS (
+            SELECT m.chofer_documento AS chofer, DATE_TRUNC('month', m.fecha)::date AS mes, -SUM(m.cantidad) AS litros
+            FROM combustible_movimientos m
+            JOIN combustible_productos pr ON pr.id = m.producto_id AND pr.nombre ILIKE '%%GAS-OIL%%'
+            WHERE m.tipo_operacion = 'Retiro' AND m.chofer_documento IS NOT NULL AND m.fecha IS NOT NULL
+              AND (%(desde)s::date IS NULL OR m.fecha >= %(desde)s)
+              AND (%(chofer)s::varchar IS NULL OR m.chofer_documento = %(chofer)s)
+            GROUP BY 1, 2
+        )
+        SELECT COALESCE(r.chofer, c.chofer), COALESCE(r.mes, c.mes),
+               COALESCE(r.km, 0), COALESCE(c.litros, 0), COALESCE(r.toneladas, 0), COALESCE(r.viajes, 0),
+               CASE WHEN r.km > 0 THEN COALESCE(c.litros, 0) / r.km * 100 END
+        FROM recorridos r
+        FULL JOIN retiros c ON c.chofer = r.chofer AND c.mes = r.mes
+    """, filtro)
+    recalculados = cursor.rowcount
+
+    # Desvío de cada mes contra la media y el desvío estándar de los meses previos del chofer
+    cursor.execute("""
+        UPDATE eficiencia_combustible_mensual e
+        SET desvio_z = s.desvio_z,
+            atipico = COALESCE(ABS(s.desvio_z) >= %(umbral)s, FALSE)
+        FROM (
+            SELECT chofer, mes,
+                   CASE WHEN COUNT(consumo_100km) OVER w >= %(minimo)s
+                        THEN (consumo_100km - AVG(consumo_100km) OVER w) / NULLIF(STDDEV_SAMP(consumo_100km) OVER w, 0)
+                   END AS desvio_z
+            FROM eficiencia_combustible_mensual
+            WHERE (%(desde)s::date IS NULL OR mes >= %(desde)s::date - %(ventana)s * INTERVAL '1 month')
+              AND (%(chofer)s::varchar IS NULL OR chofer = %(chofer)s)
+            WINDOW w AS (PARTITION BY chofer ORDER BY mes
+                         RANGE BETWEEN %(ventana)s * INTERVAL '1 month' PRECEDING AND INTERVAL '1 month' PRECEDING)
+        ) s
+        WHERE e.chofer = s.chofer AND e.mes = s.mes
+          AND (%(desde)s::date IS NULL OR e.mes >= %(desde)s)
+    """, dict(filtro, umbral=EFICIENCIA_UMBRAL_Z, minimo=EFICIENCIA_MINIMO_MESES, ventana=EFICIENCIA_VENTANA_MESES))
+    print(f"Tabla 'eficiencia_combustible_mensual' actualizada. Meses recalculados: {recalculados}.")
+
+# Índice de distancias: rutas con al menos esta cantidad de viajes se usan para
+# completar y validar kilómetros; fuera de [km_minimo, km_maximo] el km es atípico.
+DISTANCIAS_MINIMO_VIAJES = 3
+DISTANCIAS_TOLERANCIA = 0.2
+
+def refresh_distancias_rutas(cursor):
+    """
+    Reconstruye 'distancias_rutas': mediana, cuartiles y rango aceptable de
+    kilómetros (ida y vuelta) por localidad de origen (sysmae.s_locali de
+    g_ctaplade) y destino (la categoría del viaje, como en fletes_margen).
+    Combina los viajes de 'fletes' con los de acohis que todavía no se
+    importaron (g_kilometr es sólo ida, por eso se duplica como al importar).
+    El rango es el mayor entre cuartiles +/- 1,5 veces el rango intercuartil y
+    la mediana +/- DISTANCIAS_TOLERANCIA.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS distancias_rutas (
+        origen VARCHAR(255) NOT NULL, destino VARCHAR(255) NOT NULL,
+        viajes INTEGER NOT NULL,
+        km_mediana NUMERIC(10, 1), km_p25 NUMERIC(10, 1), km_p75 NUMERIC(10, 1),
+        km_minimo NUMERIC(10, 1), km_maximo NUMERIC(10, 1),
+        PRIMARY KEY (origen, destino)
+    );""")
+    cursor.execute("DELETE FROM distancias_rutas")
+    cursor.execute("""
+        INSERT INTO distancias_rutas (origen, destino, viajes, km_mediana, km_p25, km_p75, km_minimo, km_maximo)
+        WITH viajes AS (
+            SELECT s.s_locali AS origen,
+                   CASE WHEN f.g_ctg LIKE '102%%' THEN 'ROSARIO'
+                        WHEN f.g_ctg LIKE '101%%' THEN 'ARRIMES'
+                        ELSE COALESCE(f.categoria, '') END AS destino,
+                   f.g_kilomet::numeric AS km
+            FROM fletes f
+            JOIN sysmae s ON s.cli_c = f.g_ctaplade
+            WHERE f.g_kilomet > 0
+            UNION ALL
+            SELECT s.s_locali,
+                   CASE WHEN h.g_ctg LIKE '102%%' THEN 'ROSARIO'
+                        WHEN h.g_ctg LIKE '101%%' THEN 'ARRIMES'
+                        ELSE '' END,
+                   h.g_kilometr * 2
+            FROM acohis h
+            JOIN sysmae s ON s.cli_c = h.g_ctaplade
+            WHERE h.g_kilometr > 0
+              AND NOT EXISTS (SELECT 1 FROM fletes f WHERE f.g_ctg = h.g_ctg)
+        ),
+        rutas AS (
+            SELECT origen, destino, COUNT(*) AS viajes,
+                   percentile_cont(0.5) WITHIN GROUP (ORDER BY km) AS mediana,
+                   percentile_cont(0.25) WITHIN GROUP (ORDER BY km) AS p25,
+                   percentile_cont(0.75) WITHIN GROUP (ORDER BY km) AS p75
+            FROM viajes
+            WHERE COALESCE(origen, '') <> ''
+            GROUP BY origen, destino
+        )
+        SELECT origen, destino, viajes, mediana, p25, p75,
+               GREATEST(LEAST(p25 - 1.5 * (p75 - p25), mediana * (1 - %(tolerancia)s)), 0),
+               GREATEST(p75 + 1.5 * (p75 - p25), mediana * (1 + %(tolerancia)s))
+        FROM rutas
+    """, {'tolerancia': DISTANCIAS_TOLERANCIA})
+    print(f"Tabla 'distancias_rutas' actualizada. Rutas: {cursor.rowcount}.")
+
+# Tablas DBF de las que sale cada tabla derivada. Las de combustible sólo
+# dependen de las tablas propias (fletes y combustible_movimientos), que la
+# aplicación recalcula al modificarlas.
+FUENTES_DERIVADAS = {
+    'ccbcta_abierta': {'ccbcta'},
+    'facetas': {'acocarpo', 'acogran', 'contrat', 'acohis', 'sysmae'},
+    # busqueda también incluye valores de facetas
+    'busqueda': {'contrat', 'sysmae', 'choferes', 'acocarpo', 'acogran', 'acohis'},
+    'contract_summary': {'acocarpo', 'liqven', 'acogran'},
+    'pronostico_entregas': {'acocarpo', 'contrat'},
+    'resumen_diario': set(FUENTES_RESUMEN_POR_TABLA),
+    'precios_granos': {'liqven', 'acogran', 'contrat'},
+    'combustible_stock': set(),
+    'valuacion_combustible': set(),
+    'fletes_margen': set(),
+    'distancias_rutas': {'acohis', 'sysmae'},
+    'eficiencia_combustible': set(),
+}
+
+def refresh_tablas_derivadas(cursor, contratos_modificados=None, resumen_desde=None, tablas=None):
+    """
+    Recalcula los resúmenes precalculados a partir de las tablas sincronizadas.
+    'contratos_modificados' permite actualizar sólo esos contratos en los
+    resúmenes por contrato y 'resumen_desde' sólo los días a partir de esa
+    fecha en el resumen diario y el índice de precios (None = recalcular todo).
+    'tablas' son las tablas DBF que cambiaron: sólo se recalcula lo que
+    depende de ellas (None = todo, también lo de combustible).
+    """
+    def afectada(derivada):
+        return tablas is None or not FUENTES_DERIVADAS[derivada].isdisjoint(tablas)
+
+    crear_indices(cursor)
+    if afectada('ccbcta_abierta'):
+        refresh_ccbcta_abierta(cursor)
+    if afectada('facetas'):
+        refresh_facetas(cursor)
+    if afectada('busqueda'):
+        refresh_busqueda(cursor)
+    if afectada('contract_summary'):
+        # Un cambio en acogran puede cambiar el grano de cualquier contrato
+        refresh_contract_summary(cursor, None if tablas and 'acogran' in tablas else contratos_modificados)
+    if afectada('pronostico_entregas'):
+        refresh_pronostico_entregas(cursor)
+    if afectada('resumen_diario'):
+        fuentes = None if tablas is None else sorted({f for t in tablas for f in FUENTES_RESUMEN_POR_TABLA.get(t, [])})
+        refresh_resumen_diario(cursor, resumen_desde, fuentes)
+    if afectada('precios_granos'):
+        refresh_precios_granos(cursor, resumen_desde)
+    if afectada('combustible_stock'):
+        refresh_combustible_stock(cursor)
+    if afectada('valuacion_combustible'):
+        refresh_valuacion_combustible(cursor)
+    if afectada('fletes_margen'):
+        refresh_fletes_margen(cursor)
+    if afectada('distancias_rutas'):
+        refresh_distancias_rutas(cursor)
+    if afectada('eficiencia_combustible'):
+        refresh_eficiencia_combustible(cursor, desde=datetime.date.today() - datetime.timedelta(days=31 * (EFICIENCIA_MESES_SYNC - 1)))
+
+# --- EJECUCIONES DE SINCRONIZACIÓN Y PUNTOS DE CONTROL ---
+# Cada sincronización (completa o por actualización) queda registrada en
+# 'sync_ejecuciones' y el avance de cada tabla en 'sync_tablas'. Los DBF se
+# cargan primero en tablas de carga (<tabla>_carga), confirmando cada
+# SYNC_LOTE registros y guardando hasta qué registro del DBF se llegó. Si la
+# ejecución se corta, la siguiente del mismo tipo la retoma: saltea las tablas
+# ya cargadas y sigue las demás desde el último lote confirmado, siempre que el
+# DBF no haya cambiado (huella: tamaño y fecha de modificación). Recién con
+# todas las tablas cargadas se pasan a las tablas reales y se recalculan los
+# resúmenes en una sola transacción, así la aplicación nunca ve una
+# sincronización a medias.
+SYNC_LOTE = 5000
+SUFIJO_CARGA = '_carga'
+# Clave del advisory lock: una sola sincronización a la vez
+SYNC_BLOQUEO = 730101
+# Ejecuciones que se conservan en el registro
+SYNC_HISTORIA = 50
+
+def asegurar_registro_sync(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS sync_ejecuciones (
+        id SERIAL PRIMARY KEY, tipo VARCHAR(20) NOT NULL, estado VARCHAR(20) NOT NULL,
+        inicio TIMESTAMP DEFAULT NOW(), fin TIMESTAMP, error TEXT
+    );""")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS sync_tablas (
+        ejecucion_id INTEGER REFERENCES sync_ejecuciones(id) ON DELETE CASCADE, tabla VARCHAR(50),
+        estado VARCHAR(20) NOT NULL, huella VARCHAR(100), leidos INTEGER DEFAULT 0, registros INTEGER DEFAULT 0,
+        omitidos INTEGER DEFAULT 0, errores INTEGER DEFAULT 0, actualizado TIMESTAMP DEFAULT NOW(),
+        PRIMARY KEY (ejecucion_id, tabla)
+    );""")
+
+def bloquear_sync(cursor):
+    """Toma el bloqueo de sincronización de la sesión; False si otra sincronización lo tiene."""
+    cursor.execute("SELECT pg_try_advisory_lock(%s)", (SYNC_BLOQUEO,))
+    return cursor.fetchone()[0]
+
+def huella_dbf(dbf_path):
+    estado = os.stat(dbf_path)
+    return f"{estado.st_size}:{int(estado.st_mtime)}"
+
+def iniciar_ejecucion(cursor, tipo):
+    """
+    Retoma la última ejecución si quedó sin terminar y es del mismo tipo; si no,
+    abre una nueva y descarta las tablas de carga que hubieran quedado.
+    Devuelve (ejecucion_id, retomada).
+    """
+    cursor.execute("SELECT id, tipo, estado FROM sync_ejecuciones ORDER BY id DESC LIMIT 1")
+    ultima = cursor.fetchone()
+    if ultima and ultima[2] in ('en_curso', 'fallida') and ultima[1] == tipo:
+        cursor.execute("UPDATE sync_ejecuciones SET estado = 'en_curso', error = NULL WHERE id = %s", (ultima[0],))
+        return ultima[0], True
+    if ultima and ultima[2] in ('en_curso', 'fallida'):
+        cursor.execute("UPDATE sync_ejecuciones SET estado = 'abandonada', fin = NOW() WHERE id = %s", (ultima[0],))
+    for tabla in TABLAS_DBF:
+        cursor.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(tabla + SUFIJO_CARGA)))
+    cursor.execute("INSERT INTO sync_ejecuciones (tipo, estado) VALUES (%s, 'en_curso') RETURNING id", (tipo,))
+    ejecucion_id = cursor.fetchone()[0]
+    cursor.execute("DELETE FROM sync_ejecuciones WHERE id <= %s", (ejecucion_id - SYNC_HISTORIA,))
+    return ejecucion_id, False
+
+def terminar_ejecucion(cursor, ejecucion_id, estado, error=None):
+    cursor.execute("UPDATE sync_ejecuciones SET estado = %s, error = %s, fin = NOW() WHERE id = %s",
+                   (estado, error, ejecucion_id))
+
+def guardar_checkpoint(cursor, ejecucion_id, tabla, estado, huella=None, leidos=0, registros=0, omitidos=0, errores=0):
+    cursor.execute("""
+        INSERT INTO sync_tablas (ejecucion_id, tabla, estado, huella, leidos, registros, omitidos, errores, actualizado)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())
+        ON CONFLICT (ejecucion_id, tabla) DO UPDATE SET
+            estado = EXCLUDED.estado, huella = EXCLUDED.huella, leidos = EXCLUDED.leidos, registros = EXCLUDED.registros,
+            omitidos = EXCLUDED.omitidos, errores = EXCLUDED.errores, actualizado = EXCLUDED.actualizado
+    """, (ejecucion_id, tabla, estado, huella, leidos, registros, omitidos, errores))
+
+def get_tablas_ejecucion(cursor, ejecucion_id):
+    """Tablas que la ejecución ya empezó a cargar (hay que terminarlas al retomarla)."""
+    cursor.execute("SELECT tabla FROM sync_tablas WHERE ejecucion_id = %s", (ejecucion_id,))
+    return {rec[0] for rec in cursor.fetchall()}
+
+def get_tablas_cargadas(cursor, ejecucion_id):
+    """Tablas de la ejecución listas para pasar a las tablas reales."""
+    cursor.execute("SELECT tabla FROM sync_tablas WHERE ejecucion_id = %s AND estado = 'cargada'", (ejecucion_id,))
+    return {rec[0] for rec in cursor.fetchall()}
+
+def insertar_lote(cursor, insert_sql, lote, tabla):
+    """
+    Inserta el lote de una vez; si falla, lo reintenta fila por fila para
+    informar y saltear sólo las filas con error. Devuelve (insertadas, errores).
+    """
+    cursor.execute("SAVEPOINT lote_sync")
+    try:
+        execute_values(cursor, insert_sql, [fila for _, fila in lote], page_size=len(lote))
+        cursor.execute("RELEASE SAVEPOINT lote_sync")
+        return len(lote), 0
+    except Exception:
+        cursor.execute("ROLLBACK TO SAVEPOINT lote_sync")
+    errores = 0
+    for numero, fila in lote:
+        cursor.execute("SAVEPOINT fila_sync")
+        try:
+            execute_values(cursor, insert_sql, [fila])
+            cursor.execute("RELEASE SAVEPOINT fila_sync")
+        except Exception as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT fila_sync")
+            errores += 1
+            print(f"  [Error Fila #{numero}] No se pudo insertar el registro en '{tabla}'. Causa: {e}")
+            print(f"  [Error Fila #{numero}] Datos problemáticos: {fila}")
+    return len(lote) - errores, errores
+
+def cargar_tabla(conn, cursor, ejecucion_id, tabla, actualizar_claves=False, carpeta=None):
+    """
+    Carga el DBF de 'tabla' en su tabla de carga, confirmando cada SYNC_LOTE
+    registros, o retoma la carga desde el último lote confirmado. Con
+    'actualizar_claves', una clave repetida en el DBF se queda con el último
+    registro (como el upsert de update_sync); si no, con el primero.
+    Devuelve 'cargada' o 'sin_archivo'; cualquier otro error se propaga y la
+    tabla queda para retomar.
+    """
+    dbf_path = os.path.join(carpeta or DBF_PATH_PREFIX, f'{tabla}.dbf')
+    try:
+        huella = huella_dbf(dbf_path)
+    except FileNotFoundError:
+        print(f"  [Error Fatal] Archivo no encontrado: {dbf_path}. Saltando tabla '{tabla}'.")
+        guardar_checkpoint(cursor, ejecucion_id, tabla, 'sin_archivo')
+        conn.commit()
+        return 'sin_archivo'
+
+    carga = sql.Identifier(tabla + SUFIJO_CARGA)
+    cursor.execute("SELECT estado, huella, leidos, registros, omitidos, errores FROM sync_tablas WHERE ejecucion_id = %s AND tabla = %s",
+                   (ejecucion_id, tabla))
+    previo = cursor.fetchone()
+    if previo and previo[1] == huella and previo[0] == 'cargada':
+        print(f"  Ya cargada en esta ejecución ({previo[3]} registros), se saltea.")
+        return 'cargada'
+    if previo and previo[1] == huella and previo[0] == 'cargando':
+        leidos, registros, omitidos, errores = previo[2:]
+        print(f"  Se retoma la carga desde el registro {leidos + 1}.")
+    else:
+        leidos = registros = omitidos = errores = 0
+        cursor.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(carga))
+        cursor.execute(sql.SQL(ESQUEMAS_DBF[tabla]).format(carga))
+        guardar_checkpoint(cursor, ejecucion_id, tabla, 'cargando', huella)
+        conn.commit()
+
+    columnas = COLUMNAS_DBF[tabla]
+    insert_sql = sql.SQL("INSERT INTO {} ({}) VALUES %s").format(
+        carga, sql.SQL(', ').join(sql.Identifier(col.lower()) for col in columnas))
+    claves = CLAVES_DBF.get(tabla)
+    if claves:
+        no_claves = [col for col in columnas if col not in claves]
+        if actualizar_claves and no_claves:
+            accion = sql.SQL("DO UPDATE SET {}").format(sql.SQL(', ').join(
+                sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(col.lower())) for col in no_claves))
+        else:
+            accion = sql.SQL("DO NOTHING")
+        insert_sql += sql.SQL(" ON CONFLICT ({}) {}").format(
+            sql.SQL(', ').join(sql.Identifier(col.lower()) for col in claves), accion)
+    insert_sql = insert_sql.as_string(conn)
+    campo_fecha = CAMPOS_FECHA.get(tabla)
+
+    def confirmar_lote(lote, numero, estado):
+        nonlocal registros, errores, leidos
+        if lote:
+            insertadas, con_error = insertar_lote(cursor, insert_sql, lote, tabla)
+            registros += insertadas
+            errores += con_error
+        leidos = numero
+        guardar_checkpoint(cursor, ejecucion_id, tabla, estado, huella, leidos, registros, omitidos, errores)
+        conn.commit()
+
+    dbf = DBF(dbf_path, encoding='iso-8859-1')
+    lote = []
+    numero = leidos
+    for numero, rec in enumerate(dbf, start=1):
+        if numero <= leidos:
+            continue
+        record_date = rec.get(campo_fecha) if campo_fecha else None
+        if record_date and isinstance(record_date, datetime.date) and record_date.year < ANIO_CORTE:
+            omitidos += 1
+        else:
+            lote.append((numero, limpiar_registro(rec, columnas)))
+        if numero % SYNC_LOTE == 0:
+            confirmar_lote(lote, numero, 'cargando')
+            lote = []
+    confirmar_lote(lote, max(numero, leidos), 'cargada')
+    print(f"  Carga de '{tabla}' finalizada. Registros leídos: {leidos}, Omitidos(<{ANIO_CORTE}): {omitidos}, Procesados: {registros}, Errores: {errores}.")
+    return 'cargada'
+
+def cargar_tablas(conn, cursor, ejecucion_id, actualizar_claves=False, carpeta=None, tablas=TABLAS_DBF):
+    """
+    Carga (o retoma) las tablas DBF de la ejecución. Una tabla que falla
+    no detiene las demás. Devuelve las tablas que fallaron.
+    """
+    fallidas = []
+    for tabla in tablas:
+        print(f"\n--- Procesando tabla: {tabla} ---")
+        try:
+            cargar_tabla(conn, cursor, ejecucion_id, tabla, actualizar_claves, carpeta)
+        except Exception as e:
+            conn.rollback()
+            fallidas.append(tabla)
+            print(f"  [Error Fatal] Ocurrió un error inesperado procesando la tabla '{tabla}'. Causa: {e}")
+    return fallidas
+
+def marcar_fallida(conn, ejecucion_id, error):
+    """Deja la ejecución para retomar, después de revertir la transacción en curso."""
+    conn.rollback()
+    with conn.cursor() as cursor:
+        terminar_ejecucion(cursor, ejecucion_id, 'fallida', str(error))
+    conn.commit()
+    print(f"La sincronización quedó incompleta ({error}); al volver a ejecutarla se retoma desde las tablas que faltan.",
+          file=sys.stderr)
+
+def reemplazar_tabla(cursor, tabla):
+    """Sincronización completa: la tabla de carga pasa a ser la tabla real."""
+    # CASCADE en choferes: combustible_movimientos la referencia
+    cascade = sql.SQL(" CASCADE") if tabla == 'choferes' else sql.SQL("")
+    cursor.execute(sql.SQL("DROP TABLE IF EXISTS {}{}").format(sql.Identifier(tabla), cascade))
+    reiniciar_backfill(cursor, tabla)
+    cursor.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+        sql.Identifier(tabla + SUFIJO_CARGA), sql.Identifier(tabla)))
+    if tabla in CLAVES_DBF:
+        # Así la próxima tabla de carga puede volver a crear su clave primaria con el nombre por defecto
+        cursor.execute(sql.SQL("ALTER INDEX IF EXISTS {} RENAME TO {}").format(
+            sql.Identifier(f"{tabla}{SUFIJO_CARGA}_pkey"), sql.Identifier(f"{tabla}_pkey")))
+    print(f"Tabla '{tabla}' reemplazada por la nueva carga.")
+
 def sync_dbfs_to_postgres():
     """
     Sincroniza todos los archivos DBF especificados a sus respectivas tablas en PostgreSQL.
-    El script es robusto y reporta errores sin detenerse.
+    El script es robusto y reporta errores sin detenerse; si se corta, la
+    próxima ejecución retoma la carga desde el último punto de control.
+    Devuelve True si la sincronización se aplicó.
     """
     conn = get_db_connection()
     if not conn:
-        return
+        return False
 
+    ejecucion_id = None
     try:
         with conn.cursor() as cursor:
             print("Conexión a PostgreSQL exitosa. Listo para sincronizar.")
+            if not bloquear_sync(cursor):
+                print("Ya hay una sincronización en curso. Se cancela esta ejecución.", file=sys.stderr)
+                return False
+            asegurar_registro_sync(cursor)
+            ejecucion_id, retomada = iniciar_ejecucion(cursor, 'completa')
+            conn.commit()
+            if retomada:
+                print(f"Se retoma la sincronización #{ejecucion_id}.")
+
+            # --- Carga de los DBF en las tablas de carga, con puntos de control ---
+            fallidas = cargar_tablas(conn, cursor, ejecucion_id)
+            if fallidas:
+                marcar_fallida(conn, ejecucion_id, f"Tablas sin cargar: {', '.join(fallidas)}")
+                return False
+
+            # --- Desde aquí, una sola transacción: la aplicación ve todo el cambio junto ---
+            print("\n--- Reemplazando las tablas sincronizadas ---")
+            cargadas = get_tablas_cargadas(cursor, ejecucion_id)
+            for tabla in TABLAS_DBF:
+                if tabla in cargadas:
+                    reemplazar_tabla(cursor, tabla)
+                else:
+                    # Sin DBF se conservan los datos anteriores; la tabla tiene que existir igual
+                    cursor.execute(sql.SQL(ESQUEMAS_DBF[tabla]).format(sql.Identifier(tabla)))
 
-            # --- Definición de las tablas a sincronizar ---
-            # Cada tupla contiene: (nombre_tabla, nombre_archivo_dbf, create_statement, insert_statement, columnas)
-            tables_to_sync = [
-                (
-                    'acocarpo', 'acocarpo.dbf',
-                    """CREATE TABLE IF NOT EXISTS acocarpo (
-                        G_FECHA DATE, G_CONTRATO VARCHAR(255), G_CODI VARCHAR(255), G_COSE VARCHAR(255),
-                        G_SALDO NUMERIC, G_CONFIRM VARCHAR(1), G_ROMAN VARCHAR(255), G_CTG VARCHAR(255), G_DESTINO VARCHAR(255)
-                    );""",
-                    "INSERT INTO acocarpo (G_FECHA, G_CONTRATO, G_CODI, G_COSE, G_SALDO, G_CONFIRM, G_ROMAN, G_CTG, G_DESTINO) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                    ['G_FECHA', 'G_CONTRATO', 'G_CODI', 'G_COSE', 'G_SALDO', 'G_CONFIRM', 'G_ROMAN', 'G_CTG', 'G_DESTINO']
-                ),
-                (
-                    'liqven', 'liqven.dbf',
-                    """CREATE TABLE IF NOT EXISTS liqven (
-                        FEC_C DATE, CONTRATO VARCHAR(255), PESO NUMERIC, NET_CTA NUMERIC, NOM_C VARCHAR(255), FAC_C VARCHAR(255),
-                        FA1_C VARCHAR(255), BRU_C NUMERIC, IVA_C NUMERIC, PREOPE NUMERIC, OTR_GAS NUMERIC, IVA_GAS NUMERIC,
-                        GAS_COM NUMERIC, IVA_COM NUMERIC, GAS_VAR NUMERIC, IVA_VAR NUMERIC
-                    );""",
-                    "INSERT INTO liqven VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                    ['FEC_C', 'CONTRATO', 'PESO', 'NET_CTA', 'NOM_C', 'FAC_C', 'FA1_C', 'BRU_C', 'IVA_C', 'PREOPE', 'OTR_GAS', 'IVA_GAS', 'GAS_COM', 'IVA_COM', 'GAS_VAR', 'IVA_VAR']
-                ),
-                (
-                    'acogran', 'acogran.dbf',
-                    "CREATE TABLE IF NOT EXISTS acogran (G_CODI VARCHAR(255) PRIMARY KEY, G_DESC VARCHAR(255));",
-                    "INSERT INTO acogran (G_CODI, G_DESC) VALUES (%s, %s) ON CONFLICT (G_CODI) DO NOTHING",
-                    ['G_CODI', 'G_DESC']
-                ),
-                (
-                    'acograst', 'acograst.dbf',
-                    "CREATE TABLE IF NOT EXISTS acograst (G_CODI VARCHAR(255), G_COSE VARCHAR(255), G_STOK NUMERIC, PRIMARY KEY (G_CODI, G_COSE));",
-                    "INSERT INTO acograst (G_CODI, G_COSE, G_STOK) VALUES (%s, %s, %s) ON CONFLICT (G_CODI, G_COSE) DO NOTHING",
-                    ['G_CODI', 'G_COSE', 'G_STOK']
-                ),
-                (
-                    'contrat', 'contrat.dbf',
-                    """CREATE TABLE IF NOT EXISTS contrat (
-                        NROCONT_C VARCHAR(255) PRIMARY KEY, KILOPED_C NUMERIC, ENTREGA_C NUMERIC, LIQUIYA_C NUMERIC,
-                        COSECHA_C VARCHAR(255), PRODUCT_C VARCHAR(255), APELCOM_C VARCHAR(255), FECONT_C DATE
-                    );""",
-                    "INSERT INTO contrat VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (NROCONT_C) DO NOTHING",
-                    ['NROCONT_C', 'KILOPED_C', 'ENTREGA_C', 'LIQUIYA_C', 'COSECHA_C', 'PRODUCT_C', 'APELCOM_C', 'FECONT_C']
-                ),
-                (
-                    'acohis', 'acohis.dbf',
-                    """CREATE TABLE IF NOT EXISTS acohis (
-                        G_FECHA DATE, G_CTG VARCHAR(255), G_CODI VARCHAR(255), G_COSE VARCHAR(255), O_PESO NUMERIC, O_NETO NUMERIC,
-                        G_TARFLET NUMERIC, G_KILOMETR NUMERIC, G_CTAPLADE VARCHAR(255), G_CUILCHOF VARCHAR(255), G_CUITRAN VARCHAR(255), 
-                        G_CTL VARCHAR(255), CLI_C VARCHAR(255), G_LOCALI VARCHAR(255)
-                    );""",
-                    "INSERT INTO acohis VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                    ['G_FECHA', 'G_CTG', 'G_CODI', 'G_COSE', 'O_PESO', 'O_NETO', 'G_TARFLET', 'G_KILOMETR', 'G_CTAPLADE', 'G_CUILCHOF', 'G_CUITRAN', 'G_CTL', 'CLI_C', 'G_LOCALI']
-                ),
-                (
-                    'sysmae', 'sysmae.dbf',
-                    "CREATE TABLE IF NOT EXISTS sysmae (CLI_C VARCHAR(255) PRIMARY KEY, S_APELLI VARCHAR(255), S_LOCALI VARCHAR(255), S_ZONACU VARCHAR(255));",
-                    "INSERT INTO sysmae (CLI_C, S_APELLI, S_LOCALI, S_ZONACU) VALUES (%s, %s, %s, %s) ON CONFLICT (CLI_C) DO NOTHING",
-                    ['CLI_C', 'S_APELLI', 'S_LOCALI', 'S_ZONACU']
-                ),
-                (
-                    'choferes', 'choferes.dbf',
-                    "CREATE TABLE IF NOT EXISTS choferes (C_DOCUMENT VARCHAR(255) PRIMARY KEY, C_NOMBRE VARCHAR(255));",
-                    "INSERT INTO choferes (C_DOCUMENT, C_NOMBRE) VALUES (%s, %s) ON CONFLICT (C_DOCUMENT) DO NOTHING",
-                    ['C_DOCUMENT', 'C_NOMBRE']
-                ),
-                (
-                    'ccbcta', 'ccbcta.dbf',
-                    """CREATE TABLE IF NOT EXISTS ccbcta (
-                        VTO_F DATE, TIP_F VARCHAR(255), IMP_F NUMERIC, CLI_F VARCHAR(255),
-                        FA1_F VARCHAR(255), FAC_F VARCHAR(255), CTA_P VARCHAR(255)
-                    );""",
-                    "INSERT INTO ccbcta VALUES (%s, %s, %s, %s, %s, %s, %s)",
-                    ['VTO_F', 'TIP_F', 'IMP_F', 'CLI_F', 'FA1_F', 'FAC_F', 'CTA_P']
-                )
-            ]
-
-            # --- Proceso de Sincronización ---
-            for table_name, dbf_filename, create_sql, insert_sql, columns in tables_to_sync:
-                print(f"\n--- Procesando tabla: {table_name} ---")
-                try:
-                    # 1. Dropear la tabla para asegurar que el esquema se actualice
-                    # Usamos sql.SQL para evitar inyección de SQL con nombres de tablas.
-                    if table_name == 'choferes': # Add CASCADE for choferes
-                        cursor.execute(sql.SQL("DROP TABLE IF EXISTS {} CASCADE;").format(sql.Identifier(table_name)))
-                        print(f"Tabla '{table_name}' eliminada (si existía) con CASCADE.")
-                    else:
-                        cursor.execute(sql.SQL("DROP TABLE IF EXISTS {};").format(sql.Identifier(table_name)))
-                        print(f"Tabla '{table_name}' eliminada (si existía).")
-
-                    # 2. Crear la tabla de nuevo
-                    cursor.execute(create_sql)
-                    print(f"Tabla '{table_name}' creada de nuevo.")
-
-                    # 3. Leer el archivo DBF
-                    dbf_path = os.path.join(DBF_PATH_PREFIX, dbf_filename)
-                    dbf = DBF(dbf_path, encoding='iso-8859-1')
-                    record_count = 0
-                    error_count = 0
-                    skipped_count = 0
-
-                    # 4. Insertar registros uno por uno
-                    for rec in dbf:
-                        record_count += 1
-
-                        # Filtro de fecha para tablas específicas
-                        if table_name in ['acohis', 'liqven', 'ccbcta', 'acocarpo', 'contrat']:
-                            date_field_name = ''
-                            if table_name == 'acohis':
-                                date_field_name = 'G_FECHA'
-                            elif table_name == 'liqven':
-                                date_field_name = 'FEC_C'
-                            elif table_name == 'ccbcta':
-                                date_field_name = 'VTO_F'
-                            elif table_name == 'acocarpo':
-                                date_field_name = 'G_FECHA'
-                            elif table_name == 'contrat':
-                                date_field_name = 'FECONT_C'
-                            
-                            record_date = rec.get(date_field_name)
-                            if record_date and isinstance(record_date, datetime.date) and record_date.year < 2023:
-                                skipped_count += 1
-                                continue
-                        
-                        try:
-                            # Limpiar y preparar datos
-                            values = []
-                            for col in columns:
-                                val = rec.get(col)
-                                # Lógica de limpieza mejorada y más explícita
-                                col_upper = col.upper()
-                                if 'FECHA' in col_upper or 'FEC_' in col_upper or 'VTO_' in col_upper:
-                                    values.append(clean_date(val))
-                                elif col_upper in ['G_SALDO', 'PESO', 'NET_CTA', 'BRU_C', 'IVA_C', 'PREOPE', 'OTR_GAS', 
-                                                 'IVA_GAS', 'GAS_COM', 'IVA_COM', 'GAS_VAR', 'IVA_VAR', 'G_STOK', 
-                                                 'KILOPED_C', 'ENTREGA_C', 'LIQUIYA_C', 'O_PESO', 'O_NETO', 
-                                                 'G_TARFLET', 'G_KILOMETR', 'IMP_F']:
-                                    values.append(clean_numeric(val))
-                                else:
-                                    values.append(val)
-                            
-                            cursor.execute(insert_sql, tuple(values))
-
-                        except Exception as e:
-                            error_count += 1
-                            print(f"  [Error Fila #{record_count}] No se pudo insertar el registro en '{table_name}'. Causa: {e}")
-                            print(f"  [Error Fila #{record_count}] Datos problemáticos: {dict(rec)}")
-                    
-                    print(f"Sincronización de '{table_name}' finalizada. Total de registros leídos: {record_count}. Registros de años anteriores a 2023 omitidos: {skipped_count}. Errores: {error_count}.")
-
-                except FileNotFoundError:
-                    print(f"  [Error Fatal] Archivo no encontrado: {dbf_path}. Saltando tabla '{table_name}'.")
-                except Exception as e:
-                    print(f"  [Error Fatal] Ocurrió un error inesperado procesando la tabla '{table_name}'. Causa: {e}")
-            
             # Crear tablas base que no se sincronizan desde DBF
             cursor.execute("""
             CREATE TABLE IF NOT EXISTS fletes (
@@ -282,18 +1159,31 @@ def sync_dbfs_to_postgres():
             );""")
             print("Tabla 'combustible_movimientos' creada o ya existente.")
 
+            # --- Resúmenes precalculados ---
+            print("\n--- Recalculando tablas derivadas ---")
+            refresh_tablas_derivadas(cursor)
+            # Las páginas abiertas se actualizan cuando se confirma la sincronización
+            notificar(cursor, 'sync')
+            terminar_ejecucion(cursor, ejecucion_id, 'completa')
+
         conn.commit()
         print("\n¡Sincronización completada! Todos los cambios han sido guardados en la base de datos.")
+        return True
 
     except Exception as e:
-        print(f"\nOcurrió un error crítico durante la transacción: {e}")
+        print(f"\nOcurrió un error crítico durante la transacción: {e}", file=sys.stderr)
         if conn:
             conn.rollback()
             print("Se revirtieron todos los cambios de la transacción actual.")
+            if ejecucion_id:
+                marcar_fallida(conn, ejecucion_id, e)
+        return False
     finally:
         if conn:
             conn.close()
             print("Conexión a la base de datos cerrada.")
 
 if __name__ == '__main__':
-    sync_dbfs_to_postgres()
+    # Código de salida distinto de cero si no se aplicó: /sync-db lo informa como error
+    if not sync_dbfs_to_postgres():
+        sys.exit(1)
@@ -0,0 +1,44 @@
+import sys
+
+import app
+
+# Prueba la página de Fletes filtrada por chofer y sin categoría, el caso que
+# muestra el Resumen del Chofer. Usa la base configurada en app.py.
+
+conn = app.get_db()
+if not conn:
+    print("Error: No se pudo conectar a la base de datos PostgreSQL.")
+    sys.exit(1)
+try:
+    with app.get_dict_cursor(conn) as cursor:
+        cursor.execute("""
+            SELECT g_cuilchof, MIN(g_fecha) AS desde, MAX(g_fecha) AS hasta
+            FROM fletes
+            WHERE g_cuilchof IS NOT NULL AND g_cuilchof != ''
+            GROUP BY g_cuilchof
+            ORDER BY COUNT(*) DESC
+            LIMIT 1
+        """)
+        chofer = cursor.fetchone()
+finally:
+    conn.close()
+
+if not chofer:
+    print("No hay fletes con chofer cargados: no se puede probar el resumen.")
+    sys.exit(1)
+
+respuesta = app.app.test_client().post('/fletes', data={
+    'chofer': chofer['g_cuilchof'],
+    'fecha_desde': chofer['desde'].strftime('%Y-%m-%d'),
+    'fecha_hasta': chofer['hasta'].strftime('%Y-%m-%d'),
+    'categoria': '',
+})
+html = respuesta.get_data(as_text=True)
+if respuesta.status_code != 200 or 'Ocurrió un error' in html or 'Resumen del Chofer' not in html:
+    print(f"Error: /fletes filtrado por el chofer {chofer['g_cuilchof']} no mostró el resumen "
+          f"(estado {respuesta.status_code}).")
+    print(html[:2000])
+    sys.exit(1)
+
+print(f"/fletes filtrado por el chofer {chofer['g_cuilchof']} muestra el Resumen del Chofer.")
+sys.exit(0)
@@ -1,8 +1,13 @@
+import argparse
 import psycopg2
+import sys
 from psycopg2 import sql
-from dbfread import DBF
 import datetime
-import os
+from sync_db import refresh_tablas_derivadas, normalizar_textos
+from sync_db import asegurar_registro_sync, bloquear_sync, iniciar_ejecucion, terminar_ejecucion
+from sync_db import cargar_tablas, marcar_fallida, get_tablas_cargadas, get_tablas_ejecucion
+from sync_db import COLUMNAS_DBF, CLAVES_DBF, CAMPOS_FECHA, ANIO_CORTE, TABLAS_DBF, SUFIJO_CARGA
+from notificaciones import notificar
 
 # --- CONFIGURACIÓN ---
 # Ruta base donde se encuentran los archivos .dbf
@@ -30,153 +35,130 @@ def get_db_connection():
         print(f"Error al conectar a la base de datos: {e}")
         return None
 
-def clean_date(d):
-    """Limpia y valida fechas. Devuelve None si la fecha es inválida."""
-    if isinstance(d, (datetime.date, datetime.datetime)):
-        return d
-    return None
+# Contratos con entregas o liquidaciones borradas o reinsertadas, para
+# actualizar sólo esos contratos en contract_summary.
+CAMPOS_CONTRATO = {'acocarpo': 'G_CONTRATO', 'liqven': 'CONTRATO'}
 
-def clean_numeric(n):
-    """Limpia y valida valores numéricos. Devuelve None si no es un número."""
-    if n is None:
-        return None
-    try:
-        return float(n)
-    except (ValueError, TypeError):
-        return None
-
-def update_dbfs_to_postgres():
+def aplicar_tabla(cursor, tabla, corte, contratos_modificados):
+    """
+    Pasa la tabla de carga a la tabla real: upsert por clave primaria o, en las
+    tablas sin clave, borrar desde el corte e insertar lo cargado.
+    """
+    carga = sql.Identifier(tabla + SUFIJO_CARGA)
+    columnas = COLUMNAS_DBF[tabla]
+    sql_columns = sql.SQL(', ').join(sql.Identifier(col.lower()) for col in columnas)
+    pk_columns = CLAVES_DBF.get(tabla)
+    date_field = CAMPOS_FECHA.get(tabla)
+    contract_field = CAMPOS_CONTRATO.get(tabla)
+
+    if pk_columns:
+        update_cols = [col for col in columnas if col not in pk_columns]
+        if update_cols:
+            accion = sql.SQL("DO UPDATE SET {}").format(sql.SQL(', ').join(
+                sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(col.lower())) for col in update_cols))
+        else: # Si no hay columnas que actualizar, solo se inserta si no existe
+            accion = sql.SQL("DO NOTHING")
+        cursor.execute(sql.SQL("INSERT INTO {table} ({cols}) SELECT {cols} FROM {carga} ON CONFLICT ({pks}) {accion}").format(
+            table=sql.Identifier(tabla), cols=sql_columns, carga=carga,
+            pks=sql.SQL(', ').join(sql.Identifier(col.lower()) for col in pk_columns), accion=accion
+        ))
+        print(f"  '{tabla}': {cursor.rowcount} registros insertados o actualizados.")
+    else:
+        # Estrategia "Delete-then-Insert" para tablas sin PK definida
+        if contract_field:
+            cursor.execute(sql.SQL("SELECT DISTINCT {campo} FROM {table} WHERE {fecha} >= %s UNION SELECT {campo} FROM {carga}").format(
+                campo=sql.Identifier(contract_field.lower()), table=sql.Identifier(tabla),
+                fecha=sql.Identifier(date_field.lower()), carga=carga
+            ), [corte])
+            contratos_modificados.update(row[0] for row in cursor.fetchall())
+        cursor.execute(sql.SQL("DELETE FROM {} WHERE {} >= %s").format(
+            sql.Identifier(tabla), sql.Identifier(date_field.lower())
+        ), [corte])
+        borrados = cursor.rowcount
+        cursor.execute(sql.SQL("INSERT INTO {table} ({cols}) SELECT {cols} FROM {carga}").format(
+            table=sql.Identifier(tabla), cols=sql_columns, carga=carga
+        ))
+        print(f"  '{tabla}': {borrados} registros desde {ANIO_CORTE} eliminados, {cursor.rowcount} insertados.")
+    cursor.execute(sql.SQL("DROP TABLE {}").format(carga))
+
+def update_dbfs_to_postgres(tablas=None):
     """
     Sincroniza archivos DBF a PostgreSQL usando una estrategia de "upsert" (actualizar o insertar).
-    No borra las tablas.
+    No borra las tablas. Los DBF se cargan primero en tablas de carga con puntos
+    de control (ver sync_db.cargar_tabla), así una ejecución cortada se retoma.
+    'tablas' limita la sincronización a esas tablas (por defecto, todas).
+    Devuelve True si la sincronización se completó.
     """
     conn = get_db_connection()
     if not conn:
-        return
+        return False
 
+    ejecucion_id = None
     try:
         with conn.cursor() as cursor:
             print("Conexión a PostgreSQL exitosa. Iniciando sincronización por actualización.")
-
-            # Definición de las tablas a sincronizar con estrategia de UPSERT
-            # (table_name, dbf_filename, columns, pk_columns)
-            # Si pk_columns es None, se usará la estrategia de borrar e insertar por fecha.
-            tables_to_sync = [
-                ('acocarpo', 'acocarpo.dbf', ['G_FECHA', 'G_CONTRATO', 'G_CODI', 'G_COSE', 'G_SALDO', 'G_CONFIRM', 'G_ROMAN', 'G_CTG', 'G_DESTINO'], None),
-                ('liqven', 'liqven.dbf', ['FEC_C', 'CONTRATO', 'PESO', 'NET_CTA', 'NOM_C', 'FAC_C', 'FA1_C', 'BRU_C', 'IVA_C', 'PREOPE', 'OTR_GAS', 'IVA_GAS', 'GAS_COM', 'IVA_COM', 'GAS_VAR', 'IVA_VAR'], None),
-                ('acogran', 'acogran.dbf', ['G_CODI', 'G_DESC'], ['G_CODI']),
-                ('acograst', 'acograst.dbf', ['G_CODI', 'G_COSE', 'G_STOK'], ['G_CODI', 'G_COSE']),
-                ('contrat', 'contrat.dbf', ['NROCONT_C', 'KILOPED_C', 'ENTREGA_C', 'LIQUIYA_C', 'COSECHA_C', 'PRODUCT_C', 'APELCOM_C', 'FECONT_C'], ['NROCONT_C']),
-                ('acohis', 'acohis.dbf', ['G_FECHA', 'G_CTG', 'G_CODI', 'G_COSE', 'O_PESO', 'O_NETO', 'G_TARFLET', 'G_KILOMETR', 'G_CTAPLADE', 'G_CUILCHOF', 'G_CUITRAN', 'G_CTL', 'CLI_C', 'G_LOCALI'], None),
-                ('sysmae', 'sysmae.dbf', ['CLI_C', 'S_APELLI', 'S_LOCALI', 'S_ZONACU'], ['CLI_C']),
-                ('choferes', 'choferes.dbf', ['C_DOCUMENT', 'C_NOMBRE'], ['C_DOCUMENT']),
-                ('ccbcta', 'ccbcta.dbf', ['VTO_F', 'TIP_F', 'IMP_F', 'CLI_F', 'FA1_F', 'FAC_F', 'CTA_P'], None)
-            ]
-
-            for table_name, dbf_filename, columns, pk_columns in tables_to_sync:
-                print(f"\n--- Procesando tabla: {table_name} ---")
-                try:
-                    dbf_path = os.path.join(DBF_PATH_PREFIX, dbf_filename)
-                    dbf = DBF(dbf_path, encoding='iso-8859-1')
-                    
-                    record_count = 0
-                    error_count = 0
-                    skipped_count = 0
-                    upserted_count = 0
-
-                    date_field_map = {
-                        'acohis': 'G_FECHA', 'liqven': 'FEC_C', 'ccbcta': 'VTO_F',
-                        'acocarpo': 'G_FECHA', 'contrat': 'FECONT_C'
-                    }
-                    date_field = date_field_map.get(table_name)
-
-                    # Estrategia "Delete-then-Insert" para tablas sin PK definida
-                    if pk_columns is None and date_field:
-                        print(f"  Estrategia: Borrar e Insertar para registros desde 2023.")
-                        cursor.execute(sql.SQL("DELETE FROM {} WHERE {} >= %s").format(
-                            sql.Identifier(table_name),
-                            sql.Identifier(date_field)
-                        ), [datetime.date(2023, 1, 1)])
-                        print(f"  Registros desde 2023 eliminados de '{table_name}'.")
-
-                    # Construcción de la sentencia de UPSERT para tablas con PK
-                    insert_sql = None
-                    if pk_columns:
-                        update_cols = [col for col in columns if col not in pk_columns]
-                        if not update_cols: # Si no hay columnas que actualizar, solo se inserta si no existe
-                            insert_sql = sql.SQL("INSERT INTO {table} ({cols}) VALUES ({placeholders}) ON CONFLICT ({pks}) DO NOTHING").format(
-                                table=sql.Identifier(table_name),
-                                cols=sql.SQL(', ').join(map(sql.Identifier, columns)),
-                                placeholders=sql.SQL(', ').join(sql.Placeholder() * len(columns)),
-                                pks=sql.SQL(', ').join(map(sql.Identifier, pk_columns))
-                            )
-                        else:
-                            assign_placeholders = sql.SQL(', ').join(
-                                sql.SQL("{} = EXCLUDED.{}").format(sql.Identifier(col), sql.Identifier(col)) for col in update_cols
-                            )
-                            insert_sql = sql.SQL("INSERT INTO {table} ({cols}) VALUES ({placeholders}) ON CONFLICT ({pks}) DO UPDATE SET {assigns}").format(
-                                table=sql.Identifier(table_name),
-                                cols=sql.SQL(', ').join(map(sql.Identifier, columns)),
-                                placeholders=sql.SQL(', ').join(sql.Placeholder() * len(columns)),
-                                pks=sql.SQL(', ').join(map(sql.Identifier, pk_columns)),
-                                assigns=assign_placeholders
-                            )
-                    else: # SQL para "Delete-then-Insert"
-                        insert_sql = sql.SQL("INSERT INTO {table} ({cols}) VALUES ({placeholders})").format(
-                            table=sql.Identifier(table_name),
-                            cols=sql.SQL(', ').join(map(sql.Identifier, columns)),
-                            placeholders=sql.SQL(', ').join(sql.Placeholder() * len(columns))
-                        )
-                    
-                    for rec in dbf:
-                        record_count += 1
-                        
-                        if date_field:
-                            record_date = rec.get(date_field)
-                            if record_date and isinstance(record_date, datetime.date) and record_date.year < 2023:
-                                skipped_count += 1
-                                continue
-                        
-                        try:
-                            values = []
-                            for col in columns:
-                                val = rec.get(col)
-                                col_upper = col.upper()
-                                if 'FECHA' in col_upper or 'FEC_' in col_upper or 'VTO_' in col_upper:
-                                    values.append(clean_date(val))
-                                elif isinstance(val, (int, float, Decimal)):
-                                     values.append(clean_numeric(val))
-                                else:
-                                    values.append(val)
-                            
-                            cursor.execute(insert_sql, tuple(values))
-                            upserted_count += 1
-
-                        except Exception as e:
-                            error_count += 1
-                            print(f"  [Error Fila #{record_count}] No se pudo procesar el registro en '{table_name}'. Causa: {e}")
-                            print(f"  [Error Fila #{record_count}] Datos problemáticos: {dict(rec)}")
-                    
-                    print(f"  Sincronización de '{table_name}' finalizada.")
-                    print(f"  Registros leídos: {record_count}, Omitidos(<2023): {skipped_count}, Procesados: {upserted_count}, Errores: {error_count}.")
-
-                except FileNotFoundError:
-                    print(f"  [Error Fatal] Archivo no encontrado: {dbf_path}. Saltando tabla '{table_name}'.")
-                except Exception as e:
-                    print(f"  [Error Fatal] Ocurrió un error inesperado procesando la tabla '{table_name}'. Causa: {e}")
+            if not bloquear_sync(cursor):
+                print("Ya hay una sincronización en curso. Se cancela esta ejecución.", file=sys.stderr)
+                return False
+            asegurar_registro_sync(cursor)
+            ejecucion_id, retomada = iniciar_ejecucion(cursor, 'actualizacion')
+            conn.commit()
+            # Sincronización parcial (watch_dbf.py): sólo se normaliza y recalcula lo de las tablas cargadas
+            parcial = tablas is not None
+            pedidas = set(tablas or TABLAS_DBF)
+            if retomada:
+                print(f"Se retoma la sincronización #{ejecucion_id}.")
+                # Lo que la ejecución cortada ya había empezado también se termina
+                pedidas |= get_tablas_ejecucion(cursor, ejecucion_id)
+            tablas = [tabla for tabla in TABLAS_DBF if tabla in pedidas]
+
+            # Una clave repetida en el DBF se queda con el último registro, como el upsert fila por fila
+            fallidas = cargar_tablas(conn, cursor, ejecucion_id, actualizar_claves=True, carpeta=DBF_PATH_PREFIX, tablas=tablas)
+            if fallidas:
+                marcar_fallida(conn, ejecucion_id, f"Tablas sin cargar: {', '.join(fallidas)}")
+                return False
+
+            # --- Desde aquí, una sola transacción: la aplicación ve todo el cambio junto ---
+            cargadas = get_tablas_cargadas(cursor, ejecucion_id)
+            alcance = sorted(cargadas) if parcial else None
+            # Las claves con espacios de cargas anteriores no coincidirían con las nuevas en los upserts
+            normalizar_textos(cursor, alcance)
+
+            # Lo anterior al corte lo carga backfill_db.py y no se toca aquí
+            corte = datetime.date(ANIO_CORTE, 1, 1)
+            contratos_modificados = set()
+            print("\n--- Aplicando las tablas cargadas ---")
+            for tabla in TABLAS_DBF:
+                if tabla in cargadas:
+                    aplicar_tabla(cursor, tabla, corte, contratos_modificados)
+
+            print("\n--- Recalculando tablas derivadas ---")
+            refresh_tablas_derivadas(cursor, contratos_modificados, resumen_desde=corte, tablas=alcance)
+            # Las páginas abiertas se actualizan cuando se confirma la sincronización
+            notificar(cursor, 'sync')
+            terminar_ejecucion(cursor, ejecucion_id, 'completa')
 
         conn.commit()
         print("\n¡Sincronización por actualización completada! Todos los cambios han sido guardados.")
+        return True
 
     except Exception as e:
-        print(f"\nOcurrió un error crítico durante la transacción: {e}")
+        print(f"\nOcurrió un error crítico durante la transacción: {e}", file=sys.stderr)
         if conn:
             conn.rollback()
             print("Se revirtieron todos los cambios de la transacción actual.")
+            if ejecucion_id:
+                marcar_fallida(conn, ejecucion_id, e)
+        return False
     finally:
         if conn:
             conn.close()
             print("Conexión a la base de datos cerrada.")
 
 if __name__ == '__main__':
-    update_dbfs_to_postgres()
+    parser = argparse.ArgumentParser(description="Sincroniza los DBF por actualización (upsert).")
+    parser.add_argument('--tablas', nargs='+', choices=TABLAS_DBF, help="Sólo estas tablas (por defecto, todas).")
+    args = parser.parse_args()
+    # Código de salida distinto de cero si no se aplicó: /update-sync-db lo informa como error
+    if not update_dbfs_to_postgres(args.tablas):
+        sys.exit(1)
@@ -0,0 +1,270 @@
+# valuacion_combustible.py
+# Valorización del combustible a costo promedio ponderado y FIFO.
+#
+# Los movimientos se procesan en orden de fecha por proveedor/producto. Cada
+# proveedor/producto guarda su estado (capas de costo y último movimiento
+# procesado) en 'combustible_valuacion_estado', así cada corrida sólo valoriza
+# los movimientos nuevos. Al comienzo de cada mes se guarda una copia del
+# estado en 'combustible_valuacion_cierres': si se carga, edita o borra un
+# movimiento con fecha anterior a lo ya procesado, se vuelve al cierre de ese
+# mes y se revaloriza desde ahí, sin recorrer todo el historial.
+#
+# Las capas son listas de [cantidad, costo_unitario]. Para el promedio
+# ponderado hay una sola capa; en FIFO se consumen desde la más antigua. Una
+# capa con cantidad negativa representa stock retirado sin compras previas,
+# valorizado al último costo conocido.
+
+import json
+from decimal import Decimal
+
+from psycopg2.extras import execute_values
+
+METODOS_VALUACION = ('promedio', 'fifo')
+FECHA_SIN_DATO = '1900-01-01'
+LOTE_VALUACION = 5000
+
+def crear_tablas_valuacion(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS combustible_valuacion (
+        movimiento_id INTEGER PRIMARY KEY,
+        fecha TIMESTAMP NOT NULL,
+        proveedor_id VARCHAR(255) NOT NULL DEFAULT '', producto_id INTEGER NOT NULL DEFAULT 0,
+        chofer_documento VARCHAR(255), tipo_operacion VARCHAR(50),
+        cantidad NUMERIC(12, 4) NOT NULL DEFAULT 0,
+        costo_promedio NUMERIC(16, 4) NOT NULL DEFAULT 0,
+        costo_fifo NUMERIC(16, 4) NOT NULL DEFAULT 0
+    );""")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_combustible_valuacion_chofer ON combustible_valuacion (chofer_documento, fecha)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_combustible_valuacion_clave ON combustible_valuacion (proveedor_id, producto_id, fecha)")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS combustible_valuacion_estado (
+        proveedor_id VARCHAR(255) NOT NULL DEFAULT '', producto_id INTEGER NOT NULL DEFAULT 0,
+        ultima_fecha TIMESTAMP NOT NULL, ultimo_id INTEGER NOT NULL,
+        capas_promedio JSONB NOT NULL, capas_fifo JSONB NOT NULL,
+        PRIMARY KEY (proveedor_id, producto_id)
+    );""")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS combustible_valuacion_cierres (
+        mes DATE NOT NULL,
+        proveedor_id VARCHAR(255) NOT NULL DEFAULT '', producto_id INTEGER NOT NULL DEFAULT 0,
+        capas_promedio JSONB NOT NULL, capas_fifo JSONB NOT NULL,
+        PRIMARY KEY (proveedor_id, producto_id, mes)
+    );""")
+
+def valuar_movimiento(capas, cantidad, precio_unitario, promedio):
+    """
+    Aplica un movimiento a las capas (se modifican en el lugar) y devuelve su
+    costo con el signo de la cantidad: positivo para entradas, negativo para
+    retiros y salidas de canje.
+    """
+    if cantidad > 0:
+        if precio_unitario is not None:
+            costo_unitario = precio_unitario
+        else:
+            costo_unitario = capas[-1][1] if capas else Decimal(0)
+        restante = cantidad
+        # Primero se cubre el stock negativo pendiente
+        while restante and capas and capas[0][0] < 0:
+            cubierto = min(restante, -capas[0][0])
+            capas[0][0] += cubierto
+            restante -= cubierto
+            if capas[0][0] == 0:
+                capas.pop(0)
+        if restante:
+            capas.append([restante, costo_unitario])
+        if promedio and len(capas) > 1:
+            total = sum(c[0] for c in capas)
+            valor = sum(c[0] * c[1] for c in capas)
+            capas[:] = [[total, valor / total if total else costo_unitario]]
+        return cantidad * costo_unitario
+
+    if cantidad < 0:
+        ultimo_costo = capas[-1][1] if capas else (precio_unitario or Decimal(0))
+        restante = -cantidad
+        costo = Decimal(0)
+        while restante and capas and capas[0][0] > 0:
+            tomado = min(restante, capas[0][0])
+            costo += tomado * capas[0][1]
+            capas[0][0] -= tomado
+            restante -= tomado
+            if capas[0][0] == 0:
+                capas.pop(0)
+        if restante:
+            costo += restante * ultimo_costo
+            if capas and capas[0][0] < 0:
+                capas[0][0] -= restante
+            else:
+                capas.insert(0, [-restante, ultimo_costo])
+        return -costo
+
+    return Decimal(0)
+
+def _capas_a_json(capas):
+    return json.dumps([[str(cantidad), str(costo)] for cantidad, costo in capas])
+
+def _capas_desde_json(valor):
+    if isinstance(valor, str):
+        valor = json.loads(valor)
+    return [[Decimal(cantidad), Decimal(costo)] for cantidad, costo in valor]
+
+def invalidar_valuacion_combustible(cursor, proveedor_id, producto_id, fecha):
+    """
+    Se llama al cargar, editar o borrar un movimiento. Si la fecha es anterior
+    a lo ya valorizado para ese proveedor/producto, vuelve al cierre del mes
+    correspondiente para que la próxima corrida revalorice desde ahí.
+    """
+    crear_tablas_valuacion(cursor)
+    proveedor_id = proveedor_id or ''
+    producto_id = int(producto_id) if producto_id else 0
+    fecha = fecha or FECHA_SIN_DATO
+    cursor.execute("""
+        SELECT 1 FROM combustible_valuacion_estado
+        WHERE proveedor_id = %s AND producto_id = %s AND ultima_fecha >= %s
+    """, (proveedor_id, producto_id, fecha))
+    if not cursor.fetchone():
+        return
+
+    cursor.execute("""
+        SELECT mes, capas_promedio, capas_fifo FROM combustible_valuacion_cierres
+        WHERE proveedor_id = %s AND producto_id = %s AND mes <= %s
+        ORDER BY mes DESC LIMIT 1
+    """, (proveedor_id, producto_id, fecha))
+    cierre = cursor.fetchone()
+    desde = cierre[0] if cierre else FECHA_SIN_DATO
+
+    cursor.execute("DELETE FROM combustible_valuacion WHERE proveedor_id = %s AND producto_id = %s AND fecha >= %s",
+                   (proveedor_id, producto_id, desde))
+    cursor.execute("DELETE FROM combustible_valuacion_cierres WHERE proveedor_id = %s AND producto_id = %s AND mes > %s",
+                   (proveedor_id, producto_id, desde))
+    if cierre:
+        # El estado queda justo antes del primer movimiento del mes del cierre
+        cursor.execute("""
+            UPDATE combustible_valuacion_estado
+            SET ultima_fecha = %s, ultimo_id = 0, capas_promedio = %s, capas_fifo = %s
+            WHERE proveedor_id = %s AND producto_id = %s
+        """, (cierre[0], json.dumps(cierre[1]), json.dumps(cierre[2]), proveedor_id, producto_id))
+    else:
+        cursor.execute("DELETE FROM combustible_valuacion_estado WHERE proveedor_id = %s AND producto_id = %s",
+                       (proveedor_id, producto_id))
+
+def refresh_valuacion_combustible(cursor, desde_cero=False):
+    """
+    Valoriza los movimientos de combustible que todavía no fueron procesados.
+    Con 'desde_cero' se descarta todo lo calculado y se recorre el historial completo.
+    """
+    crear_tablas_valuacion(cursor)
+    if desde_cero:
+        cursor.execute("DELETE FROM combustible_valuacion")
+        cursor.execute("DELETE FROM combustible_valuacion_estado")
+        cursor.execute("DELETE FROM combustible_valuacion_cierres")
+
+    estados = {}
+    cursor.execute("SELECT proveedor_id, producto_id, ultima_fecha, ultimo_id, capas_promedio, capas_fifo FROM combustible_valuacion_estado")
+    for proveedor_id, producto_id, ultima_fecha, ultimo_id, capas_promedio, capas_fifo in cursor.fetchall():
+        estados[(proveedor_id, producto_id)] = {
+            'ultima_fecha': ultima_fecha, 'ultimo_id': ultimo_id,
+            'promedio': _capas_desde_json(capas_promedio), 'fifo': _capas_desde_json(capas_fifo),
+            'mes': ultima_fecha.date().replace(day=1), 'modificado': False,
+        }
+
+    # Cursor del lado del servidor: la primera corrida puede recorrer años de movimientos
+    valuados = []
+    cierres = []
+    procesados = 0
+    with cursor.connection.cursor(name='valuacion_combustible') as pendientes:
+        pendientes.itersize = LOTE_VALUACION
+        pendientes.execute("""
+            SELECT m.id, COALESCE(m.fecha, %(sin_dato)s) AS fecha,
+                   COALESCE(m.proveedor_id, '') AS proveedor_id, COALESCE(m.producto_id, 0) AS producto_id,
+                   m.chofer_documento, m.tipo_operacion, COALESCE(m.cantidad, 0), m.precio_unitario
+            FROM combustible_movimientos m
+            LEFT JOIN combustible_valuacion_estado e
+                   ON e.proveedor_id = COALESCE(m.proveedor_id, '') AND e.producto_id = COALESCE(m.producto_id, 0)
+            WHERE e.proveedor_id IS NULL OR (COALESCE(m.fecha, %(sin_dato)s), m.id) > (e.ultima_fecha, e.ultimo_id)
+            ORDER BY 3, 4, 2, 1
+        """, {'sin_dato': FECHA_SIN_DATO})
+        for mov_id, fecha, proveedor_id, producto_id, chofer, tipo, cantidad, precio in pendientes:
+            clave = (proveedor_id, producto_id)
+            estado = estados.get(clave)
+            mes = fecha.date().replace(day=1)
+            if estado is None:
+                estado = estados[clave] = {'promedio': [], 'fifo': [], 'mes': mes}
+            elif mes > estado['mes']:
+                cierres.append((mes, proveedor_id, producto_id,
+                                _capas_a_json(estado['promedio']), _capas_a_json(estado['fifo'])))
+            estado.update(mes=mes, ultima_fecha=fecha, ultimo_id=mov_id, modificado=True)
+
+            costo_promedio = valuar_movimiento(estado['promedio'], cantidad, precio, True)
+            costo_fifo = valuar_movimiento(estado['fifo'], cantidad, precio, False)
+            valuados.append((mov_id, fecha, proveedor_id, producto_id, chofer, tipo, cantidad,
+                             round(costo_promedio, 4), round(costo_fifo, 4)))
+            procesados += 1
+            if len(valuados) >= LOTE_VALUACION:
+                _guardar_valuados(cursor, valuados, cierres)
+
+    _guardar_valuados(cursor, valuados, cierres)
+    estados_modificados = [
+        (proveedor_id, producto_id, e['ultima_fecha'], e['ultimo_id'],
+         _capas_a_json(e['promedio']), _capas_a_json(e['fifo']))
+        for (proveedor_id, producto_id), e in estados.items() if e.get('modificado')
+    ]
+    if estados_modificados:
+        execute_values(cursor, """
+            INSERT INTO combustible_valuacion_estado
+                (proveedor_id, producto_id, ultima_fecha, ultimo_id, capas_promedio, capas_fifo)
+            VALUES %s
+            ON CONFLICT (proveedor_id, producto_id) DO UPDATE SET
+                ultima_fecha = EXCLUDED.ultima_fecha, ultimo_id = EXCLUDED.ultimo_id,
+                capas_promedio = EXCLUDED.capas_promedio, capas_fifo = EXCLUDED.capas_fifo
+        """, estados_modificados)
+    print(f"Valorización de combustible actualizada. Movimientos valorizados: {procesados}.")
+    return procesados
+
+def _guardar_valuados(cursor, valuados, cierres):
+    if valuados:
+        execute_values(cursor, """
+            INSERT INTO combustible_valuacion
+                (movimiento_id, fecha, proveedor_id, producto_id, chofer_documento, tipo_operacion,
+                 cantidad, costo_promedio, costo_fifo)
+            VALUES %s
+            ON CONFLICT (movimiento_id) DO UPDATE SET
+                fecha = EXCLUDED.fecha, proveedor_id = EXCLUDED.proveedor_id, producto_id = EXCLUDED.producto_id,
+                chofer_documento = EXCLUDED.chofer_documento, tipo_operacion = EXCLUDED.tipo_operacion,
+                cantidad = EXCLUDED.cantidad, costo_promedio = EXCLUDED.costo_promedio, costo_fifo = EXCLUDED.costo_fifo
+        """, valuados, page_size=1000)
+        valuados.clear()
+    if cierres:
+        execute_values(cursor, """
+            INSERT INTO combustible_valuacion_cierres (mes, proveedor_id, producto_id, capas_promedio, capas_fifo)
+            VALUES %s
+            ON CONFLICT (proveedor_id, producto_id, mes) DO UPDATE SET
+                capas_promedio = EXCLUDED.capas_promedio, capas_fifo = EXCLUDED.capas_fifo
+        """, cierres, page_size=1000)
+        cierres.clear()
+
+def get_retiros_valorizados(cursor, metodo='promedio', fecha_inicio=None, fecha_fin=None, chofer=None):
+    """Retiros valorizados agrupados por chofer y mes, con el costo según 'metodo'."""
+    columna_costo = 'costo_fifo' if metodo == 'fifo' else 'costo_promedio'
+    query = f"""
+        SELECT v.chofer_documento, ch.c_nombre AS chofer,
+               DATE_TRUNC('month', v.fecha)::date AS mes,
+               -SUM(v.cantidad) AS litros,
+               -SUM(v.{columna_costo}) AS costo,
+               CASE WHEN SUM(v.cantidad) != 0 THEN SUM(v.{columna_costo}) / SUM(v.cantidad) END AS costo_por_litro
+        FROM combustible_valuacion v
+        LEFT JOIN choferes ch ON ch.c_document = v.chofer_documento
+        WHERE v.tipo_operacion = 'Retiro'
+    """
+    params = []
+    if fecha_inicio:
+        query += " AND v.fecha >= %s"
+        params.append(fecha_inicio)
+    if fecha_fin:
+        query += " AND v.fecha < %s::date + 1"
+        params.append(fecha_fin)
+    if chofer:
+        query += " AND v.chofer_documento = %s"
+        params.append(chofer)
+    query += " GROUP BY v.chofer_documento, ch.c_nombre, mes ORDER BY mes DESC, ch.c_nombre"
+    cursor.execute(query, params)
+    return cursor.fetchall()
@@ -0,0 +1,208 @@
+# watch_dbf.py
+# Sincronización automática: vigila la carpeta de los DBF (DBF_PATH_PREFIX de
+# update_sync.py) y, cuando el sistema de acopio modifica alguno de los nueve
+# archivos, sincroniza por actualización sólo las tablas que cambiaron y
+# recalcula sólo las tablas derivadas que dependen de ellas.
+#
+# Los avisos de cambios vienen de watchdog (inotify en Linux, los avisos de
+# carpeta de Windows en C:\acocta5). Si watchdog no está instalado o no puede
+# vigilar la carpeta (por ejemplo, una unidad de red), se revisa cada
+# WATCH_INTERVALO_SONDEO segundos la huella (tamaño y fecha) de cada archivo.
+#
+# El sistema de acopio escribe un DBF en varias tandas: una tabla se sincroniza
+# recién cuando pasan WATCH_ESPERA segundos sin cambios en su archivo (o a los
+# WATCH_ESPERA_MAXIMA segundos del primer cambio, si no para de escribirse).
+# Un único hilo hace las sincronizaciones, de a una: los cambios que llegan
+# mientras tanto se juntan y salen todos en la siguiente, así cada tabla tiene
+# a lo sumo una sincronización en curso y otra pendiente. Si la sincronización
+# no se completa (otra en curso desde la página de sincronización o un error),
+# las tablas se vuelven a intentar a los WATCH_REINTENTO segundos.
+#
+# Uso: python watch_dbf.py [--sondeo]
+
+import argparse
+import os
+import threading
+import time
+
+import update_sync
+from sync_db import huella_dbf, asegurar_registro_sync, TABLAS_DBF
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+# Segundos sin cambios en un DBF antes de sincronizar su tabla
+WATCH_ESPERA = 30
+# Un archivo que no para de cambiar se sincroniza igual pasado este tiempo
+WATCH_ESPERA_MAXIMA = 300
+WATCH_INTERVALO_SONDEO = 10
+WATCH_REINTENTO = 60
+
+def get_huellas_sincronizadas():
+    """Huella de cada DBF en su última sincronización completa, para no repetirla."""
+    conn = update_sync.get_db_connection()
+    if not conn:
+        return {}
+    try:
+        with conn.cursor() as cursor:
+            asegurar_registro_sync(cursor)
+            cursor.execute("""
+                SELECT DISTINCT ON (t.tabla) t.tabla, t.huella
+                FROM sync_tablas t
+                JOIN sync_ejecuciones e ON e.id = t.ejecucion_id
+                WHERE e.estado = 'completa' AND t.estado = 'cargada'
+                ORDER BY t.tabla, e.id DESC
+            """)
+            huellas = dict(cursor.fetchall())
+        conn.commit()
+        return huellas
+    finally:
+        conn.close()
+
+def tabla_de_archivo(path):
+    """Tabla sincronizada a la que corresponde un archivo de la carpeta, o None."""
+    nombre, extension = os.path.splitext(os.path.basename(path).lower())
+    if extension == '.dbf' and nombre in TABLAS_DBF:
+        return nombre
+    return None
+
+def huella_actual(tabla):
+    try:
+        return huella_dbf(os.path.join(update_sync.DBF_PATH_PREFIX, f'{tabla}.dbf'))
+    except OSError:
+        return None
+
+class VigilanteDBF(FileSystemEventHandler):
+    """
+    Junta los cambios de los DBF por tabla y los sincroniza desde un único hilo
+    cuando cada archivo deja de cambiar.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # tabla -> [primer cambio, último cambio] de las que esperan sincronizarse
+        self._pendientes = {}
+        self._condicion = threading.Condition()
+        # Huella de cada DBF en su última sincronización (la actualiza sólo el hilo que sincroniza)
+        self.huellas = get_huellas_sincronizadas()
+
+    def avisar(self, tabla, demora=0):
+        with self._condicion:
+            ahora = time.monotonic() + demora
+            if tabla in self._pendientes:
+                self._pendientes[tabla][1] = ahora
+            else:
+                self._pendientes[tabla] = [ahora, ahora]
+            self._condicion.notify()
+
+    def on_any_event(self, event):
+        # Abrir o leer el archivo (lo hace la misma sincronización) no es un cambio
+        if event.is_directory or event.event_type in ('opened', 'closed_no_write'):
+            return
+        # En un renombre (el sistema puede reemplazar el archivo) importa el destino
+        for path in (event.src_path, getattr(event, 'dest_path', '')):
+            tabla = tabla_de_archivo(path) if path else None
+            if tabla:
+                self.avisar(tabla)
+
+    def revisar_huellas(self, vistas):
+        """Avisa las tablas cuyo DBF cambió desde la huella anotada en 'vistas', y la actualiza."""
+        for tabla in TABLAS_DBF:
+            huella = huella_actual(tabla)
+            if huella and huella != vistas.get(tabla):
+                vistas[tabla] = huella
+                self.avisar(tabla)
+
+    def _listas(self):
+        """Tablas sin cambios hace WATCH_ESPERA segundos, y cuánto falta para la próxima."""
+        ahora = time.monotonic()
+        listas = []
+        vencimientos = []
+        for tabla, (primero, ultimo) in self._pendientes.items():
+            vence = min(ultimo + WATCH_ESPERA, primero + WATCH_ESPERA_MAXIMA)
+            if vence <= ahora:
+                listas.append(tabla)
+            else:
+                vencimientos.append(vence)
+        return listas, (min(vencimientos) - ahora if vencimientos else None)
+
+    def _esperar_listas(self):
+        with self._condicion:
+            while True:
+                listas, proxima = self._listas()
+                if listas:
+                    for tabla in listas:
+                        del self._pendientes[tabla]
+                    return listas
+                self._condicion.wait(proxima)
+
+    def sincronizar(self):
+        """Bucle del hilo de sincronización."""
+        while True:
+            tablas = self._esperar_listas()
+            huellas = {tabla: huella_actual(tabla) for tabla in tablas}
+            # Un aviso sin cambio real (por ejemplo, sólo se abrió el archivo) no se sincroniza
+            tablas = [tabla for tabla in tablas if huellas[tabla] and huellas[tabla] != self.huellas.get(tabla)]
+            if not tablas:
+                continue
+            print(f"\n=== Cambios en {', '.join(tablas)}: sincronizando ===")
+            try:
+                completa = update_sync.update_dbfs_to_postgres(tablas)
+            except Exception as e:
+                print(f"Error inesperado en la sincronización automática: {e}")
+                completa = False
+            if completa:
+                self.huellas.update(huellas)
+            else:
+                print(f"Sincronización no completada; se reintenta en {WATCH_REINTENTO} s.")
+                for tabla in tablas:
+                    self.avisar(tabla, demora=WATCH_REINTENTO)
+
+    def sondear(self, vistas):
+        """Bucle de revisión periódica, si no se pueden recibir avisos de la carpeta."""
+        while True:
+            time.sleep(WATCH_INTERVALO_SONDEO)
+            self.revisar_huellas(vistas)
+
+def iniciar_observador(vigilante):
+    """Empieza a recibir los avisos de la carpeta con watchdog; None si no se puede."""
+    if Observer is None:
+        print("watchdog no está instalado: se revisan los archivos cada "
+              f"{WATCH_INTERVALO_SONDEO} s.")
+        return None
+    observador = Observer()
+    try:
+        observador.schedule(vigilante, update_sync.DBF_PATH_PREFIX, recursive=False)
+        observador.start()
+    except Exception as e:
+        print(f"No se pudo vigilar la carpeta, se revisan los archivos cada {WATCH_INTERVALO_SONDEO} s. Causa: {e}")
+        return None
+    return observador
+
+def vigilar(sondeo=False):
+    print(f"Vigilando los DBF de {update_sync.DBF_PATH_PREFIX}.")
+    vigilante = VigilanteDBF()
+    # Lo que cambió mientras el vigilante no estaba corriendo
+    vistas = dict(vigilante.huellas)
+    vigilante.revisar_huellas(vistas)
+    observador = None if sondeo else iniciar_observador(vigilante)
+    if observador is None:
+        threading.Thread(target=vigilante.sondear, args=(vistas,), name='sondeo-dbf', daemon=True).start()
+    try:
+        vigilante.sincronizar()
+    except KeyboardInterrupt:
+        print("\nVigilancia detenida.")
+    finally:
+        if observador:
+            observador.stop()
+            observador.join()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sincroniza automáticamente las tablas cuyos DBF cambian.")
+    parser.add_argument('--sondeo', action='store_true', help="Revisar los archivos periódicamente en lugar de usar watchdog.")
+    args = parser.parse_args()
+    vigilar(args.sondeo)